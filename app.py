@@ -1,178 +1,2509 @@
 import os
+import re
+import io
+import csv
 import json
+import gzip
+import shutil
+import sqlite3
+import math
+import time
+import random
+import sys
+import hashlib
+import hmac
+import html
+import uuid
+import threading
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import logging.handlers
+import queue
+import atexit
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from email.utils import parsedate_to_datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session, jsonify, g, has_app_context
+from flask import before_render_template, template_rendered
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from diff_match_patch import diff_match_patch
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 import traceback
+import click
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, and a single development server doesn't need it
+    fcntl = None
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
-
-# Set up logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hunt_analyzer.log')),
-        logging.StreamHandler()
-    ]
-)
+# Without SECRET_KEY, create_app() uses a key stored in the data directory
+app.secret_key = os.environ.get('SECRET_KEY')
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEBUG_MODE = os.environ.get('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
+
+# Logging settings, applied by create_app()
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG' if DEBUG_MODE else 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')  # Levels of single loggers, e.g. "hunt_analyzer.api=DEBUG,urllib3=WARNING"
+LOG_FILE = os.environ.get('HUNT_LOG_FILE', os.path.join(APP_DIR, 'hunt_analyzer.log'))  # Empty to only log to the console
+LOG_MAX_BYTES = int(os.environ.get('HUNT_LOG_MAX_BYTES', str(10 * 1024 * 1024)))  # Size at which the log file is rotated, 0 never rotates
+LOG_BACKUP_COUNT = int(os.environ.get('HUNT_LOG_BACKUP_COUNT', '5'))  # Rotated log files kept
+LOG_SAMPLE_SIZE = int(os.environ.get('HUNT_LOG_SAMPLE_SIZE', '10'))  # Lines logged per message template and operation, the rest are counted
 logger = logging.getLogger('hunt_analyzer')
+# Subsystems log to child loggers so LOG_LEVELS can set their levels separately
+api_logger = logging.getLogger('hunt_analyzer.api')
+storage_logger = logging.getLogger('hunt_analyzer.storage')
+job_logger = logging.getLogger('hunt_analyzer.jobs')
+
+# Data directory, created by create_app()
+DATA_DIR = os.environ.get('HUNT_DATA_DIR', os.path.join(APP_DIR, 'data'))
+
+# Largest request body accepted, such as an uploaded hunt list, 0 disables the limit
+REQUEST_MAX_BYTES = int(os.environ.get('HUNT_MAX_REQUEST_BYTES', str(16 * 1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = REQUEST_MAX_BYTES or None
+
+# Hunt results pagination settings
+RESULTS_PAGE_SIZE = 50  # Default API limit
+RESULTS_FETCH_CONCURRENCY = int(os.environ.get('HUNT_FETCH_CONCURRENCY', '8'))
+RESULTS_MAX_PENDING_HUNTS = int(os.environ.get('HUNT_FETCH_MAX_PENDING_HUNTS', '4'))  # Hunts whose records are fetched or held in memory at once
+
+# Results cache settings, per user. Message records are kept in the database, so
+# removed results only have to be downloaded again when a hunt is refreshed
+RESULTS_CACHE_MAX_BYTES = int(os.environ.get('HUNT_RESULTS_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))  # Least recently used results are removed first, 0 disables
+RESULTS_CACHE_MAX_AGE_DAYS = float(os.environ.get('HUNT_RESULTS_CACHE_MAX_AGE_DAYS', '30'))  # Results not used for this long are removed, 0 disables
+
+# Sublime API connection settings
+API_BASE_URL = os.environ.get('SUBLIME_API_BASE_URL', 'https://platform.sublime.security/v1').rstrip('/')
+API_CONNECT_TIMEOUT = float(os.environ.get('SUBLIME_API_CONNECT_TIMEOUT', '10'))
+API_READ_TIMEOUT = float(os.environ.get('SUBLIME_API_READ_TIMEOUT', '60'))
+API_MAX_RETRIES = int(os.environ.get('SUBLIME_API_MAX_RETRIES', '5'))
+API_BACKOFF_FACTOR = float(os.environ.get('SUBLIME_API_BACKOFF_FACTOR', '0.5'))
+API_MAX_BACKOFF = float(os.environ.get('SUBLIME_API_MAX_BACKOFF', '60'))
+API_RATE_LIMIT = float(os.environ.get('SUBLIME_API_RATE_LIMIT', '20'))  # Requests per second per token, 0 disables
+API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+API_MAX_CONCURRENCY = int(os.environ.get('SUBLIME_API_MAX_CONCURRENCY', '16'))  # Requests in flight at once across the process
+
+# Background job settings
+JOB_WORKERS = int(os.environ.get('HUNT_JOB_WORKERS', '4'))
+JOB_STALE_SECONDS = float(os.environ.get('HUNT_JOB_STALE_SECONDS', '900'))  # Unfinished jobs without progress for this long were interrupted
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+JOB_PROGRESS_INTERVAL = 0.5  # Minimum seconds between progress writes
+
+# Message records kept in memory for the analyze view
+HUNT_RECORDS_CACHE_SIZE = int(os.environ.get('HUNT_RECORDS_CACHE_SIZE', '16'))  # Number of hunts
+USER_LABELS_CACHE_SIZE = int(os.environ.get('USER_LABELS_CACHE_SIZE', '32'))  # Number of users
+RULE_ANALYTICS_CACHE_SIZE = int(os.environ.get('RULE_ANALYTICS_CACHE_SIZE', '64'))  # Number of rule tables
+MESSAGES_PAGE_SIZE = 100
+MESSAGES_MAX_PAGE_SIZE = 500
+
+# MQL diff settings
+MQL_DIFF_TIMEOUT = float(os.environ.get('MQL_DIFF_TIMEOUT', '0.5'))  # Seconds one diff may take before it's made coarser
+MQL_DIFF_CACHE_SIZE = int(os.environ.get('MQL_DIFF_CACHE_SIZE', '128'))  # Number of diffs
+MQL_LINE_DIFF_CHARS = 2000  # Longer sources are diffed line by line before refining changed lines
+MQL_REFINE_MAX_CHARS = 10000  # Longer blocks of changed lines are shown whole
+MQL_INLINE_DIFF_CHARS = int(os.environ.get('MQL_INLINE_DIFF_CHARS', '20000'))  # Longer sources are diffed when the page asks for it
+
+# Near-duplicate clustering settings
+CLUSTER_LSH_BANDS = 6  # MinHash signatures are split into this many bands
+CLUSTER_LSH_ROWS = 5  # Messages whose signatures agree on every row of a band are clustered, from about 70% similarity
+CLUSTERS_PAGE_SIZE = 20
+
+# Metrics settings
+METRICS_ENABLED = os.environ.get('HUNT_METRICS', 'True').lower() in ('true', '1', 't')
+METRICS_TOKEN = os.environ.get('HUNT_METRICS_TOKEN')  # If set, /metrics requires it as a bearer token
+SERVER_TIMING = os.environ.get('HUNT_SERVER_TIMING', 'True').lower() in ('true', '1', 't')
+
+# SQLite builds before 3.32 allow at most 999 bound variables per statement
+SQLITE_MAX_VARIABLES = 900
+
+def chunked(items, size):
+    """Split a list into chunks of at most size items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class LogSampler:
+    """Logs the first few lines of each template within one operation, and counts the rest.
+    
+    Use one sampler for a loop that would log a line per message, then call summarize()
+    to log how many lines were left out.
+    """
+    
+    def __init__(self, log, limit=None):
+        self.log = log
+        self.limit = LOG_SAMPLE_SIZE if limit is None else limit
+        self.counts = {}
+    
+    def sample(self, level, msg, *args):
+        level_count = self.counts.setdefault(msg, [level, 0])
+        level_count[1] += 1
+        if level_count[1] <= self.limit:
+            self.log.log(level, msg, *args)
+    
+    def debug(self, msg, *args):
+        self.sample(logging.DEBUG, msg, *args)
+    
+    def info(self, msg, *args):
+        self.sample(logging.INFO, msg, *args)
+    
+    def summarize(self):
+        for msg, (level, count) in self.counts.items():
+            if count > self.limit:
+                self.log.log(level, "%s more lines like %r were not logged", count - self.limit, msg)
+
+# Per-user locks serializing this process's writes to each user's store
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+def get_user_lock(username):
+    """Get the lock serializing writes to a user's store within this process"""
+    with _user_locks_lock:
+        if username not in _user_locks:
+            _user_locks[username] = threading.RLock()
+        return _user_locks[username]
+
+def get_user_dir(username='default'):
+    """Get the data directory for a specific user, creating it if needed"""
+    user_dir = os.path.join(DATA_DIR, username)
+    os.makedirs(user_dir, exist_ok=True)
+    return user_dir
+
+# Instrumentation. The phases of handling a request or running a job are timed into
+# the histograms below, which /metrics serves, and summed per request into its
+# Server-Timing header. Under gunicorn each worker writes its metrics to files in
+# PROMETHEUS_MULTIPROC_DIR so /metrics reports on all of them.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUEST_SECONDS = Histogram('hunt_analyzer_request_duration_seconds', 'Time to handle a request',
+                            ['endpoint', 'method', 'status'], buckets=DURATION_BUCKETS)
+JOB_SECONDS = Histogram('hunt_analyzer_job_duration_seconds', 'Time to run a background job',
+                        ['kind', 'status'], buckets=DURATION_BUCKETS)
+PHASE_SECONDS = Histogram('hunt_analyzer_phase_duration_seconds', 'Time spent in one phase of a request or job',
+                          ['phase'], buckets=DURATION_BUCKETS)
+API_REQUESTS = Counter('hunt_analyzer_api_requests_total', 'HTTP requests sent to the Sublime API, including retries',
+                       ['endpoint', 'status'])
+API_PAGES = Counter('hunt_analyzer_api_pages_total', 'Pages of hunt results fetched from the Sublime API')
+STORAGE_BYTES = Counter('hunt_analyzer_storage_bytes_total', 'Bytes read and written by storage operations',
+                        ['direction'])
+
+# Phases that read and write the data directory, which also count the bytes they move
+STORAGE_PHASES = ('storage_read', 'storage_write')
+# Per-thread counts of the bytes a thread has read and written, on Linux
+THREAD_IO_PATH = '/proc/thread-self/io' if os.path.exists('/proc/thread-self/io') else None
+
+# The timings of the request or job the current thread is working for, and the phases it's in
+_timing = threading.local()
+
+class PhaseTimings:
+    """Time spent in each phase of one request or job, summed over the threads working for it."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.api_pages = 0
+        self.storage_bytes = {'read': 0, 'write': 0}
+    
+    def add(self, phase, seconds):
+        with self.lock:
+            total, count = self.phases.get(phase, (0.0, 0))
+            self.phases[phase] = (total + seconds, count + 1)
+    
+    def add_storage_bytes(self, read, written):
+        with self.lock:
+            self.storage_bytes['read'] += read
+            self.storage_bytes['write'] += written
+    
+    def add_api_page(self):
+        with self.lock:
+            self.api_pages += 1
+    
+    def describe(self, phase, count):
+        if phase == 'api':
+            return f"{count} requests, {self.api_pages} pages"
+        if phase == 'storage_read' and self.storage_bytes['read']:
+            return f"{self.storage_bytes['read']} bytes read"
+        if phase == 'storage_write' and self.storage_bytes['write']:
+            return f"{self.storage_bytes['write']} bytes written"
+        return f"{count} call{'s' if count != 1 else ''}"
+    
+    def server_timing(self, total):
+        """Format the phases and the total time as a Server-Timing header."""
+        with self.lock:
+            metrics = [f'{phase};dur={seconds * 1000:.1f};desc="{self.describe(phase, count)}"'
+                       for phase, (seconds, count) in self.phases.items()]
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+    
+    def summary(self):
+        """Describe the time spent in each phase for the log."""
+        with self.lock:
+            return ', '.join(f"{phase} {seconds:.2f}s ({self.describe(phase, count)})"
+                             for phase, (seconds, count) in self.phases.items()) or 'no timed phases'
+
+def get_timings():
+    return getattr(_timing, 'timings', None)
+
+@contextmanager
+def recording_timings(timings):
+    """Count the phases the current thread runs towards the given timings."""
+    previous = get_timings()
+    _timing.timings = timings
+    try:
+        yield timings
+    finally:
+        _timing.timings = previous
+
+def bind_timings(func):
+    """Wrap func so the phases it runs on another thread count towards the caller's request or job."""
+    timings = get_timings()
+    if timings is None:
+        return func
+    
+    @wraps(func)
+    def bound(*args, **kwargs):
+        with recording_timings(timings):
+            return func(*args, **kwargs)
+    return bound
+
+def read_thread_io():
+    """Get the bytes the current thread has read and written so far, and the size of the report itself."""
+    with open(THREAD_IO_PATH, 'rb') as f:
+        report = f.read()
+    counts = dict(line.split(b': ') for line in report.splitlines())
+    return int(counts[b'rchar']), int(counts[b'wchar']), len(report)
+
+def record_storage_bytes(read, written):
+    STORAGE_BYTES.labels('read').inc(read)
+    STORAGE_BYTES.labels('write').inc(written)
+    timings = get_timings()
+    if timings is not None:
+        timings.add_storage_bytes(read, written)
+
+def record_phase(phase, seconds):
+    PHASE_SECONDS.labels(phase).observe(seconds)
+    timings = get_timings()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+@contextmanager
+def timed(phase):
+    """Time a block, or a function when used as a decorator, as a phase of the current request or job.
+    
+    A block nested in another of the same phase is counted as part of the outer one.
+    The storage phases share one count, so reads within a write transaction aren't
+    counted twice.
+    """
+    key = 'storage' if phase in STORAGE_PHASES else phase
+    active = _timing.__dict__.setdefault('active', set())
+    if key in active:
+        yield
+        return
+    
+    active.add(key)
+    io_before = read_thread_io() if key == 'storage' and THREAD_IO_PATH else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+        active.discard(key)
+        if io_before is not None:
+            io_after = read_thread_io()
+            # The first report was read after it was taken, so it's counted in the second
+            read = max(0, io_after[0] - io_before[0] - io_before[2])
+            record_storage_bytes(read, io_after[1] - io_before[1])
+
+def get_metrics_registry():
+    """Get the registry to serve, collecting the metrics of every worker process under gunicorn."""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+class MessageRecord:
+    """Compact, normalized form of a message group from a hunt's results.
+    
+    Message groups come in v0 or v1 format with many nested fields we never show, so
+    each one is converted once, when the hunt's results are fetched, and only the
+    record is kept. Repeated strings such as rule names and verdicts are interned so
+    hunts held in memory at the same time share them.
+    """
+    
+    __slots__ = ('id', 'subject', 'sender', 'sender_domain', 'recipients', 'recipients_count',
+                 'date', 'verdict', 'rule_names', 'rules_count', 'cluster_id')
+    
+    def __init__(self, id, subject, sender=None, sender_domain=None, recipients=(), recipients_count=0,
+                 date=None, verdict='unknown', rule_names=(), rules_count=0, cluster_id=None):
+        self.id = id
+        self.subject = subject
+        self.sender = sender
+        self.sender_domain = sys.intern(sender_domain) if sender_domain else None
+        self.recipients = tuple(recipients)
+        self.recipients_count = recipients_count
+        self.date = date
+        self.verdict = sys.intern(verdict or 'unknown')
+        self.rule_names = tuple(sys.intern(rule_name) for rule_name in rule_names)
+        self.rules_count = rules_count
+        self.cluster_id = cluster_id
+    
+    @classmethod
+    def from_message_group(cls, message_group):
+        """Build a record from a v0 or v1 message group."""
+        sender = None
+        sender_email = None
+        recipients = []
+        recipients_count = 0
+        date = None
+        
+        # First try v1 API format
+        if message_group.get('sender_email_addresses') and len(message_group['sender_email_addresses']) > 0:
+            sender_email = message_group['sender_email_addresses'][0]
+            sender_name = "Unknown"
+            
+            # Try to get sender display name from v1 API format
+            if message_group.get('sender_display_name__info') and len(message_group['sender_display_name__info']) > 0:
+                # Get the first display name from the info object
+                sender_name = list(message_group['sender_display_name__info'].keys())[0]
+            # Or try from previews
+            elif message_group.get('previews') and len(message_group['previews']) > 0:
+                sender_name = message_group['previews'][0].get('sender_display_name', 'Unknown')
+            
+            sender = f"{sender_name} <{sender_email}>"
+            
+            # Get recipients from v1 format
+            if message_group.get('recipients'):
+                recipients = message_group['recipients'][:3]
+                recipients_count = len(message_group['recipients'])
+            
+            # Get date from v1 format
+            date = message_group.get('first_created_at')
+        
+        # Fallback to v0 API format
+        elif message_group.get('messages') and len(message_group['messages']) > 0:
+            message = message_group['messages'][0]
+            sender_name = message.get('sender', {}).get('display_name', 'Unknown')
+            sender_email = message.get('sender', {}).get('email', 'unknown@example.com')
+            sender = f"{sender_name} <{sender_email}>"
+            
+            all_recipients = [r.get('email', 'unknown@example.com') for r in message.get('recipients', [])]
+            recipients = all_recipients[:3]
+            recipients_count = len(all_recipients)
+            
+            date = message.get('created_at', 'Unknown')
+        
+        # Handle flagged rules differently based on API version
+        flagged_rules = message_group.get('flagged_rules', [])
+        if flagged_rules and isinstance(flagged_rules[0], dict) and 'rule_meta' in flagged_rules[0]:
+            # v1 API format
+            rule_names = [rule.get('rule_meta', {}).get('name', 'Unknown Rule') for rule in flagged_rules]
+        else:
+            # v0 API format
+            rule_names = [rule.get('name', 'Unknown Rule') for rule in flagged_rules]
+        
+        return cls(
+            message_group['id'],
+            HuntAnalyzer.get_subject_from_message_group(message_group),
+            sender=sender,
+            sender_domain=sender_email.rsplit('@', 1)[1].lower() if sender_email and '@' in sender_email else None,
+            recipients=recipients,
+            recipients_count=recipients_count,
+            date=date,
+            verdict=message_group.get('attack_score_verdict'),
+            rule_names=rule_names,
+            rules_count=len(flagged_rules)
+        )
+    
+    @classmethod
+    def from_row(cls, row):
+        """Build a record from a hunt_records row."""
+        return cls(row['msg_id'], row['subject'], sender=row['sender'], sender_domain=row['sender_domain'],
+                   recipients=json.loads(row['recipients']), recipients_count=row['recipients_count'],
+                   date=row['date'], verdict=row['verdict'], rule_names=json.loads(row['rule_names']),
+                   rules_count=row['rules_count'], cluster_id=row['cluster_id'])
+    
+    def to_row(self, hunt_id, position):
+        """Get the values of the record's hunt_records row."""
+        return (hunt_id, position, self.id, self.subject, self.sender, self.sender_domain,
+                json.dumps(self.recipients), self.recipients_count, self.date, self.verdict,
+                json.dumps(self.rule_names), self.rules_count, self.cluster_id)
+    
+    def to_dict(self):
+        """Get the record in the format of the analyze view's messages."""
+        return {
+            'id': self.id,
+            'subject': self.subject,
+            'sender': self.sender,
+            'sender_domain': self.sender_domain,
+            'recipients': list(self.recipients),
+            'recipients_count': self.recipients_count,
+            'date': self.date,
+            'message_link': f"https://platform.sublime.security/messages/{self.id}",
+            'attack_score_verdict': self.verdict,
+            'rules': list(self.rule_names[:5]),
+            'rules_count': self.rules_count,
+            'cluster_id': self.cluster_id
+        }
+    
+    @property
+    def sender_name(self):
+        """The sender's display name, without the address."""
+        return self.sender.rsplit(' <', 1)[0] if self.sender else ''
+
+# Near-duplicate clustering. Big hunts are dominated by campaigns of near-identical
+# messages, so each hunt's messages are grouped by sender domain and by the MinHash
+# similarity of their subject and sender name, and clusters are labeled as a whole.
+MINHASH_PRIME = (1 << 61) - 1
+
+def make_minhash_permutations(count, seed=0):
+    """Make the (a, b) coefficients of the hash functions a * x + b mod MINHASH_PRIME, the same in every process."""
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME)) for _ in range(count)]
+
+MINHASH_PERMUTATIONS = make_minhash_permutations(CLUSTER_LSH_BANDS * CLUSTER_LSH_ROWS)
+
+def get_message_features(record):
+    """Get the words and word pairs of a record's subject and the words of its sender name.
+    
+    Text is lowercased, punctuation is dropped and numbers are collapsed, so messages
+    of a campaign that only differ in invoice numbers, dates or counters share their
+    features.
+    """
+    subject_words = re.findall(r'\w+', re.sub(r'\d+', '0', (record.subject or '').lower()))
+    name_words = re.findall(r'\w+', re.sub(r'\d+', '0', record.sender_name.lower()))
+    features = set(subject_words)
+    features.update(f'{first} {second}' for first, second in zip(subject_words, subject_words[1:]))
+    features.update(f'from:{word}' for word in name_words)
+    return frozenset(features)
+
+def get_minhash_signature(features, feature_hashes):
+    """Get the MinHash signature of a set of features.
+    
+    The hashes of each feature under every permutation are cached in feature_hashes,
+    since features repeat across a hunt's messages, and the signature is their
+    element-wise minimum.
+    """
+    hashes = []
+    for feature in features or ('',):
+        permuted = feature_hashes.get(feature)
+        if permuted is None:
+            value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+            permuted = feature_hashes[feature] = [(a * value + b) % MINHASH_PRIME for a, b in MINHASH_PERMUTATIONS]
+        hashes.append(permuted)
+    return list(map(min, *hashes)) if len(hashes) > 1 else hashes[0]
+
+@timed('cluster')
+def cluster_records(records):
+    """Assign every record of a hunt the ID of its cluster of near-duplicate messages.
+    
+    Records with the same sender domain and identical features share a signature,
+    which is computed once. Signatures are then bucketed band by band, and records
+    sharing a bucket are joined with a union-find, so the work stays linear in the
+    number of records. Clusters are numbered from 0 by decreasing size, then by the
+    position of their first record. Returns the number of clusters.
+    """
+    # Group records by their sender domain and features
+    keys = {}
+    key_indexes = []
+    for record in records:
+        key = (record.sender_domain or '', get_message_features(record))
+        key_indexes.append(keys.setdefault(key, len(keys)))
+    
+    feature_hashes = {}
+    signatures = [(domain, get_minhash_signature(features, feature_hashes)) for domain, features in keys]
+    
+    parents = list(range(len(signatures)))
+    
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+    
+    for band in range(CLUSTER_LSH_BANDS):
+        start = band * CLUSTER_LSH_ROWS
+        buckets = {}
+        for index, (domain, signature) in enumerate(signatures):
+            other = buckets.setdefault((domain, *signature[start:start + CLUSTER_LSH_ROWS]), index)
+            if other != index:
+                parents[find(index)] = find(other)
+    
+    # Number the clusters by size, then by first appearance
+    sizes = {}
+    roots = [find(key_index) for key_index in key_indexes]
+    for root in roots:
+        sizes[root] = sizes.get(root, 0) + 1
+    cluster_ids = {root: cluster_id for cluster_id, root in enumerate(sorted(sizes, key=lambda root: -sizes[root]))}
+    for record, root in zip(records, roots):
+        record.cluster_id = cluster_ids[root]
+    
+    return len(cluster_ids)
 
-# Create data directory if it doesn't exist
-DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+class LabelStore:
+    """SQLite-backed store of a user's hunts, labels and hunt membership.
+    
+    Labels are stored one row per message so categorizing a message is a single-row
+    upsert rather than a rewrite of the user's whole labeling history.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS hunts (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS labels (
+            msg_id TEXT PRIMARY KEY,
+            category TEXT NOT NULL CHECK (category IN ('true_positive', 'false_positive')),
+            hunt_id TEXT NOT NULL,
+            subject TEXT,
+            labeled_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_labels_hunt_id ON labels (hunt_id, category);
+        CREATE TABLE IF NOT EXISTS hunt_members (
+            hunt_id TEXT NOT NULL,
+            msg_id TEXT NOT NULL,
+            PRIMARY KEY (hunt_id, msg_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_hunt_members_msg_id ON hunt_members (msg_id);
+        CREATE TABLE IF NOT EXISTS hunt_records (
+            hunt_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            msg_id TEXT NOT NULL,
+            subject TEXT,
+            sender TEXT,
+            sender_domain TEXT,
+            recipients TEXT NOT NULL,
+            recipients_count INTEGER NOT NULL,
+            date TEXT,
+            verdict TEXT NOT NULL,
+            rule_names TEXT NOT NULL,
+            rules_count INTEGER NOT NULL,
+            cluster_id INTEGER,
+            PRIMARY KEY (hunt_id, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS hunt_stats (
+            hunt_id TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            tp INTEGER NOT NULL DEFAULT 0,
+            fp INTEGER NOT NULL DEFAULT 0,
+            pre_labeled INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            hunt_id TEXT,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'completed', 'failed')),
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            notified INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, notified);
+        CREATE TABLE IF NOT EXISTS generations (
+            scope TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS dirty_hunts (
+            hunt_id TEXT PRIMARY KEY
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS rules (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS hunt_rule_members (
+            hunt_id TEXT NOT NULL,
+            rule_id INTEGER NOT NULL,
+            msg_id TEXT NOT NULL,
+            PRIMARY KEY (hunt_id, rule_id, msg_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_hunt_rule_members_msg_id ON hunt_rule_members (msg_id);
+        CREATE INDEX IF NOT EXISTS idx_hunt_rule_members_rule_id ON hunt_rule_members (rule_id, msg_id);
+        CREATE TABLE IF NOT EXISTS rule_stats (
+            hunt_id TEXT NOT NULL,
+            rule_id INTEGER NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            tp INTEGER NOT NULL DEFAULT 0,
+            fp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hunt_id, rule_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_rule_stats_rule_id ON rule_stats (rule_id);
+    """
+    
+    # Version of the data in the store, kept in SQLite's user_version
+    #   1: rule index built for hunts stored before it existed
+    #   2: cluster_id column added to hunt_records
+    DATA_VERSION = 2
+    
+    # Recomputes the stats of hunts from their membership and the labels of their messages
+    STATS_QUERY = """
+        SELECT m.hunt_id AS hunt_id,
+               COUNT(*) AS total,
+               COALESCE(SUM(l.category = 'true_positive'), 0) AS tp,
+               COALESCE(SUM(l.category = 'false_positive'), 0) AS fp,
+               COALESCE(SUM(l.hunt_id != m.hunt_id), 0) AS pre_labeled
+        FROM hunt_members m LEFT JOIN labels l ON l.msg_id = m.msg_id
+    """
+    
+    # Recomputes the number of messages each rule flagged in hunts, and how they're labeled
+    RULE_STATS_QUERY = """
+        SELECT r.hunt_id AS hunt_id,
+               r.rule_id AS rule_id,
+               COUNT(*) AS total,
+               COALESCE(SUM(l.category = 'true_positive'), 0) AS tp,
+               COALESCE(SUM(l.category = 'false_positive'), 0) AS fp
+        FROM hunt_rule_members r LEFT JOIN labels l ON l.msg_id = r.msg_id
+    """
+    
+    def __init__(self, username='default'):
+        self.username = username
+        self.db_path = os.path.join(get_user_dir(username), 'hunt_data.db')
+        self.transaction_depth = 0
+        with timed('storage_read'):
+            # Transactions are started explicitly by transaction()
+            self.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self.conn.row_factory = sqlite3.Row
+            # In WAL mode a commit appends to the write-ahead log, which is synced and later
+            # checkpointed into the database, so a crash mid-write can't corrupt the data
+            # and readers don't block the writer
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.conn.executescript(self.SCHEMA)
+            self.migrate_json()
+            self.migrate_data()
+    
+    def close(self):
+        self.conn.close()
+    
+    @contextmanager
+    def transaction(self):
+        """Run a block in a write transaction, rolling it back if the block raises.
+        
+        BEGIN IMMEDIATE takes the database's write lock before anything is read, so
+        read-modify-write cycles of other threads and worker processes wait for this one
+        instead of interleaving with it. Writers in this process also queue on a per-user
+        lock rather than polling SQLite's busy handler. Nested blocks join the outer
+        transaction.
+        """
+        if self.transaction_depth:
+            self.transaction_depth += 1
+            try:
+                yield
+            finally:
+                self.transaction_depth -= 1
+            return
+        
+        with get_user_lock(self.username), timed('storage_write'):
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.transaction_depth = 1
+            try:
+                yield
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            finally:
+                self.transaction_depth = 0
+    
+    def checkpoint(self):
+        """Copy the write-ahead log into the database and truncate it."""
+        try:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            # Readers can keep the log from being truncated, the next checkpoint catches up
+            storage_logger.warning("Checkpoint of %s failed: %s", self.db_path, e)
+    
+    # Generations
+    
+    def get_generations(self, scopes):
+        """Get the change counters of the given scopes, as a tuple in the same order.
+        
+        Data cached in memory records the generations it was read at, and is still
+        current as long as they haven't changed, whichever process made the change.
+        Scopes are 'labels', 'hunts' for wholesale changes and 'hunt:<id>' for a hunt's
+        membership and records.
+        """
+        values = dict(self.conn.execute(
+            f"SELECT scope, value FROM generations WHERE scope IN ({','.join('?' * len(scopes))})", scopes
+        ).fetchall())
+        return tuple(values.get(scope, 0) for scope in scopes)
+    
+    def bump_generations(self, scopes):
+        """Advance the change counters of the given scopes within the current transaction."""
+        self.conn.executemany(
+            "INSERT INTO generations (scope, value) VALUES (?, 1) ON CONFLICT (scope) DO UPDATE SET value = value + 1",
+            [(scope,) for scope in scopes]
+        )
+    
+    def migrate_json(self):
+        """Import a legacy hunt_data.json file into the store, once."""
+        json_path = os.path.join(get_user_dir(self.username), 'hunt_data.json')
+        if not os.path.exists(json_path):
+            return False
+        
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        
+        storage_logger.info("Migrating %s with %s hunts, %s TPs and %s FPs", json_path, len(data.get('hunts', [])),
+                            len(data.get('true_positives', {})), len(data.get('false_positives', {})))
+        self.save_data(data)
+        
+        # Keep the original file around in case the migration needs to be redone
+        os.replace(json_path, f"{json_path}.migrated")
+        storage_logger.info("Migration of %s complete", json_path)
+        return True
+    
+    def get_data_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+    
+    def migrate_data(self):
+        """Upgrade data stored by older versions to DATA_VERSION, once."""
+        if self.get_data_version() >= self.DATA_VERSION:
+            return
+        
+        with self.transaction():
+            # Another process may have migrated the store while we waited for the lock
+            version = self.get_data_version()
+            if version >= self.DATA_VERSION:
+                return
+            
+            if version < 1:
+                hunt_ids = [row[0] for row in self.conn.execute("SELECT DISTINCT hunt_id FROM hunt_records")]
+                for hunt_id in hunt_ids:
+                    rows = self.conn.execute("SELECT msg_id, rule_names FROM hunt_records WHERE hunt_id = ?", (hunt_id,))
+                    self.write_rule_index(hunt_id, [(msg_id, json.loads(rule_names)) for msg_id, rule_names in rows])
+                if hunt_ids:
+                    storage_logger.info("Built the rule index of %s hunts for user %s", len(hunt_ids), self.username)
+            
+            if version < 2:
+                # Records stored before clustering are clustered the first time they're loaded
+                columns = [row['name'] for row in self.conn.execute("PRAGMA table_info(hunt_records)")]
+                if 'cluster_id' not in columns:
+                    self.conn.execute("ALTER TABLE hunt_records ADD COLUMN cluster_id INTEGER")
+            
+            self.conn.execute(f"PRAGMA user_version = {self.DATA_VERSION}")
+    
+    # Hunts
+    
+    @timed('storage_read')
+    def get_hunts(self):
+        """Get all hunts in the order they were added, with their current stats."""
+        rows = self.conn.execute(
+            "SELECT h.data, s.total, s.tp, s.fp, s.pre_labeled FROM hunts h "
+            "LEFT JOIN hunt_stats s ON s.hunt_id = h.id ORDER BY h.position"
+        ).fetchall()
+        return [self.apply_stats(json.loads(row['data']), row) for row in rows]
+    
+    @timed('storage_read')
+    def get_hunt(self, hunt_id):
+        row = self.conn.execute(
+            "SELECT h.data, s.total, s.tp, s.fp, s.pre_labeled FROM hunts h "
+            "LEFT JOIN hunt_stats s ON s.hunt_id = h.id WHERE h.id = ?", (hunt_id,)
+        ).fetchone()
+        return self.apply_stats(json.loads(row['data']), row) if row else None
+    
+    @staticmethod
+    def apply_stats(hunt, stats):
+        """Fill in the hunt's count fields from its maintained stats, if it has any."""
+        if stats is None or stats['total'] is None:
+            return hunt
+        
+        hunt['total_samples'] = stats['total']
+        hunt['true_positives_count'] = stats['tp']
+        hunt['false_positives_count'] = stats['fp']
+        hunt['pre_labeled_count'] = stats['pre_labeled']
+        hunt['unlabeled_count'] = stats['total'] - stats['tp'] - stats['fp']
+        hunt['total_new_samples'] = stats['total'] - stats['pre_labeled']
+        hunt['labeled_new_samples'] = stats['tp'] + stats['fp'] - stats['pre_labeled']
+        return hunt
+    
+    def add_hunt(self, hunt):
+        with self.transaction():
+            self.conn.execute(
+                "INSERT INTO hunts (id, position, name, data) "
+                "VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM hunts), ?, ?)",
+                (hunt['id'], hunt.get('name', ''), json.dumps(hunt))
+            )
+    
+    def set_hunt_order(self, hunt_ids):
+        """Reorder the given hunts among the positions they already take up, in the order given."""
+        with self.transaction():
+            rows = []
+            for chunk in chunked(hunt_ids, SQLITE_MAX_VARIABLES):
+                rows.extend(self.conn.execute(
+                    f"SELECT id, position FROM hunts WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                ))
+            existing = {row['id'] for row in rows}
+            positions = sorted(row['position'] for row in rows)
+            self.conn.executemany(
+                "UPDATE hunts SET position = ? WHERE id = ?",
+                zip(positions, [hunt_id for hunt_id in hunt_ids if hunt_id in existing])
+            )
+    
+    def update_hunt(self, hunt_id, fields):
+        """Update some fields of a stored hunt."""
+        with self.transaction():
+            row = self.conn.execute("SELECT data FROM hunts WHERE id = ?", (hunt_id,)).fetchone()
+            if not row:
+                return None
+            hunt = json.loads(row['data'])
+            hunt.update(fields)
+            self.conn.execute("UPDATE hunts SET name = ?, data = ? WHERE id = ?",
+                              (hunt.get('name', ''), json.dumps(hunt), hunt_id))
+            return hunt
+    
+    def delete_hunt(self, hunt_id):
+        """Delete a hunt, keeping labels made in it for messages that appear in other hunts.
+        
+        Labels made in the deleted hunt are reassigned to the first remaining hunt that
+        contains the message, or removed if no remaining hunt contains it. Returns the
+        number of (reassigned, removed) labels.
+        """
+        reassigned = 0
+        removed = 0
+        
+        with self.transaction():
+            self.bump_generations(['labels', f'hunt:{hunt_id}'])
+            # Labels that still reference the hunt are found through its dirty flag
+            self.mark_dirty([hunt_id])
+            self.conn.execute("DELETE FROM hunts WHERE id = ?", (hunt_id,))
+            self.conn.execute("DELETE FROM hunt_members WHERE hunt_id = ?", (hunt_id,))
+            self.conn.execute("DELETE FROM hunt_records WHERE hunt_id = ?", (hunt_id,))
+            self.conn.execute("DELETE FROM hunt_stats WHERE hunt_id = ?", (hunt_id,))
+            self.delete_rule_index(hunt_id)
+            
+            labels = self.conn.execute("SELECT msg_id, category FROM labels WHERE hunt_id = ?", (hunt_id,)).fetchall()
+            message_hunts = self.get_message_hunts([row['msg_id'] for row in labels])
+            
+            for row in labels:
+                msg_id = row['msg_id']
+                other_hunts_with_msg = message_hunts.get(msg_id)
+                if other_hunts_with_msg:
+                    # Use the first hunt where this message appears
+                    self.conn.execute("UPDATE labels SET hunt_id = ? WHERE msg_id = ?", (other_hunts_with_msg[0], msg_id))
+                    self.apply_label_change(msg_id, (row['category'], hunt_id), (row['category'], other_hunts_with_msg[0]))
+                    reassigned += 1
+                else:
+                    self.conn.execute("DELETE FROM labels WHERE msg_id = ?", (msg_id,))
+                    removed += 1
+        
+        return reassigned, removed
+    
+    def fix_orphaned_labels(self, hunt_ids=None):
+        """Fix labels whose hunt no longer exists, returning (reassigned, removed) counts.
+        
+        Labels are reassigned to the first hunt containing the message, and labels of
+        messages that don't appear in any indexed hunt are removed. When hunt_ids is
+        given, only labels made in those hunts are checked.
+        """
+        reassigned = 0
+        removed = 0
+        orphaned_query = ("SELECT msg_id, category, hunt_id FROM labels WHERE (hunt_id NOT IN (SELECT id FROM hunts) "
+                          "OR msg_id NOT IN (SELECT msg_id FROM hunt_members))")
+        
+        sampled_log = LogSampler(storage_logger)
+        
+        with self.transaction():
+            if hunt_ids is None:
+                labels = self.conn.execute(orphaned_query).fetchall()
+            else:
+                labels = []
+                for chunk in chunked(list(hunt_ids), SQLITE_MAX_VARIABLES):
+                    labels.extend(self.conn.execute(
+                        f"{orphaned_query} AND hunt_id IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall())
+            message_hunts = self.get_message_hunts([row['msg_id'] for row in labels])
+            hunt_ids = {row[0] for row in self.conn.execute("SELECT id FROM hunts")}
+            if labels:
+                self.bump_generations(['labels'])
+            
+            for row in labels:
+                msg_id = row['msg_id']
+                hunts_with_msg = message_hunts.get(msg_id)
+                if not hunts_with_msg:
+                    sampled_log.info("Removing %s message %s as it doesn't exist in any hunt", row['category'], msg_id)
+                    self.conn.execute("DELETE FROM labels WHERE msg_id = ?", (msg_id,))
+                    removed += 1
+                elif row['hunt_id'] not in hunt_ids:
+                    sampled_log.info("%s message %s referenced deleted hunt %s, reassigning to %s",
+                                     row['category'], msg_id, row['hunt_id'], hunts_with_msg[0])
+                    self.conn.execute("UPDATE labels SET hunt_id = ? WHERE msg_id = ?", (hunts_with_msg[0], msg_id))
+                    self.apply_label_change(msg_id, (row['category'], row['hunt_id']), (row['category'], hunts_with_msg[0]))
+                    reassigned += 1
+        
+        sampled_log.summarize()
+        return reassigned, removed
+    
+    # Labels
+    
+    @timed('storage_read')
+    def get_labels(self):
+        """Get all labels as (true_positives, false_positives) dicts keyed by message ID."""
+        true_positives = {}
+        false_positives = {}
+        for row in self.conn.execute("SELECT msg_id, category, hunt_id, subject, labeled_at FROM labels"):
+            label = {'hunt_id': row['hunt_id'], 'subject': row['subject'], 'labeled_at': row['labeled_at']}
+            if row['category'] == 'true_positive':
+                true_positives[row['msg_id']] = label
+            else:
+                false_positives[row['msg_id']] = label
+        return true_positives, false_positives
+    
+    def get_label(self, msg_id):
+        row = self.conn.execute(
+            "SELECT category, hunt_id, subject, labeled_at FROM labels WHERE msg_id = ?", (msg_id,)
+        ).fetchone()
+        return dict(row) if row else None
+    
+    @timed('storage_read')
+    def get_label_states(self):
+        """Get the (category, hunt_id) of every labeled message, keyed by message ID."""
+        return {msg_id: (category, hunt_id) for msg_id, category, hunt_id in
+                self.conn.execute("SELECT msg_id, category, hunt_id FROM labels")}
+    
+    @timed('storage_read')
+    def get_label_map(self, msg_ids):
+        """Get the labels of the given messages, keyed by message ID."""
+        labels = {}
+        for chunk in chunked(list(msg_ids), SQLITE_MAX_VARIABLES):
+            rows = self.conn.execute(
+                f"SELECT msg_id, category, hunt_id, subject, labeled_at FROM labels "
+                f"WHERE msg_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            for row in rows:
+                labels[row['msg_id']] = dict(row)
+        return labels
+    
+    def set_label(self, msg_id, category, hunt_id, subject):
+        """Label a single message, replacing any previous label."""
+        self.set_labels([(msg_id, category, hunt_id, subject)])
+    
+    def set_labels(self, labels):
+        """Label several messages in one transaction from (msg_id, category, hunt_id, subject) tuples.
+        
+        The stats of every hunt containing a relabeled message are adjusted by the change.
+        """
+        labeled_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        changes = {}
+        with self.transaction():
+            generation = self.get_generations(['labels'])
+            self.bump_generations(['labels'])
+            for msg_id, category, hunt_id, subject in labels:
+                previous = self.conn.execute(
+                    "SELECT category, hunt_id FROM labels WHERE msg_id = ?", (msg_id,)
+                ).fetchone()
+                self.conn.execute(
+                    "INSERT INTO labels (msg_id, category, hunt_id, subject, labeled_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (msg_id) DO UPDATE SET category = excluded.category, hunt_id = excluded.hunt_id, "
+                    "subject = excluded.subject, labeled_at = excluded.labeled_at",
+                    (msg_id, category, hunt_id, subject, labeled_at)
+                )
+                self.apply_label_change(msg_id, previous, (category, hunt_id))
+                changes[msg_id] = (category, hunt_id)
+        self.after_label_changes(generation, changes)
+    
+    def delete_labels(self, msg_ids):
+        """Remove the labels of several messages in one transaction."""
+        changes = {}
+        with self.transaction():
+            generation = self.get_generations(['labels'])
+            self.bump_generations(['labels'])
+            for msg_id in msg_ids:
+                previous = self.conn.execute(
+                    "SELECT category, hunt_id FROM labels WHERE msg_id = ?", (msg_id,)
+                ).fetchone()
+                if previous:
+                    self.conn.execute("DELETE FROM labels WHERE msg_id = ?", (msg_id,))
+                    self.apply_label_change(msg_id, previous, None)
+                    changes[msg_id] = None
+        self.after_label_changes(generation, changes)
+    
+    def after_label_changes(self, generation, changes):
+        """Apply committed label changes to this user's cached labels.
+        
+        generation is the labels generation the changes were made on top of. Changes
+        made inside an outer transaction could still be rolled back, so the cached
+        labels are only updated once they're committed.
+        """
+        if self.transaction_depth:
+            forget_cached_labels(self.username)
+        else:
+            update_cached_labels(self.username, generation[0], generation[0] + 1, changes)
+    
+    def apply_label_change(self, msg_id, previous, current):
+        """Adjust the stats of the hunts containing a message after its label changed.
+        
+        previous and current are (category, hunt_id) pairs, or None when the message
+        was or is unlabeled.
+        """
+        previous_category, previous_hunt_id = previous if previous else (None, None)
+        category, hunt_id = current if current else (None, None)
+        
+        if previous_category == category and previous_hunt_id == hunt_id:
+            return
+        
+        self.conn.execute(
+            """
+            UPDATE hunt_stats SET
+                tp = tp + :tp_delta,
+                fp = fp + :fp_delta,
+                pre_labeled = pre_labeled
+                    - (CASE WHEN :previous_hunt_id IS NOT NULL AND hunt_id != :previous_hunt_id THEN 1 ELSE 0 END)
+                    + (CASE WHEN :hunt_id IS NOT NULL AND hunt_id != :hunt_id THEN 1 ELSE 0 END)
+            WHERE hunt_id IN (SELECT hunt_id FROM hunt_members WHERE msg_id = :msg_id)
+            """,
+            {
+                'tp_delta': (category == 'true_positive') - (previous_category == 'true_positive'),
+                'fp_delta': (category == 'false_positive') - (previous_category == 'false_positive'),
+                'previous_hunt_id': previous_hunt_id,
+                'hunt_id': hunt_id,
+                'msg_id': msg_id
+            }
+        )
+        
+        if category != previous_category:
+            self.conn.execute(
+                "UPDATE rule_stats SET tp = tp + :tp_delta, fp = fp + :fp_delta "
+                "WHERE (hunt_id, rule_id) IN (SELECT hunt_id, rule_id FROM hunt_rule_members WHERE msg_id = :msg_id)",
+                {
+                    'tp_delta': (category == 'true_positive') - (previous_category == 'true_positive'),
+                    'fp_delta': (category == 'false_positive') - (previous_category == 'false_positive'),
+                    'msg_id': msg_id
+                }
+            )
+        
+        # Flag the hunts containing the message and the hunts it was labeled in for the next reprocess
+        self.conn.execute("INSERT OR IGNORE INTO dirty_hunts (hunt_id) SELECT hunt_id FROM hunt_members WHERE msg_id = ?", (msg_id,))
+        self.mark_dirty([hunt for hunt in (previous_hunt_id, hunt_id) if hunt is not None])
+    
+    # Hunt membership
+    
+    def set_hunt_members(self, hunt_id, msg_ids):
+        """Record which messages appear in a hunt and recompute its stats.
+        
+        Returns False without writing anything if the hunt was deleted meanwhile.
+        """
+        with self.transaction():
+            if not self.hunt_exists(hunt_id):
+                return False
+            self.write_members(hunt_id, msg_ids)
+            return True
+    
+    def hunt_exists(self, hunt_id):
+        return self.conn.execute("SELECT 1 FROM hunts WHERE id = ?", (hunt_id,)).fetchone() is not None
+    
+    def write_members(self, hunt_id, msg_ids):
+        """Replace the membership of a hunt and recompute its stats, in the caller's transaction."""
+        self.bump_generations([f'hunt:{hunt_id}'])
+        self.mark_dirty([hunt_id])
+        self.conn.execute("DELETE FROM hunt_members WHERE hunt_id = ?", (hunt_id,))
+        self.conn.executemany("INSERT OR IGNORE INTO hunt_members (hunt_id, msg_id) VALUES (?, ?)",
+                              ((hunt_id, msg_id) for msg_id in msg_ids))
+        self.write_stats([hunt_id])
+    
+    def set_hunt_records(self, hunt_id, records):
+        """Store the message records of a hunt, in result order, along with its membership.
+        
+        Returns False without writing anything if the hunt was deleted while its results
+        were being fetched, so a delete can't be undone by a job still indexing the hunt.
+        """
+        with self.transaction():
+            if not self.hunt_exists(hunt_id):
+                return False
+            self.conn.execute("DELETE FROM hunt_records WHERE hunt_id = ?", (hunt_id,))
+            self.conn.executemany(
+                "INSERT INTO hunt_records (hunt_id, position, msg_id, subject, sender, sender_domain, recipients, "
+                "recipients_count, date, verdict, rule_names, rules_count, cluster_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (record.to_row(hunt_id, position) for position, record in enumerate(records))
+            )
+            self.write_members(hunt_id, [record.id for record in records])
+            self.write_rule_index(hunt_id, [(record.id, record.rule_names) for record in records])
+            return True
+    
+    def set_record_clusters(self, hunt_id, records):
+        """Store the cluster IDs of a hunt's records, given in result order as returned by get_hunt_records."""
+        with self.transaction():
+            self.bump_generations([f'hunt:{hunt_id}'])
+            self.conn.executemany(
+                "UPDATE hunt_records SET cluster_id = ? WHERE hunt_id = ? AND position = ?",
+                ((record.cluster_id, hunt_id, position) for position, record in enumerate(records))
+            )
+    
+    @timed('storage_read')
+    def get_hunt_records(self, hunt_id):
+        """Get the message records of a hunt in result order, or None if they haven't been stored."""
+        rows = self.conn.execute(
+            "SELECT * FROM hunt_records WHERE hunt_id = ? ORDER BY position", (hunt_id,)
+        ).fetchall()
+        if rows:
+            return [MessageRecord.from_row(row) for row in rows]
+        
+        # An indexed hunt without members has no results rather than missing records
+        has_members = self.conn.execute("SELECT 1 FROM hunt_members WHERE hunt_id = ? LIMIT 1", (hunt_id,)).fetchone()
+        return [] if self.is_indexed(hunt_id) and not has_members else None
+    
+    @timed('storage_read')
+    def get_record_subjects(self, hunt_id, msg_ids):
+        """Get the subjects of the given messages from a hunt's stored records, keyed by message ID.
+        
+        Messages that aren't in the hunt are left out. Returns None if the hunt has no
+        stored records.
+        """
+        subjects = {}
+        for chunk in chunked(list(msg_ids), SQLITE_MAX_VARIABLES):
+            rows = self.conn.execute(
+                f"SELECT msg_id, subject FROM hunt_records WHERE hunt_id = ? AND msg_id IN ({','.join('?' * len(chunk))})",
+                [hunt_id, *chunk]
+            )
+            subjects.update((msg_id, subject) for msg_id, subject in rows)
+        
+        if not subjects and not self.conn.execute("SELECT 1 FROM hunt_records WHERE hunt_id = ? LIMIT 1", (hunt_id,)).fetchone():
+            return None
+        return subjects
+    
+    def is_indexed(self, hunt_id):
+        """Check whether a hunt's membership has been indexed."""
+        return self.conn.execute("SELECT 1 FROM hunt_stats WHERE hunt_id = ?", (hunt_id,)).fetchone() is not None
+    
+    @timed('storage_read')
+    def get_hunt_members(self, hunt_id):
+        """Get the sorted IDs of the messages in a hunt."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT msg_id FROM hunt_members WHERE hunt_id = ? ORDER BY msg_id", (hunt_id,)
+        )]
+    
+    @timed('storage_read')
+    def get_members_of_hunts(self, hunt_ids):
+        """Get the IDs of the messages in each of the given hunts."""
+        members = {hunt_id: [] for hunt_id in hunt_ids}
+        for chunk in chunked(list(hunt_ids), SQLITE_MAX_VARIABLES):
+            rows = self.conn.execute(
+                f"SELECT hunt_id, msg_id FROM hunt_members WHERE hunt_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            for hunt_id, msg_id in rows:
+                members[hunt_id].append(msg_id)
+        return members
+    
+    @timed('storage_read')
+    def get_message_hunts(self, msg_ids):
+        """Get the IDs of the hunts containing each message, in the order the hunts were added."""
+        message_hunts = {}
+        for chunk in chunked(list(msg_ids), SQLITE_MAX_VARIABLES):
+            rows = self.conn.execute(
+                f"SELECT m.msg_id, m.hunt_id FROM hunt_members m JOIN hunts h ON h.id = m.hunt_id "
+                f"WHERE m.msg_id IN ({','.join('?' * len(chunk))}) ORDER BY h.position", chunk
+            )
+            for msg_id, hunt_id in rows:
+                message_hunts.setdefault(msg_id, []).append(hunt_id)
+        return message_hunts
+    
+    @timed('storage_read')
+    def get_message_hunt_ids(self, msg_ids):
+        """Get the IDs of the hunts containing any of the given messages."""
+        hunt_ids = set()
+        for chunk in chunked(list(msg_ids), SQLITE_MAX_VARIABLES):
+            rows = self.conn.execute(
+                f"SELECT DISTINCT hunt_id FROM hunt_members WHERE msg_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            hunt_ids.update(row[0] for row in rows)
+        return hunt_ids
+    
+    # Hunt stats
+    
+    @timed('stats')
+    def compute_stats(self, hunt_ids=None):
+        """Recompute hunt stats from scratch, keyed by hunt ID."""
+        if hunt_ids is None:
+            rows = self.conn.execute(f"{self.STATS_QUERY} GROUP BY m.hunt_id").fetchall()
+        else:
+            rows = []
+            for chunk in chunked(list(hunt_ids), SQLITE_MAX_VARIABLES):
+                rows.extend(self.conn.execute(
+                    f"{self.STATS_QUERY} WHERE m.hunt_id IN ({','.join('?' * len(chunk))}) GROUP BY m.hunt_id", chunk
+                ).fetchall())
+        return {row['hunt_id']: dict(row) for row in rows}
+    
+    def rebuild_stats(self, hunt_ids=None):
+        """Replace the maintained stats of the given hunts (or all hunts) with recomputed ones."""
+        with self.transaction():
+            if hunt_ids is None:
+                hunt_ids = [row[0] for row in self.conn.execute("SELECT hunt_id FROM hunt_stats UNION SELECT DISTINCT hunt_id FROM hunt_members")]
+            self.write_stats(hunt_ids)
+    
+    def write_stats(self, hunt_ids):
+        """Recompute and store the stats of the given hunts within the current transaction."""
+        hunt_ids = list(hunt_ids)
+        computed = self.compute_stats(hunt_ids)
+        
+        for hunt_id in hunt_ids:
+            # Hunts indexed without any members have all-zero stats
+            stats = computed.get(hunt_id, {'total': 0, 'tp': 0, 'fp': 0, 'pre_labeled': 0})
+            self.conn.execute(
+                "INSERT OR REPLACE INTO hunt_stats (hunt_id, total, tp, fp, pre_labeled) VALUES (?, ?, ?, ?, ?)",
+                (hunt_id, stats['total'], stats['tp'], stats['fp'], stats['pre_labeled'])
+            )
+    
+    def verify_stats(self, repair=False, hunt_ids=None):
+        """Compare the maintained hunt stats against a full recount.
+        
+        Returns a dict of hunt ID to {field: (maintained, actual)} for every hunt whose
+        stats drifted. When repair is True, drifted stats are replaced by the recount.
+        When hunt_ids is given, only the stats of those hunts are recounted.
+        """
+        if hunt_ids is None:
+            computed = self.compute_stats()
+            rows = self.conn.execute("SELECT hunt_id, total, tp, fp, pre_labeled FROM hunt_stats").fetchall()
+        else:
+            hunt_ids = list(hunt_ids)
+            computed = self.compute_stats(hunt_ids)
+            rows = []
+            for chunk in chunked(hunt_ids, SQLITE_MAX_VARIABLES):
+                rows.extend(self.conn.execute(
+                    f"SELECT hunt_id, total, tp, fp, pre_labeled FROM hunt_stats WHERE hunt_id IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall())
+        drift = {}
+        
+        for row in rows:
+            actual = computed.get(row['hunt_id'], {'total': 0, 'tp': 0, 'fp': 0, 'pre_labeled': 0})
+            fields = {field: (row[field], actual[field])
+                      for field in ('total', 'tp', 'fp', 'pre_labeled') if row[field] != actual[field]}
+            if fields:
+                drift[row['hunt_id']] = fields
+        
+        if drift:
+            storage_logger.warning("Hunt stats drifted for %s hunts: %s", len(drift), drift)
+            if repair:
+                self.rebuild_stats(list(drift))
+        
+        return drift
+    
+    # Rule index
+    
+    def get_rule_ids(self, names):
+        """Get the IDs of the given rule names, keyed by name, adding names that are new."""
+        names = list(names)
+        self.conn.executemany("INSERT OR IGNORE INTO rules (name) VALUES (?)", [(name,) for name in names])
+        rule_ids = {}
+        for chunk in chunked(names, SQLITE_MAX_VARIABLES):
+            rule_ids.update(self.conn.execute(
+                f"SELECT name, id FROM rules WHERE name IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall())
+        return rule_ids
+    
+    def write_rule_index(self, hunt_id, message_rules):
+        """Replace the index of which rules flagged a hunt's messages and recount its rule stats, in the caller's transaction.
+        
+        message_rules is a list of (msg_id, rule_names) pairs.
+        """
+        self.bump_generations(['rules'])
+        self.delete_rule_index(hunt_id)
+        rule_ids = self.get_rule_ids({rule_name for _, rule_names in message_rules for rule_name in rule_names})
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO hunt_rule_members (hunt_id, rule_id, msg_id) VALUES (?, ?, ?)",
+            ((hunt_id, rule_ids[rule_name], msg_id) for msg_id, rule_names in message_rules for rule_name in rule_names)
+        )
+        self.write_rule_stats([hunt_id])
+    
+    def delete_rule_index(self, hunt_id):
+        self.bump_generations(['rules'])
+        self.conn.execute("DELETE FROM hunt_rule_members WHERE hunt_id = ?", (hunt_id,))
+        self.conn.execute("DELETE FROM rule_stats WHERE hunt_id = ?", (hunt_id,))
+    
+    @timed('stats')
+    def write_rule_stats(self, hunt_ids):
+        """Recount and store the rule stats of the given hunts within the current transaction."""
+        for chunk in chunked(list(hunt_ids), SQLITE_MAX_VARIABLES):
+            placeholders = ','.join('?' * len(chunk))
+            self.conn.execute(f"DELETE FROM rule_stats WHERE hunt_id IN ({placeholders})", chunk)
+            self.conn.execute(
+                f"INSERT INTO rule_stats (hunt_id, rule_id, total, tp, fp) "
+                f"{self.RULE_STATS_QUERY} WHERE r.hunt_id IN ({placeholders}) GROUP BY r.hunt_id, r.rule_id", chunk
+            )
+    
+    def get_hunts_without_records(self):
+        """Get the IDs of hunts whose message records, and so their rule index, haven't been stored."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT id FROM hunts h WHERE NOT EXISTS (SELECT 1 FROM hunt_records r WHERE r.hunt_id = h.id) ORDER BY position"
+        )]
+    
+    @timed('storage_read')
+    def get_rule_stats(self, hunt_id=None):
+        """Get the number of messages each rule flagged and how many of them are labeled TP and FP.
+        
+        The counts are of one hunt's messages, read from the maintained rule stats, or
+        of the distinct messages of all hunts when hunt_id is None. Also returns the
+        number of hunts each rule flagged messages in. Rules are ordered by the number
+        of messages they flagged. Rows of hunts that no longer exist are ignored.
+        """
+        if hunt_id is not None:
+            rows = self.conn.execute(
+                "SELECT ru.name AS name, s.total AS total, s.tp AS tp, s.fp AS fp, 1 AS hunts "
+                "FROM rule_stats s JOIN rules ru ON ru.id = s.rule_id JOIN hunts h ON h.id = s.hunt_id "
+                "WHERE s.hunt_id = ? ORDER BY s.total DESC, ru.name",
+                (hunt_id,)
+            ).fetchall()
+        else:
+            rows = self.conn.execute(
+                """
+                SELECT ru.name AS name,
+                       COUNT(*) AS total,
+                       COALESCE(SUM(l.category = 'true_positive'), 0) AS tp,
+                       COALESCE(SUM(l.category = 'false_positive'), 0) AS fp,
+                       (SELECT COUNT(*) FROM rule_stats s JOIN hunts h ON h.id = s.hunt_id WHERE s.rule_id = m.rule_id) AS hunts
+                FROM (SELECT DISTINCT r.rule_id, r.msg_id FROM hunt_rule_members r JOIN hunts h ON h.id = r.hunt_id) m
+                JOIN rules ru ON ru.id = m.rule_id
+                LEFT JOIN labels l ON l.msg_id = m.msg_id
+                GROUP BY m.rule_id
+                ORDER BY total DESC, ru.name
+                """
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    @timed('storage_read')
+    def get_rule_cooccurrence(self, rule_name, hunt_id=None):
+        """Get the other rules that flagged the messages a rule flagged, in one hunt or across all hunts.
+        
+        Returns, for every other rule, the number of messages both rules flagged and how
+        many of those are labeled TP and FP, ordered by the number of shared messages.
+        """
+        hunt_filter = "AND m.hunt_id = :hunt_id AND o.hunt_id = m.hunt_id" if hunt_id is not None else ""
+        rows = self.conn.execute(
+            f"""
+            SELECT ru.name AS name,
+                   COUNT(*) AS total,
+                   COALESCE(SUM(l.category = 'true_positive'), 0) AS tp,
+                   COALESCE(SUM(l.category = 'false_positive'), 0) AS fp
+            FROM (
+                SELECT DISTINCT o.rule_id AS rule_id, o.msg_id AS msg_id
+                FROM hunt_rule_members m
+                JOIN hunt_rule_members o ON o.msg_id = m.msg_id AND o.rule_id != m.rule_id
+                JOIN hunts hm ON hm.id = m.hunt_id
+                JOIN hunts ho ON ho.id = o.hunt_id
+                WHERE m.rule_id = (SELECT id FROM rules WHERE name = :rule_name) {hunt_filter}
+            ) p
+            JOIN rules ru ON ru.id = p.rule_id
+            LEFT JOIN labels l ON l.msg_id = p.msg_id
+            GROUP BY p.rule_id
+            ORDER BY total DESC, ru.name
+            """,
+            {'rule_name': rule_name, 'hunt_id': hunt_id}
+        ).fetchall()
+        return [dict(row) for row in rows]
+    
+    # Dirty hunts
+    
+    def mark_dirty(self, hunt_ids):
+        """Flag hunts whose stats or labels need checking by the next reprocess, in the caller's transaction."""
+        self.conn.executemany("INSERT OR IGNORE INTO dirty_hunts (hunt_id) VALUES (?)", [(hunt_id,) for hunt_id in hunt_ids])
+    
+    def get_dirty_hunts(self):
+        return [row[0] for row in self.conn.execute("SELECT hunt_id FROM dirty_hunts")]
+    
+    def reconcile(self, full=False):
+        """Fix orphaned labels and repair the stats of hunts that changed since the last reconcile.
+        
+        Hunts are flagged dirty when their membership is replaced, when they're deleted and
+        when a message in them is relabeled, so only those hunts are checked and the work
+        is proportional to what changed. When full is True, every label and every hunt's
+        stats are checked instead. Returns (reassigned, removed, drift).
+        """
+        with self.transaction():
+            hunt_ids = None if full else self.get_dirty_hunts()
+            if hunt_ids == []:
+                return 0, 0, {}
+            
+            reassigned, removed = self.fix_orphaned_labels(hunt_ids)
+            drift = self.verify_stats(repair=True, hunt_ids=hunt_ids)
+            self.write_rule_stats(hunt_ids if hunt_ids is not None else
+                                  [row[0] for row in self.conn.execute("SELECT DISTINCT hunt_id FROM hunt_rule_members")])
+            
+            if full:
+                self.conn.execute("DELETE FROM dirty_hunts")
+            else:
+                # Hunts flagged by reassignments above that weren't checked stay flagged
+                for chunk in chunked(hunt_ids, SQLITE_MAX_VARIABLES):
+                    self.conn.execute(f"DELETE FROM dirty_hunts WHERE hunt_id IN ({','.join('?' * len(chunk))})", chunk)
+        
+        return reassigned, removed, drift
+    
+    # Background jobs
+    
+    def create_job(self, kind, hunt_id=None, message=None):
+        """Record a new queued job and return its ID."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction():
+            # Forget finished jobs nobody has looked at in a long time
+            self.conn.execute(
+                "DELETE FROM jobs WHERE status IN ('completed', 'failed') AND updated_at < ?",
+                (now - JOB_RETENTION_SECONDS,)
+            )
+            self.conn.execute(
+                "INSERT INTO jobs (id, kind, hunt_id, message, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, hunt_id, message, now, now)
+            )
+        return job_id
+    
+    def update_job(self, job_id, **fields):
+        """Update the status, progress or message of a job."""
+        fields['updated_at'] = time.time()
+        with self.transaction():
+            self.conn.execute(
+                f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                [*fields.values(), job_id]
+            )
+    
+    def expire_jobs(self):
+        """Mark unfinished jobs that stopped reporting progress as failed.
+        
+        Jobs run in worker threads of the server process, so they are lost when the
+        server restarts and would otherwise stay queued or running forever.
+        """
+        stale_before = time.time() - JOB_STALE_SECONDS
+        # Checked first so viewing jobs doesn't take the write lock
+        if not self.conn.execute(
+            "SELECT 1 FROM jobs WHERE status IN ('queued', 'running') AND updated_at < ? LIMIT 1", (stale_before,)
+        ).fetchone():
+            return
+        
+        with self.transaction():
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed', message = 'Job was interrupted' "
+                "WHERE status IN ('queued', 'running') AND updated_at < ?",
+                (stale_before,)
+            )
+    
+    def get_job(self, job_id):
+        row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def get_active_jobs(self, kind=None, hunt_id=None):
+        """Get queued and running jobs, oldest first, optionally of one kind and hunt."""
+        self.expire_jobs()
+        query = "SELECT * FROM jobs WHERE status IN ('queued', 'running')"
+        params = []
+        if kind:
+            query += " AND kind = ?"
+            params.append(kind)
+        if hunt_id:
+            query += " AND hunt_id = ?"
+            params.append(hunt_id)
+        return [dict(row) for row in self.conn.execute(query + " ORDER BY created_at", params)]
+    
+    def pop_finished_jobs(self):
+        """Get finished jobs the user hasn't been told about yet, marking them as notified."""
+        with self.transaction():
+            jobs = [dict(row) for row in self.conn.execute(
+                "SELECT * FROM jobs WHERE status IN ('completed', 'failed') AND notified = 0 ORDER BY updated_at"
+            )]
+            self.conn.executemany("UPDATE jobs SET notified = 1 WHERE id = ?", [(job['id'],) for job in jobs])
+        return jobs
+    
+    # Whole-store operations
+    
+    @timed('storage_read')
+    def load_data(self):
+        """Load the whole store in the hunts/true_positives/false_positives dict format."""
+        true_positives, false_positives = self.get_labels()
+        return {
+            'hunts': self.get_hunts(),
+            'true_positives': true_positives,
+            'false_positives': false_positives
+        }
+    
+    def save_data(self, data):
+        """Replace the hunts and labels in the store with the given data in one transaction."""
+        labeled_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        labels = []
+        for category, key in (('true_positive', 'true_positives'), ('false_positive', 'false_positives')):
+            for msg_id, label in data.get(key, {}).items():
+                labels.append((msg_id, category, label['hunt_id'], label.get('subject'),
+                               label.get('labeled_at', labeled_at)))
+        
+        hunts = data.get('hunts', [])
+        hunt_ids = [hunt['id'] for hunt in hunts]
+        
+        with self.transaction():
+            self.conn.execute("DELETE FROM hunts")
+            self.conn.executemany(
+                "INSERT INTO hunts (id, position, name, data) VALUES (?, ?, ?, ?)",
+                [(hunt['id'], position, hunt.get('name', ''), json.dumps(hunt)) for position, hunt in enumerate(hunts)]
+            )
+            self.conn.execute("DELETE FROM labels")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO labels (msg_id, category, hunt_id, subject, labeled_at) VALUES (?, ?, ?, ?, ?)",
+                labels
+            )
+            # Drop membership and stats of hunts that no longer exist
+            self.conn.execute(
+                f"DELETE FROM hunt_members WHERE hunt_id NOT IN ({','.join('?' * len(hunt_ids))})", hunt_ids
+            )
+            self.conn.execute(
+                f"DELETE FROM hunt_records WHERE hunt_id NOT IN ({','.join('?' * len(hunt_ids))})", hunt_ids
+            )
+            self.conn.execute(
+                f"DELETE FROM hunt_stats WHERE hunt_id NOT IN ({','.join('?' * len(hunt_ids))})", hunt_ids
+            )
+            for table in ('hunt_rule_members', 'rule_stats'):
+                self.conn.execute(
+                    f"DELETE FROM {table} WHERE hunt_id NOT IN ({','.join('?' * len(hunt_ids))})", hunt_ids
+                )
+            
+            # Labels were replaced wholesale, so recount every indexed hunt and drop cached data
+            self.bump_generations(['labels', 'hunts', 'rules'])
+            self.conn.execute("INSERT OR IGNORE INTO dirty_hunts (hunt_id) SELECT DISTINCT hunt_id FROM labels")
+            self.write_stats(row[0] for row in self.conn.execute("SELECT hunt_id FROM hunt_stats").fetchall())
+            self.write_rule_stats(row[0] for row in self.conn.execute("SELECT DISTINCT hunt_id FROM rule_stats").fetchall())
+    
+    def clear(self):
+        with self.transaction():
+            self.bump_generations(['labels', 'hunts', 'rules'])
+            self.conn.execute("DELETE FROM hunts")
+            self.conn.execute("DELETE FROM labels")
+            self.conn.execute("DELETE FROM hunt_members")
+            self.conn.execute("DELETE FROM hunt_records")
+            self.conn.execute("DELETE FROM hunt_stats")
+            self.conn.execute("DELETE FROM rules")
+            self.conn.execute("DELETE FROM hunt_rule_members")
+            self.conn.execute("DELETE FROM rule_stats")
+            self.conn.execute("DELETE FROM dirty_hunts")
+
+def get_store(username='default'):
+    """Open the label store for a specific user, shared for the rest of the request"""
+    if has_app_context():
+        stores = g.setdefault('label_stores', {})
+        if username not in stores:
+            stores[username] = LabelStore(username)
+        return stores[username]
+    return LabelStore(username)
+
+@app.teardown_appcontext
+def close_stores(exception):
+    """Close label stores opened during the request"""
+    for store in g.pop('label_stores', {}).values():
+        store.close()
+
+def load_data(username='default'):
+    """Load all hunts and labels for specific user"""
+    return get_store(username).load_data()
+
+def save_data(data, username='default'):
+    """Save all hunts and labels for specific user"""
+    get_store(username).save_data(data)
+
+def get_results_cache_dir(username='default'):
+    """Get the directory holding cached hunt results for a specific user"""
+    cache_dir = os.path.join(get_user_dir(username), 'results_cache')
+    # Jobs for the same user can get here at the same time
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def get_analyzer(username, api_token):
+    """Create a HuntAnalyzer that caches hunt results in the user's data directory"""
+    return HuntAnalyzer(api_token, cache_dir=get_results_cache_dir(username))
+
+# Message records of recently viewed hunts, keyed by (username, hunt_id), with the
+# generations they were read at
+_hunt_records = OrderedDict()
+_hunt_records_lock = threading.Lock()
+
+# Labels of recently active users, keyed by username, with the labels generation they reflect
+_user_labels = OrderedDict()
+_user_labels_lock = threading.Lock()
+
+# Rule stats and co-occurrence of recently viewed hunts and rules, keyed by
+# (username, hunt_id, rule), with the generations they were read at
+_rule_analytics = OrderedDict()
+_rule_analytics_lock = threading.Lock()
+
+def remember(cache, lock, key, value, size):
+    """Store a value in an LRU cache, evicting the least recently used entries."""
+    with lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+def get_records_generations(store, hunt_id):
+    return store.get_generations(['hunts', f'hunt:{hunt_id}'])
+
+def get_clusters_version(store, hunt_id):
+    """Get a version string of a hunt's cluster IDs, which are reassigned whenever its records are stored."""
+    return '.'.join(str(generation) for generation in get_records_generations(store, hunt_id))
+
+def index_hunt_results(analyzer, store, hunt_id, refresh=False, progress=None):
+    """Fetch a hunt's results and store their message records and the hunt's membership."""
+    records = list(analyzer.iter_hunt_records(hunt_id, refresh=refresh, progress=progress))
+    store_hunt_records(analyzer, store, hunt_id, records)
+    return records
+
+def index_hunts(analyzer, store, hunt_ids, refresh=False, progress=None):
+    """Fetch and index the results of several hunts at once.
+    
+    Results are fetched concurrently and stored from the calling thread as each hunt
+    completes, since the store's connection belongs to that thread. Hunts that
+    succeeded stay indexed if another one fails, and the first failure is raised once
+    all hunts are done. progress, if given, is called with (done, total, message).
+    """
+    hunt_ids = list(hunt_ids)
+    errors = []
+    for done, (hunt_id, records, error) in enumerate(analyzer.get_many_hunt_records(hunt_ids, refresh=refresh), 1):
+        if error:
+            logger.error("Error indexing hunt %s: %s", hunt_id, error)
+            errors.append(error)
+        elif store_hunt_records(analyzer, store, hunt_id, records):
+            logger.info("Indexed %s members of hunt %s", len(records), hunt_id)
+        if progress:
+            progress(done, len(hunt_ids), f'Loaded results of {done} of {len(hunt_ids)} hunts')
+    
+    if errors:
+        raise errors[0]
+    return len(hunt_ids)
+
+def store_hunt_records(analyzer, store, hunt_id, records):
+    """Cluster a hunt's records, store them and the hunt's membership and keep the records in memory.
+    
+    Returns False if the hunt was deleted while its results were being fetched, in
+    which case the results cached during the fetch are removed as well.
+    """
+    cluster_records(records)
+    if not store.set_hunt_records(hunt_id, records):
+        logger.info("Hunt %s was deleted while its results were fetched, not storing them", hunt_id)
+        analyzer.delete_cached_results(hunt_id)
+        return False
+    remember(_hunt_records, _hunt_records_lock, (store.username, hunt_id),
+             (get_records_generations(store, hunt_id), records), HUNT_RECORDS_CACHE_SIZE)
+    return True
+
+def get_cached_records(store, analyzer, hunt_id):
+    """Get the message records of a hunt, keeping those of recently viewed hunts in memory.
+    
+    Cached records are used as long as the hunt's generations show it hasn't been
+    reindexed, deleted or replaced since, by this or any other server process. Hunts
+    indexed before records were stored have their records built from their results,
+    and records stored before clustering are clustered, the first time they're needed.
+    """
+    key = (store.username, hunt_id)
+    generations = get_records_generations(store, hunt_id)
+    with _hunt_records_lock:
+        cached = _hunt_records.get(key)
+        if cached is not None and cached[0] == generations:
+            _hunt_records.move_to_end(key)
+            return cached[1]
+    
+    records = store.get_hunt_records(hunt_id)
+    if records is None:
+        logger.info("Building message records of hunt %s from its results", hunt_id)
+        return index_hunt_results(analyzer, store, hunt_id)
+    
+    if records and records[0].cluster_id is None:
+        logger.info("Clustering the stored records of hunt %s", hunt_id)
+        cluster_records(records)
+        store.set_record_clusters(hunt_id, records)
+        generations = get_records_generations(store, hunt_id)
+    
+    remember(_hunt_records, _hunt_records_lock, key, (generations, records), HUNT_RECORDS_CACHE_SIZE)
+    return records
+
+def get_hunt_subjects(store, analyzer, hunt_id, msg_ids):
+    """Get the subjects of the given messages of a hunt, keyed by message ID, leaving out messages not in the hunt."""
+    subjects = store.get_record_subjects(hunt_id, msg_ids)
+    if subjects is None:
+        msg_ids = set(msg_ids)
+        subjects = {record.id: record.subject for record in get_cached_records(store, analyzer, hunt_id) if record.id in msg_ids}
+    return subjects
+
+def get_cached_labels(store):
+    """Get the (category, hunt_id) of every message the user labeled, keyed by message ID.
+    
+    The labels are kept in memory and reloaded only when another store or process
+    changed them; label changes made through a store update the cached copy in place.
+    The returned dict must not be modified.
+    """
+    generation, = store.get_generations(['labels'])
+    with _user_labels_lock:
+        cached = _user_labels.get(store.username)
+        if cached is not None and cached[0] == generation:
+            _user_labels.move_to_end(store.username)
+            return cached[1]
+    
+    labels = store.get_label_states()
+    remember(_user_labels, _user_labels_lock, store.username, (generation, labels), USER_LABELS_CACHE_SIZE)
+    return labels
+
+def get_rule_analytics(store, hunt_id=None, rule=None):
+    """Get the rule stats of a hunt, or of all hunts when hunt_id is None, or the rules co-occurring with a rule.
+    
+    Results are kept in memory until labels change or a hunt's rule index is replaced.
+    """
+    key = (store.username, hunt_id, rule)
+    generations = store.get_generations(['labels', 'rules'])
+    with _rule_analytics_lock:
+        cached = _rule_analytics.get(key)
+        if cached is not None and cached[0] == generations:
+            _rule_analytics.move_to_end(key)
+            return cached[1]
+    
+    if rule is None:
+        rows = store.get_rule_stats(hunt_id)
+    else:
+        rows = store.get_rule_cooccurrence(rule, hunt_id)
+    for row in rows:
+        row['unlabeled'] = row['total'] - row['tp'] - row['fp']
+        row['fp_share'] = round(row['fp'] / (row['tp'] + row['fp']), 3) if row['tp'] + row['fp'] else None
+    remember(_rule_analytics, _rule_analytics_lock, key, (generations, rows), RULE_ANALYTICS_CACHE_SIZE)
+    return rows
+
+def update_cached_labels(username, previous_generation, generation, changes):
+    """Apply committed label changes to a user's cached labels.
+    
+    changes maps message IDs to their new (category, hunt_id), or None when unlabeled.
+    The cached labels are updated only if they were current when the changes were made.
+    """
+    with _user_labels_lock:
+        cached = _user_labels.get(username)
+        if cached is None or cached[0] >= generation:
+            return
+        if cached[0] != previous_generation:
+            del _user_labels[username]
+            return
+        
+        # Readers may still hold the old dict, so apply the changes to a copy
+        labels = dict(cached[1])
+        for msg_id, label in changes.items():
+            if label is None:
+                labels.pop(msg_id, None)
+            else:
+                labels[msg_id] = label
+        _user_labels[username] = (generation, labels)
+
+def forget_cached_labels(username):
+    with _user_labels_lock:
+        _user_labels.pop(username, None)
+
+# Long-running work such as importing a hunt runs on this pool instead of in the request
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='hunt-job')
+# Jobs submitted by this process that haven't started yet, keyed by job ID, and the IDs of running ones
+_queued_jobs = {}
+_running_jobs = set()
+_jobs_lock = threading.Lock()
+
+class JobProgress:
+    """Callable that records a background job's progress in its job record.
+    
+    Called as progress(done, total, message). Writes are throttled, except for
+    message changes, so per-page progress doesn't hammer the database.
+    """
+    
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        self.message = None
+        self.last_write = 0
+    
+    def __call__(self, done=None, total=None, message=None):
+        now = time.monotonic()
+        if (message is None or message == self.message) and now - self.last_write < JOB_PROGRESS_INTERVAL:
+            return
+        
+        fields = {'progress': done, 'total': total, 'message': message}
+        self.store.update_job(self.job_id, **{field: value for field, value in fields.items() if value is not None})
+        if message is not None:
+            self.message = message
+        self.last_write = now
+
+def submit_job(username, kind, func, *args, hunt_id=None, message=None):
+    """Record a background job for a user and run func(store, progress, *args) on the job pool.
+    
+    The job's return value becomes its final message. Returns the job ID.
+    """
+    job_id = get_store(username).create_job(kind, hunt_id=hunt_id, message=message)
+    with _jobs_lock:
+        _queued_jobs[job_id] = username
+    job_executor.submit(run_job, username, job_id, kind, func, args)
+    job_logger.info("Queued %s job %s for user %s", kind, job_id, username)
+    return job_id
+
+def run_job(username, job_id, kind, func, args):
+    """Run a background job with its own label store, recording how it ended and how long its phases took."""
+    with _jobs_lock:
+        _queued_jobs.pop(job_id, None)
+        _running_jobs.add(job_id)
+    status = 'failed'
+    start = time.perf_counter()
+    with recording_timings(PhaseTimings()) as timings:
+        store = LabelStore(username)
+        try:
+            store.update_job(job_id, status='running')
+            message = func(store, JobProgress(store, job_id), *args)
+            store.update_job(job_id, status='completed', message=message)
+            status = 'completed'
+            job_logger.info("Job %s completed: %s", job_id, message)
+        except Exception as e:
+            job_logger.error("Job %s failed: %s", job_id, e, exc_info=True)
+            store.update_job(job_id, status='failed', message=str(e))
+        finally:
+            # Jobs write in bulk, so fold their log into the database off the request path
+            store.checkpoint()
+            store.close()
+            with _jobs_lock:
+                _running_jobs.discard(job_id)
+    
+    duration = time.perf_counter() - start
+    JOB_SECONDS.labels(kind, status).observe(duration)
+    job_logger.info("%s job %s took %.2fs: %s", kind, job_id, duration, timings.summary())
+
+def shutdown_jobs(timeout=None):
+    """Stop this process from starting queued jobs and wait for running ones to finish.
+    
+    Called when a server worker exits, before the interpreter shuts down and stops the
+    thread pools jobs use. Queued jobs are failed so their users are told. Running jobs
+    get up to timeout seconds to finish.
+    """
+    job_executor.shutdown(wait=False, cancel_futures=True)
+    with _jobs_lock:
+        queued_jobs = list(_queued_jobs.items())
+        _queued_jobs.clear()
+    
+    for job_id, username in queued_jobs:
+        store = LabelStore(username)
+        store.update_job(job_id, status='failed', message='The server restarted before this job started. Please try again.')
+        store.close()
+    if queued_jobs:
+        job_logger.warning("Failed %s queued jobs on shutdown", len(queued_jobs))
+    
+    deadline = None if timeout is None else time.time() + timeout
+    while _running_jobs and (deadline is None or time.time() < deadline):
+        time.sleep(0.5)
+    if _running_jobs:
+        job_logger.warning("%s jobs still running on shutdown", len(_running_jobs))
+
+# Rendered MQL diffs, keyed by the hashes of the two sources
+_mql_diffs = OrderedDict()
+_mql_diffs_lock = threading.Lock()
+
+def get_diff_key(text1, text2):
+    return (hashlib.sha256(text1.encode('utf-8')).hexdigest(), hashlib.sha256(text2.encode('utf-8')).hexdigest())
+
+def get_cached_html_diff(text1, text2):
+    """Get the rendered diff of two strings if it's cached, or None."""
+    key = get_diff_key(text1 or '', text2 or '')
+    with _mql_diffs_lock:
+        html_diff = _mql_diffs.get(key)
+        if html_diff is not None:
+            _mql_diffs.move_to_end(key)
+        return html_diff
+
+def create_html_diff(text1, text2):
+    """Create an HTML diff between two strings, reusing the diff of a pair of strings seen before."""
+    text1 = text1 or ''
+    text2 = text2 or ''
+    html_diff = get_cached_html_diff(text1, text2)
+    if html_diff is None:
+        html_diff = render_html_diff(text1, text2)
+        remember(_mql_diffs, _mql_diffs_lock, get_diff_key(text1, text2), html_diff, MQL_DIFF_CACHE_SIZE)
+    return html_diff
+
+def compute_diff(text1, text2):
+    """Diff two strings with diff_match_patch within MQL_DIFF_TIMEOUT seconds.
+    
+    Long strings are diffed line by line first, and only blocks of changed lines are
+    refined to characters, so unchanged parts of a long rule cost next to nothing. Once
+    the deadline passes, diff_match_patch returns a coarser but still valid diff.
+    """
+    dmp = diff_match_patch()
+    deadline = time.time() + MQL_DIFF_TIMEOUT
+    
+    if len(text1) + len(text2) <= MQL_LINE_DIFF_CHARS:
+        diffs = dmp.diff_main(text1, text2, False, deadline)
+    else:
+        lines1, lines2, line_array = dmp.diff_linesToChars(text1, text2)
+        line_diffs = dmp.diff_main(lines1, lines2, False, deadline)
+        dmp.diff_charsToLines(line_diffs, line_array)
+        
+        diffs = []
+        deleted = inserted = ''
+        # A trailing equality flushes the last block of changed lines
+        for op, text in line_diffs + [(dmp.DIFF_EQUAL, '')]:
+            if op == dmp.DIFF_DELETE:
+                deleted += text
+            elif op == dmp.DIFF_INSERT:
+                inserted += text
+            else:
+                if deleted and inserted and len(deleted) + len(inserted) <= MQL_REFINE_MAX_CHARS:
+                    diffs.extend(dmp.diff_main(deleted, inserted, False, deadline))
+                else:
+                    if deleted:
+                        diffs.append((dmp.DIFF_DELETE, deleted))
+                    if inserted:
+                        diffs.append((dmp.DIFF_INSERT, inserted))
+                deleted = inserted = ''
+                if text:
+                    diffs.append((dmp.DIFF_EQUAL, text))
+    
+    dmp.diff_cleanupSemantic(diffs)
+    return diffs
+
+def render_html_diff(text1, text2):
+    """Render the diff of two strings as HTML."""
+    if not text1 and not text2:
+        return "<em>No MQL source available for both hunts</em>"
+    elif not text1:
+        return f"<pre style='background-color:#e6ffed;'>{html.escape(text2, quote=False)}</pre>"
+    elif not text2:
+        return f"<pre style='background-color:#ffdce0;'>{html.escape(text1, quote=False)}</pre>"
+    
+    parts = ["<pre>"]
+    for op, text in compute_diff(text1, text2):
+        text = html.escape(text, quote=False)
+        if op == 0:  # Equal
+            parts.append(f"<span>{text}</span>")
+        elif op == -1:  # Deletion
+            parts.append(f"<span style='background-color:#ffdce0;'>{text}</span>")
+        elif op == 1:  # Insertion
+            parts.append(f"<span style='background-color:#e6ffed;'>{text}</span>")
+    parts.append("</pre>")
+    
+    return "".join(parts)
+
+class RateLimiter:
+    """Token bucket limiting how many requests per second are sent with one API token."""
+    
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request may be sent."""
+        if self.rate <= 0:
+            return
+        
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Shared HTTP sessions and rate limiters, keyed by a hash of the API token
+_api_clients = {}
+_api_clients_lock = threading.Lock()
+
+# Caps the requests in flight across every job and request, however many hunts are fetched at once
+api_request_slots = threading.BoundedSemaphore(max(1, API_MAX_CONCURRENCY))
+
+# Work on several hunts at once, such as fetching all of their results, fans out on this pool
+api_executor = ThreadPoolExecutor(max_workers=max(1, API_MAX_CONCURRENCY), thread_name_prefix='sublime-api')
+
+def get_api_client(api_token):
+    """Get the pooled keep-alive HTTP session and rate limiter shared by all users of an API token."""
+    token_key = hashlib.sha256(api_token.encode('utf-8')).hexdigest()
+    
+    with _api_clients_lock:
+        client = _api_clients.get(token_key)
+        if client is None:
+            http_session = requests.Session()
+            # Retries are handled by HuntAnalyzer so they pass through the rate limiter
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, API_MAX_CONCURRENCY), max_retries=0)
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+            client = (http_session, RateLimiter(API_RATE_LIMIT))
+            _api_clients[token_key] = client
+            api_logger.debug("Created new pooled API session")
+    
+    return client
 
-def load_data(username='default'):
-    """Load data from JSON file for specific user"""
-    # Create user directory if it doesn't exist
-    user_dir = os.path.join(DATA_DIR, username)
-    if not os.path.exists(user_dir):
-        os.makedirs(user_dir)
-        
-    data_file = os.path.join(user_dir, 'hunt_data.json')
+def get_retry_after(response):
+    """Get the number of seconds a Retry-After header asks us to wait, or None."""
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
     
-    if not os.path.exists(data_file):
-        return {
-            'hunts': [],
-            'true_positives': {},
-            'false_positives': {}
-        }
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
     
-    with open(data_file, 'r') as f:
-        return json.load(f)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
-def save_data(data, username='default'):
-    """Save data to JSON file for specific user"""
-    # Create user directory if it doesn't exist
-    user_dir = os.path.join(DATA_DIR, username)
-    if not os.path.exists(user_dir):
-        os.makedirs(user_dir)
-        
-    data_file = os.path.join(user_dir, 'hunt_data.json')
+class ResultsCacheWriter:
+    """Writes a hunt's results cache page by page to a temporary file that replaces the cache on commit.
     
-    with open(data_file, 'w') as f:
-        json.dump(data, f, indent=2)
-        
-def create_html_diff(text1, text2):
-    """Create an HTML diff between two strings."""
-    if not text1 and not text2:
-        return "<em>No MQL source available for both hunts</em>"
-    elif not text1:
-        return f"<pre style='background-color:#e6ffed;'>{text2}</pre>"
-    elif not text2:
-        return f"<pre style='background-color:#ffdce0;'>{text1}</pre>"
+    Caching is best effort: if writing fails the error is logged and the rest of the
+    results are not cached.
+    """
     
-    dmp = diff_match_patch()
-    diffs = dmp.diff_main(text1, text2)
-    dmp.diff_cleanupSemantic(diffs)
+    def __init__(self, cache_path, hunt_id, hunt_status):
+        self.cache_path = cache_path
+        self.tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        self.hunt_id = hunt_id
+        self.hunt_status = hunt_status
+        self.raw_file = None
+        self.file = None
+        self.failed = False
+        self.count = 0
     
-    html = []
-    for op, text in diffs:
-        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        if op == 0:  # Equal
-            html.append(f"<span>{text}</span>")
-        elif op == -1:  # Deletion
-            html.append(f"<span style='background-color:#ffdce0;'>{text}</span>")
-        elif op == 1:  # Insertion
-            html.append(f"<span style='background-color:#e6ffed;'>{text}</span>")
+    def write_page(self, message_groups, etag=None):
+        if self.failed:
+            return
+        
+        try:
+            if self.file is None:
+                self.raw_file = open(self.tmp_path, 'wb')
+                self.file = gzip.open(self.raw_file, 'wt', encoding='utf-8')
+                self.file.write(json.dumps({
+                    'hunt_id': self.hunt_id,
+                    'fetched_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'etag': etag,
+                    'status': self.hunt_status,
+                    'completed': self.hunt_status == "COMPLETED"
+                }) + '\n')
+            for message_group in message_groups:
+                self.file.write(json.dumps(message_group) + '\n')
+            self.count += len(message_groups)
+        except Exception as e:
+            api_logger.error("Error caching results for hunt %s: %s", self.hunt_id, e)
+            self.failed = True
+            self.discard()
+    
+    def commit(self):
+        """Replace the cache with the written results once they are safely on disk."""
+        if self.failed or self.file is None:
+            return
+        
+        try:
+            self.file.close()
+            self.file = None
+            self.raw_file.flush()
+            os.fsync(self.raw_file.fileno())
+            self.raw_file.close()
+            self.raw_file = None
+            os.replace(self.tmp_path, self.cache_path)
+            record_storage_bytes(0, os.path.getsize(self.cache_path))
+            api_logger.debug("Cached %s results for hunt %s (status: %s)", self.count, self.hunt_id, self.hunt_status)
+        except Exception as e:
+            api_logger.error("Error caching results for hunt %s: %s", self.hunt_id, e)
+            self.discard()
     
-    return "<pre>" + "".join(html) + "</pre>"
+    def discard(self):
+        """Remove the temporary file if the cache wasn't committed."""
+        for f in (self.file, self.raw_file):
+            if f is not None:
+                try:
+                    f.close()
+                except Exception:
+                    pass
+        self.file = None
+        self.raw_file = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
 
 class HuntAnalyzer:
-    def __init__(self, api_token):
-        """Initialize the Hunt Analyzer with API token."""
+    def __init__(self, api_token, cache_dir=None, concurrency=None):
+        """Initialize the Hunt Analyzer with API token and optional results cache directory."""
         self.api_token = api_token
-        self.base_url = "https://platform.sublime.security/v1"
+        self.base_url = API_BASE_URL
         self.headers = {
             "accept": "application/json",
             "authorization": f"Bearer {self.api_token}",
             "content-type": "application/json"
         }
+        self.cache_dir = cache_dir
+        self.concurrency = max(1, concurrency or RESULTS_FETCH_CONCURRENCY)
+        self.timeout = (API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+        self.max_retries = API_MAX_RETRIES
+        self.http_session, self.rate_limiter = get_api_client(api_token)
     
-    def get_hunt_results(self, hunt_id):
-        """Get results of a hunt job using pagination to ensure all results are fetched."""
-        all_results = []
-        offset = 0
-        limit = 50  # Default API limit
-        total_count = None
-        max_iterations = 100  # Safety limit to prevent infinite loops
-        iteration = 0
-        
-        logger.info(f"Fetching all results for hunt {hunt_id} with pagination")
-        
-        while iteration < max_iterations:
-            iteration += 1
-            logger.debug(f"Fetching results for hunt {hunt_id} with offset={offset}, limit={limit} (page {iteration})")
-            response = requests.get(
-                f"{self.base_url}/hunt-jobs/{hunt_id}/results?limit={limit}&offset={offset}",
-                headers=self.headers
-            )
+    @timed('api')
+    def api_get(self, url, endpoint):
+        """Send a GET request through the shared session, retrying throttled and failed requests.
+        
+        429 and 5xx responses and connection errors are retried with exponential backoff,
+        honouring the Retry-After header when the API sends one. The last response is
+        returned once retries are exhausted so callers can report the error. endpoint
+        names the kind of request in the metrics.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
             
-            if response.status_code != 200:
-                raise Exception(f"Error getting hunt results: {response.text}")
+            try:
+                with api_request_slots:
+                    response = self.http_session.get(url, headers=self.headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                API_REQUESTS.labels(endpoint, 'error').inc()
+                if attempt >= self.max_retries:
+                    raise Exception(f"Error contacting Sublime API: {str(e)}")
+                delay = min(API_MAX_BACKOFF, API_BACKOFF_FACTOR * (2 ** attempt))
+                api_logger.warning("Request to %s failed (%s), retrying in %.1fs (attempt %s/%s)", url, e, delay, attempt + 1, self.max_retries)
+                time.sleep(delay + random.uniform(0, delay / 2))
+                continue
             
-            response_data = response.json()
-            message_groups = response_data.get("message_groups", [])
-            all_results.extend(message_groups)
+            API_REQUESTS.labels(endpoint, str(response.status_code)).inc()
+            if response.status_code not in API_RETRY_STATUSES or attempt >= self.max_retries:
+                return response
             
-            # Set total_count on first iteration if available
-            if total_count is None:
-                total_count = response_data.get("total_group_count", 0)
-                logger.info(f"Hunt {hunt_id} has reported total_group_count of {total_count} message groups")
-                
-                # The v1 API may incorrectly report total_count as the page size
-                # Continue fetching even if total_count equals limit
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = API_BACKOFF_FACTOR * (2 ** attempt)
+                delay += random.uniform(0, delay / 2)
+            delay = min(API_MAX_BACKOFF, delay)
+            api_logger.warning("Request to %s returned %s, retrying in %.1fs (attempt %s/%s)", url, response.status_code, delay, attempt + 1, self.max_retries)
+            time.sleep(delay)
+        
+        return response
+    
+    def iter_hunt_results(self, hunt_id, refresh=False, progress=None, hunt_details=None):
+        """Iterate over the message groups of a hunt job, streamed from the local cache when the hunt is completed.
+        
+        Completed hunts are immutable, so their results are cached on disk and only
+        refetched when refresh is True. Hunts that were not completed when they were
+        fetched are always refetched. Only one page of results is held in memory at a
+        time. progress is passed on to iter_result_pages. hunt_details are the hunt's
+        details if the caller already has them, otherwise they're fetched for the status.
+        """
+        if not refresh:
+            cached = self.open_cached_results(hunt_id)
+            if cached is not None:
+                yield from self.iter_cached_results(hunt_id, *cached)
+                return
+        
+        # Check the hunt status before fetching so we know whether the results are final
+        hunt_status = None
+        if self.cache_dir:
+            if hunt_details is None:
+                try:
+                    hunt_details = self.get_hunt_details(hunt_id)
+                except Exception as e:
+                    api_logger.warning("Could not get status for hunt %s, results will not be cached as final: %s", hunt_id, e)
+            if hunt_details is not None:
+                hunt_status = hunt_details.get('status', '').upper()
+        
+        # The cache is written page by page and only replaces the old one once every page is in
+        cache_writer = ResultsCacheWriter(self.get_cache_path(hunt_id), hunt_id, hunt_status) if self.cache_dir else None
+        try:
+            for etag, message_groups in self.iter_result_pages(hunt_id, progress=progress):
+                if cache_writer:
+                    cache_writer.write_page(message_groups, etag)
+                yield from message_groups
             
-            # If we received fewer results than requested, we've reached the end
-            if len(message_groups) < limit:
-                logger.info(f"Received {len(message_groups)} messages (less than limit of {limit}), reached end of results")
-                break
+            if cache_writer:
+                cache_writer.commit()
+                self.prune_results_cache()
+        finally:
+            if cache_writer:
+                cache_writer.discard()
+    
+    def iter_hunt_records(self, hunt_id, refresh=False, progress=None, hunt_details=None):
+        """Iterate over the normalized message records of a hunt job."""
+        for message_group in self.iter_hunt_results(hunt_id, refresh=refresh, progress=progress, hunt_details=hunt_details):
+            yield MessageRecord.from_message_group(message_group)
+    
+    def map_hunts(self, func, hunt_ids, max_pending=None):
+        """Call func(hunt_id) for several hunts at once on the shared API pool.
+        
+        Yields (hunt_id, result, error) as the calls complete, where error is the
+        exception raised by a failed call. Every request still goes through the global
+        request cap and the token's rate limiter. When max_pending is given, no more
+        calls than that are running or waiting to be yielded at once, so large results
+        don't pile up while the caller is busy with earlier ones.
+        """
+        func = bind_timings(func)
+        queued = deque(hunt_ids)
+        futures = {}
+        try:
+            while queued or futures:
+                while queued and (max_pending is None or len(futures) < max_pending):
+                    hunt_id = queued.popleft()
+                    futures[api_executor.submit(func, hunt_id)] = hunt_id
                 
-            # If we received no results, stop
-            if len(message_groups) == 0:
-                logger.info(f"Received 0 messages, stopping pagination")
-                break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    hunt_id = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        yield hunt_id, None, e
+                    else:
+                        yield hunt_id, result, None
+        finally:
+            # Don't start hunts nobody is waiting for anymore
+            for future in futures:
+                future.cancel()
+    
+    def get_many_hunt_records(self, hunt_ids, refresh=False, hunt_details=None):
+        """Fetch the records of several hunts at once, yielding (hunt_id, records, error) as each one completes.
+        
+        Only RESULTS_MAX_PENDING_HUNTS hunts are fetched at a time, so the records held
+        in memory are bounded by that many hunts however many are requested. hunt_details
+        maps hunt IDs to details the caller already has, so they aren't fetched again.
+        """
+        hunt_details = hunt_details or {}
+        return self.map_hunts(lambda hunt_id: list(self.iter_hunt_records(hunt_id, refresh=refresh,
+                                                                          hunt_details=hunt_details.get(hunt_id))),
+                              hunt_ids, max_pending=RESULTS_MAX_PENDING_HUNTS)
+    
+    def get_many_hunt_details(self, hunt_ids):
+        """Fetch the details of several hunts at once, yielding (hunt_id, details, error) as each one completes."""
+        return self.map_hunts(self.get_hunt_details, hunt_ids)
+    
+    def fetch_results_page(self, hunt_id, offset, limit):
+        """Fetch a single page of hunt results from the API."""
+        api_logger.debug("Fetching results for hunt %s with offset=%s, limit=%s", hunt_id, offset, limit)
+        response = self.api_get(f"{self.base_url}/hunt-jobs/{hunt_id}/results?limit={limit}&offset={offset}", 'results')
+        
+        if response.status_code != 200:
+            raise Exception(f"Error getting hunt results: {response.text}")
+        
+        API_PAGES.inc()
+        timings = get_timings()
+        if timings is not None:
+            timings.add_api_page()
+        return response
+    
+    def iter_result_pages(self, hunt_id, progress=None):
+        """Iterate over the pages of a hunt job's results from the API, requesting pages concurrently.
+        
+        The first page tells us the reported total_group_count, and the following pages
+        are requested through a bounded worker pool that keeps at most `concurrency`
+        pages in flight, so memory use doesn't grow with the size of the hunt. Because
+        the v1 API may misreport the total as the page size, we keep probing further
+        pages, in windows that grow up to the concurrency limit, until a page comes back short.
+        
+        Yields (etag, message_groups) for each page in order, where etag is that of the
+        first page. If given, progress is called with the number of message groups
+        fetched so far and the number expected after each page.
+        """
+        limit = RESULTS_PAGE_SIZE
+        
+        api_logger.info("Fetching all results for hunt %s with pagination (concurrency=%s)", hunt_id, self.concurrency)
+        
+        response = self.fetch_results_page(hunt_id, 0, limit)
+        etag = response.headers.get("ETag")
+        with timed('json'):
+            response_data = response.json()
+        message_groups = response_data.get("message_groups", [])
+        total_count = response_data.get("total_group_count", 0)
+        del response, response_data
+        api_logger.info("Hunt %s has reported total_group_count of %s message groups", hunt_id, total_count)
+        
+        fetched_count = len(message_groups)
+        page_count = 1
+        if progress:
+            progress(fetched_count, max(total_count, fetched_count))
+        
+        reached_end = len(message_groups) < limit
+        yield etag, message_groups
+        
+        if not reached_end:
+            # Pages starting before this offset are expected based on the reported total
+            expected_end = max(total_count, limit)
+            next_offset = limit
+            probe_window = 1
+            pending = deque()
             
-            # Update offset for next batch
-            offset += limit
-            logger.debug(f"Updated offset to {offset} for next page")
+            fetch_results_page = bind_timings(self.fetch_results_page)
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                try:
+                    while not reached_end:
+                        # Keep the window full, probing past the expected pages more cautiously
+                        window = self.concurrency if next_offset < expected_end else min(probe_window, self.concurrency)
+                        while len(pending) < window:
+                            pending.append((next_offset, executor.submit(fetch_results_page, hunt_id, next_offset, limit)))
+                            next_offset += limit
+                        
+                        page_offset, future = pending.popleft()
+                        response = future.result()
+                        with timed('json'):
+                            message_groups = response.json().get("message_groups", [])
+                        del response
+                        fetched_count += len(message_groups)
+                        page_count += 1
+                        if progress:
+                            progress(fetched_count, max(total_count, fetched_count))
+                        
+                        # The first short page marks the end
+                        if len(message_groups) < limit:
+                            reached_end = True
+                        elif page_offset >= expected_end:
+                            probe_window *= 2
+                            api_logger.debug("Page at offset %s was full, probing %s pages ahead", page_offset, probe_window)
+                        
+                        yield etag, message_groups
+                finally:
+                    # Don't wait for pages past the end, or for the rest if the caller stopped early
+                    for _, future in pending:
+                        future.cancel()
+        
+        if fetched_count != total_count:
+            api_logger.info("Note: API reported %s total messages, but actually retrieved %s", total_count, fetched_count)
             
-        actual_total = len(all_results)
-        if actual_total != total_count:
-            logger.info(f"Note: API reported {total_count} total messages, but actually retrieved {actual_total}")
+        api_logger.info("Retrieved %s total message groups for hunt %s in %s pages", fetched_count, hunt_id, page_count)
+    
+    def get_cache_path(self, hunt_id):
+        """Get the path of the cached results file for a hunt."""
+        safe_hunt_id = re.sub(r'[^A-Za-z0-9_.-]', '_', hunt_id)
+        return os.path.join(self.cache_dir, f"{safe_hunt_id}.json.gz")
+    
+    def open_cached_results(self, hunt_id):
+        """Open the cached results of a hunt, returning (header, file) or None if there is no usable cache entry.
+        
+        The cache is gzipped JSON lines: a header with the fetch metadata followed by
+        one message group per line. Caches written by older versions are a single JSON
+        document, which is read as a header that also holds the message groups.
+        """
+        if not self.cache_dir:
+            return None
+        
+        cache_path = self.get_cache_path(hunt_id)
+        if not os.path.exists(cache_path):
+            return None
+        
+        try:
+            f = gzip.open(cache_path, 'rt', encoding='utf-8')
+            header = json.loads(f.readline())
+        except Exception as e:
+            api_logger.warning("Ignoring unreadable results cache for hunt %s: %s", hunt_id, e)
+            return None
+        
+        # Only completed hunts are immutable, anything else has to be refetched
+        if not header.get('completed'):
+            f.close()
+            api_logger.info("Cached results for hunt %s were fetched before the hunt completed, refetching", hunt_id)
+            return None
+        
+        record_storage_bytes(os.path.getsize(cache_path), 0)
+        api_logger.info("Using cached results for hunt %s fetched at %s", hunt_id, header.get('fetched_at'))
+        # The modification time records when the cache was last used, for pruning
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return header, f
+    
+    def iter_cached_results(self, hunt_id, header, f):
+        """Iterate over the message groups of an opened results cache."""
+        with f:
+            if 'message_groups' in header:
+                yield from header.pop('message_groups')
+                return
             
-        logger.info(f"Retrieved {actual_total} total message groups for hunt {hunt_id}")
-        return all_results
+            try:
+                for line in f:
+                    yield json.loads(line)
+            except (OSError, EOFError, ValueError) as e:
+                # The results already yielded can't be taken back, so drop the cache and fail
+                api_logger.error("Results cache for hunt %s is corrupt, removing it: %s", hunt_id, e)
+                self.delete_cached_results(hunt_id)
+                raise Exception(f"Cached results for hunt {hunt_id} were corrupt and have been removed, please try again")
+    
+    def delete_cached_results(self, hunt_id):
+        """Remove the cached results for a hunt."""
+        if not self.cache_dir:
+            return
+        
+        cache_path = self.get_cache_path(hunt_id)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+            api_logger.debug("Removed cached results for hunt %s", hunt_id)
+    
+    def prune_results_cache(self):
+        """Remove cached results that are too old, then the least recently used until the cache fits its size limit.
+        
+        Temporary files of writers that stopped making progress are removed as well.
+        Returns the number of removed files.
+        """
+        if not self.cache_dir:
+            return 0
+        
+        try:
+            dir_entries = list(os.scandir(self.cache_dir))
+        except OSError as e:
+            api_logger.warning("Could not prune the results cache: %s", e)
+            return 0
+        
+        now = time.time()
+        entries = []
+        removed = []
+        for entry in dir_entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Removed by another worker in the meantime
+                continue
+            if entry.name.endswith('.tmp'):
+                if now - stat.st_mtime > JOB_STALE_SECONDS:
+                    removed.append((entry.path, stat.st_size))
+            elif entry.name.endswith('.json.gz'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        
+        # Keep the most recently used results that fit
+        kept_bytes = 0
+        for mtime, size, path in sorted(entries, reverse=True):
+            too_old = RESULTS_CACHE_MAX_AGE_DAYS and now - mtime > RESULTS_CACHE_MAX_AGE_DAYS * 24 * 3600
+            too_large = RESULTS_CACHE_MAX_BYTES and kept_bytes + size > RESULTS_CACHE_MAX_BYTES
+            if too_old or too_large:
+                removed.append((path, size))
+            else:
+                kept_bytes += size
+        
+        removed_count = 0
+        removed_bytes = 0
+        for path, size in removed:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed_count += 1
+            removed_bytes += size
+        if removed_count:
+            api_logger.info("Pruned %s files (%s bytes) from the results cache, keeping %s bytes", removed_count, removed_bytes, kept_bytes)
+        return removed_count
     
     def get_hunt_details(self, hunt_id):
         """Get details of a hunt job including its time range and MQL source."""
-        response = requests.get(
-            f"{self.base_url}/hunt-jobs/{hunt_id}",
-            headers=self.headers
-        )
+        response = self.api_get(f"{self.base_url}/hunt-jobs/{hunt_id}", 'details')
         
         if response.status_code != 200:
             raise Exception(f"Error getting hunt details: {response.text}")
         
-        hunt_details = response.json()
+        with timed('json'):
+            hunt_details = response.json()
         
         # For v1 API compatibility, check for the correct field containing the MQL source
         # The v1 API might use different field names
         if 'mql' in hunt_details and 'source' not in hunt_details:
             hunt_details['source'] = hunt_details['mql']
-            logger.debug(f"Using 'mql' field as source for hunt {hunt_id}")
+            api_logger.debug("Using 'mql' field as source for hunt %s", hunt_id)
             
         return hunt_details
     
-    def get_subject_from_message_group(self, message_group):
+    @staticmethod
+    def get_subject_from_message_group(message_group):
         """Extract subject from a message group."""
         # Handle v1 API format
         if message_group.get("subjects") and len(message_group["subjects"]) > 0:
@@ -184,7 +2515,7 @@ class HuntAnalyzer:
             
         # If we can't find a subject in either format
         return "No subject"
-        
+    
     def parse_timeframe(self, hunt_details):
         """Parse hunt timeframe into a readable format."""
         start_time = hunt_details.get("range_start_time")
@@ -218,6 +2549,39 @@ class HuntAnalyzer:
         except Exception:
             return None
 
+# Request timing
+@app.before_request
+def start_request_timings():
+    g.request_started = time.perf_counter()
+    _timing.timings = PhaseTimings()
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_render_time(sender, template, context, **extra):
+    record_phase('render', time.perf_counter() - g.pop('render_started'))
+
+@app.after_request
+def record_request_timings(response):
+    """Record how long the request took and add its phase timings as a Server-Timing header."""
+    timings = get_timings()
+    started = g.pop('request_started', None)
+    if timings is None or started is None:
+        return response
+    
+    total = time.perf_counter() - started
+    # Unmatched URLs share one label so scanners can't create a series per path
+    REQUEST_SECONDS.labels(request.endpoint or 'unmatched', request.method, str(response.status_code)).observe(total)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.server_timing(total)
+    return response
+
+@app.teardown_request
+def clear_request_timings(exception):
+    _timing.timings = None
+
 # Routes
 @app.route('/')
 def index():
@@ -288,207 +2652,104 @@ def hunts():
         return redirect(url_for('index'))
     
     username = session['username']
-    data = load_data(username)
-    return render_template('hunts.html', hunts=data.get('hunts', []), username=username)
+    store = get_store(username)
+    
+    # Report background jobs that finished since the user last looked
+    for job in store.pop_finished_jobs():
+        flash(job['message'] or f'{job["kind"].capitalize()} job {job["status"]}', 'success' if job['status'] == 'completed' else 'danger')
+    
+    return render_template('hunts.html', hunts=store.get_hunts(), jobs=store.get_active_jobs(), username=username)
 
-def reprocess_samples_internal(analyzer, data):
-    """Internal function to reprocess all samples to ensure hunt stats are accurate."""
-    logger.info("Starting reprocess_samples_internal")
+def index_hunt_members(analyzer, store, refresh=False, progress=None):
+    """Index the membership and rules of hunts that haven't been indexed yet, or of all hunts on refresh."""
+    without_records = set(store.get_hunts_without_records())
+    hunt_ids = [hunt['id'] for hunt in store.get_hunts()
+                if refresh or not store.is_indexed(hunt['id']) or hunt['id'] in without_records]
+    logger.info("Indexing members of %s hunts", len(hunt_ids))
+    return index_hunts(analyzer, store, hunt_ids, refresh=refresh, progress=progress)
+
+def reprocess_samples_internal(analyzer, store, refresh=False, full=False, progress=None):
+    """Internal function to reprocess all samples to ensure hunt stats are accurate.
     
-    hunts = data.get('hunts', [])
-    true_positives = data.get('true_positives', {})
-    false_positives = data.get('false_positives', {})
+    Hunts missing from the membership index are indexed, then labels that reference
+    deleted hunts are fixed and stats are verified against a recount for the hunts that
+    changed since the last reprocess. When full is True, all labels and every hunt's
+    stats are checked. When refresh is True, every hunt's results are refetched from
+    the API and reindexed. progress, if given, is called with (done, total, message)
+    as hunts are processed.
+    """
+    logger.info("Starting reprocess_samples_internal")
     
-    logger.debug(f"Reprocessing {len(hunts)} hunts with {len(true_positives)} TPs and {len(false_positives)} FPs")
+    hunts = store.get_hunts()
     
     if not hunts:
         logger.warning("No hunts to reprocess")
         return False
     
-    # Create a lookup of which messages appear in which hunts
-    message_hunt_map = {}
-    hunt_results_cache = {}
+    # Track stats before and after for logging
+    hunt_stats_before = {hunt['id']: hunt for hunt in hunts}
     
-    # First pass: build the message-to-hunt map
-    logger.info("Building message-to-hunt map")
-    for hunt in hunts:
-        hunt_id = hunt['id']
-        logger.info(f"Fetching results for hunt {hunt_id}")
-        results = analyzer.get_hunt_results(hunt_id)
-        hunt_results_cache[hunt_id] = results
-        logger.debug(f"Hunt {hunt_id} has {len(results)} samples")
-        
-        for msg in results:
-            msg_id = msg['id']
-            if msg_id not in message_hunt_map:
-                message_hunt_map[msg_id] = []
-            message_hunt_map[msg_id].append(hunt_id)
+    # First pass: make sure we know which messages appear in which hunts
+    indexed_count = index_hunt_members(analyzer, store, refresh=refresh, progress=progress)
+    logger.info("Indexed members of %s hunts", indexed_count)
     
-    logger.info(f"Message-to-hunt map built with {len(message_hunt_map)} unique messages")
+    # Second pass: add missing timeframes and verify status, fetching all hunts' details at once
+    hunts_without_timeframe = {hunt['id']: hunt for hunt in hunts if 'timeframe' not in hunt}
+    if hunts_without_timeframe and progress:
+        progress(0, len(hunts_without_timeframe), f'Updating details of {len(hunts_without_timeframe)} hunts')
     
-    # Track stats before and after for logging
-    hunt_stats_before = {}
-    hunt_stats_after = {}
-    
-    # Second pass: recount true/false positives for each hunt
-    logger.info("Recounting true/false positives for each hunt")
-    updated_hunts = []
-    for hunt in hunts:
-        hunt_id = hunt['id']
-        results = hunt_results_cache[hunt_id]
-        
-        # Save stats before updates for logging
-        hunt_stats_before[hunt_id] = {
-            'name': hunt.get('name', 'Unknown'),
-            'tp_count': hunt.get('true_positives_count', 0),
-            'fp_count': hunt.get('false_positives_count', 0),
-            'pre_labeled_count': hunt.get('pre_labeled_count', 0),
-            'total_new_samples': hunt.get('total_new_samples', 0),
-            'labeled_new_samples': hunt.get('labeled_new_samples', 0),
-            'unlabeled_count': hunt.get('unlabeled_count', 0),
-        }
+    for hunt_id, hunt_details, error in analyzer.get_many_hunt_details(hunts_without_timeframe):
+        hunt = hunts_without_timeframe[hunt_id]
+        if error:
+            # Continue if we can't get the timeframe
+            logger.error("Error fetching timeframe for hunt %s: %s", hunt_id, error)
+            continue
         
-        # Reset counters
-        tp_count = 0
-        fp_count = 0
-        pre_labeled_count = 0
-        
-        # Count true/false positives for this hunt
-        for msg in results:
-            msg_id = msg['id']
-            if msg_id in true_positives:
-                tp_count += 1
-                # Check if this was pre-labeled from another hunt
-                if true_positives[msg_id]['hunt_id'] != hunt_id:
-                    pre_labeled_count += 1
-                    logger.debug(f"Message {msg_id} in hunt {hunt_id} is a pre-labeled TP from hunt {true_positives[msg_id]['hunt_id']}")
-            elif msg_id in false_positives:
-                fp_count += 1
-                # Check if this was pre-labeled from another hunt
-                if false_positives[msg_id]['hunt_id'] != hunt_id:
-                    pre_labeled_count += 1
-                    logger.debug(f"Message {msg_id} in hunt {hunt_id} is a pre-labeled FP from hunt {false_positives[msg_id]['hunt_id']}")
-        
-        # Calculate unlabeled counts (only for new samples)
-        total_new_samples = len(results) - pre_labeled_count
-        labeled_new_samples = (tp_count + fp_count) - pre_labeled_count
-        unlabeled_count = total_new_samples - labeled_new_samples
-        
-        logger.info(f"Hunt {hunt_id} ({hunt.get('name', 'Unknown')}): {tp_count} TPs, {fp_count} FPs, {pre_labeled_count} pre-labeled, {unlabeled_count} unlabeled")
-        
-        # Update hunt stats
-        hunt_copy = hunt.copy()
-        hunt_copy['true_positives_count'] = tp_count
-        hunt_copy['false_positives_count'] = fp_count
-        hunt_copy['pre_labeled_count'] = pre_labeled_count
-        hunt_copy['total_new_samples'] = total_new_samples
-        hunt_copy['labeled_new_samples'] = labeled_new_samples
-        hunt_copy['unlabeled_count'] = unlabeled_count
-        
-        # Save stats after updates for logging
-        hunt_stats_after[hunt_id] = {
-            'name': hunt_copy.get('name', 'Unknown'),
-            'tp_count': tp_count,
-            'fp_count': fp_count,
-            'pre_labeled_count': pre_labeled_count,
-            'total_new_samples': total_new_samples,
-            'labeled_new_samples': labeled_new_samples,
-            'unlabeled_count': unlabeled_count,
-        }
+        updates = {}
         
-        # Add timeframe if missing and verify status
-        if 'timeframe' not in hunt_copy:
-            try:
-                logger.debug(f"Fetching timeframe for hunt {hunt_id}")
-                hunt_details = analyzer.get_hunt_details(hunt_id)
-                
-                # Check if the hunt is completed
-                hunt_status = hunt_details.get('status', '').upper()
-                if hunt_status != "COMPLETED":
-                    # Add a status field to the hunt to warn the user
-                    hunt_copy['status_warning'] = f'Hunt has status "{hunt_status}" (not COMPLETED)'
-                    logger.warning(f"Hunt {hunt_id} has status {hunt_status}, not COMPLETED")
-                else:
-                    # Only add timeframe data if hunt is completed
-                    timeframe = analyzer.parse_timeframe(hunt_details)
-                    if timeframe:
-                        hunt_copy['timeframe'] = timeframe
-                        logger.debug(f"Added timeframe to hunt {hunt_id}")
-                    
-                    # Add MQL source if not already present
-                    if 'mql_source' not in hunt_copy:
-                        mql_source = hunt_details.get('source', '')
-                        if mql_source:
-                            hunt_copy['mql_source'] = mql_source
-                            logger.debug(f"Added MQL source to hunt {hunt_id}")
-            except Exception as e:
-                # Continue if we can't get the timeframe
-                logger.error(f"Error fetching timeframe for hunt {hunt_id}: {str(e)}")
-                pass
+        # Check if the hunt is completed
+        hunt_status = hunt_details.get('status', '').upper()
+        if hunt_status != "COMPLETED":
+            # Add a status field to the hunt to warn the user
+            updates['status_warning'] = f'Hunt has status "{hunt_status}" (not COMPLETED)'
+            logger.warning("Hunt %s has status %s, not COMPLETED", hunt_id, hunt_status)
+        else:
+            # Only add timeframe data if hunt is completed
+            timeframe = analyzer.parse_timeframe(hunt_details)
+            if timeframe:
+                updates['timeframe'] = timeframe
+                logger.debug("Added timeframe to hunt %s", hunt_id)
+            
+            # Add MQL source if not already present
+            if 'mql_source' not in hunt:
+                mql_source = hunt_details.get('source', '')
+                if mql_source:
+                    updates['mql_source'] = mql_source
+                    logger.debug("Added MQL source to hunt %s", hunt_id)
         
-        updated_hunts.append(hunt_copy)
+        if updates:
+            store.update_hunt(hunt_id, updates)
     
-    # Compare before and after stats
-    for hunt_id in hunt_stats_before:
-        before = hunt_stats_before[hunt_id]
-        after = hunt_stats_after[hunt_id]
+    # Fix any message references to deleted hunts and verify the maintained stats against a recount
+    logger.info("Reconciling %s hunts", 'all' if full else 'changed')
+    fixed_ref_count, removed_msg_count, drift = store.reconcile(full=full)
+    logger.info("Fixed %s message references and removed %s orphaned messages", fixed_ref_count, removed_msg_count)
+    if drift:
+        logger.info("Repaired stats of %s hunts", len(drift))
+    
+    # Compare before and after stats, skipping hunts imported while the reprocess ran
+    for after in store.get_hunts():
+        before = hunt_stats_before.get(after['id'])
+        if before is None:
+            continue
         
         # Log only if there were changes
-        if (before['tp_count'] != after['tp_count'] or
-            before['fp_count'] != after['fp_count'] or
-            before['pre_labeled_count'] != after['pre_labeled_count'] or
-            before['unlabeled_count'] != after['unlabeled_count']):
-            
-            logger.info(f"Hunt {hunt_id} ({after['name']}) stats changed:")
-            logger.info(f"  TP count: {before['tp_count']} -> {after['tp_count']}")
-            logger.info(f"  FP count: {before['fp_count']} -> {after['fp_count']}")
-            logger.info(f"  Pre-labeled: {before['pre_labeled_count']} -> {after['pre_labeled_count']}")
-            logger.info(f"  Unlabeled: {before['unlabeled_count']} -> {after['unlabeled_count']}")
-    
-    # Fix any message references to deleted hunts
-    logger.info("Fixing message references to deleted hunts")
-    fixed_ref_count = 0
-    removed_msg_count = 0
-    
-    for msg_id in list(true_positives.keys()):
-        if msg_id in message_hunt_map:
-            # If the message exists but references a non-existent hunt
-            ref_hunt_id = true_positives[msg_id]['hunt_id']
-            if ref_hunt_id not in hunt_results_cache:
-                # Assign to the first hunt where it appears
-                new_hunt_id = message_hunt_map[msg_id][0]
-                logger.info(f"TP message {msg_id} referenced deleted hunt {ref_hunt_id}, reassigning to {new_hunt_id}")
-                true_positives[msg_id]['hunt_id'] = new_hunt_id
-                fixed_ref_count += 1
-        else:
-            # If the message doesn't exist in any hunt, remove it
-            logger.info(f"Removing TP message {msg_id} as it doesn't exist in any hunt")
-            del true_positives[msg_id]
-            removed_msg_count += 1
-    
-    for msg_id in list(false_positives.keys()):
-        if msg_id in message_hunt_map:
-            # If the message exists but references a non-existent hunt
-            ref_hunt_id = false_positives[msg_id]['hunt_id']
-            if ref_hunt_id not in hunt_results_cache:
-                # Assign to the first hunt where it appears
-                new_hunt_id = message_hunt_map[msg_id][0]
-                logger.info(f"FP message {msg_id} referenced deleted hunt {ref_hunt_id}, reassigning to {new_hunt_id}")
-                false_positives[msg_id]['hunt_id'] = new_hunt_id
-                fixed_ref_count += 1
-        else:
-            # If the message doesn't exist in any hunt, remove it
-            logger.info(f"Removing FP message {msg_id} as it doesn't exist in any hunt")
-            del false_positives[msg_id]
-            removed_msg_count += 1
-    
-    logger.info(f"Fixed {fixed_ref_count} message references and removed {removed_msg_count} orphaned messages")
-    
-    # Save updated data
-    data['hunts'] = updated_hunts
-    data['true_positives'] = true_positives
-    data['false_positives'] = false_positives
-    save_data(data)
+        changed_fields = [field for field in ('true_positives_count', 'false_positives_count', 'pre_labeled_count', 'unlabeled_count')
+                          if before.get(field, 0) != after.get(field, 0)]
+        if changed_fields:
+            logger.info("Hunt %s (%s) stats changed:", after['id'], after.get('name', 'Unknown'))
+            for field in changed_fields:
+                logger.info("  %s: %s -> %s", field, before.get(field, 0), after.get(field, 0))
     
     logger.info("Reprocess completed successfully")
     return True
@@ -502,27 +2763,30 @@ def reprocess_samples():
     
     username = session['username']
     
-    # Load data
-    data = load_data(username)
-    hunts = data.get('hunts', [])
+    store = get_store(username)
     
-    if not hunts:
+    if not store.get_hunts():
         flash('No hunts to reprocess', 'warning')
         return redirect(url_for('hunts'))
     
-    try:
-        analyzer = HuntAnalyzer(session['api_token'])
-        if reprocess_samples_internal(analyzer, data):
-            # Save with the username
-            save_data(data, username)
-            flash('Samples reprocessed successfully. Hunt stats have been updated.', 'success')
-        else:
-            flash('No hunts to reprocess', 'warning')
-        return redirect(url_for('hunts'))
-    except Exception as e:
-        flash(f'Error reprocessing samples: {str(e)}', 'danger')
+    if store.get_active_jobs(kind='reprocess'):
+        flash('Samples are already being reprocessed', 'warning')
         return redirect(url_for('hunts'))
     
+    refresh = request.form.get('refresh') == 'on'
+    full = request.form.get('full') == 'on'
+    submit_job(username, 'reprocess', reprocess_job, session['api_token'], refresh, full,
+               message='Waiting to reprocess samples')
+    flash('Reprocessing samples in the background. Hunt stats will update when it finishes.', 'info')
+    return redirect(url_for('hunts'))
+
+def reprocess_job(store, progress, api_token, refresh, full):
+    """Background job that reprocesses all samples."""
+    analyzer = get_analyzer(store.username, api_token)
+    if not reprocess_samples_internal(analyzer, store, refresh=refresh, full=full, progress=progress):
+        return 'No hunts to reprocess'
+    return 'Samples reprocessed successfully. Hunt stats have been updated.'
+    
 @app.route('/clear_data', methods=['POST'])
 def clear_data():
     """Clear all hunt data and reset the application."""
@@ -533,12 +2797,10 @@ def clear_data():
     username = session['username']
     
     # Reset data to empty state
-    empty_data = {
-        'hunts': [],
-        'true_positives': {},
-        'false_positives': {}
-    }
-    save_data(empty_data, username)
+    get_store(username).clear()
+    
+    # Remove cached hunt results as well
+    shutil.rmtree(get_results_cache_dir(username), ignore_errors=True)
     
     flash('All hunt data has been cleared successfully!', 'success')
     return redirect(url_for('hunts'))
@@ -551,94 +2813,45 @@ def delete_hunt(hunt_id):
         return redirect(url_for('index'))
     
     username = session['username']
-    
-    # Load data
-    data = load_data(username)
-    hunts = data.get('hunts', [])
-    true_positives = data.get('true_positives', {})
-    false_positives = data.get('false_positives', {})
+    store = get_store(username)
     
     # Find the hunt to delete
-    hunt_to_delete = next((h for h in hunts if h['id'] == hunt_id), None)
+    hunt_to_delete = store.get_hunt(hunt_id)
     
     if not hunt_to_delete:
         flash('Hunt not found', 'danger')
         return redirect(url_for('hunts'))
     
-    # Remove the hunt from the list
-    data['hunts'] = [h for h in hunts if h['id'] != hunt_id]
+    if store.get_active_jobs(kind='delete', hunt_id=hunt_id):
+        flash(f'Hunt "{hunt_to_delete["name"]}" is already being deleted', 'warning')
+        return redirect(url_for('hunts'))
     
-    # Check which hunts remain (to preserve shared samples)
-    remaining_hunt_ids = [h['id'] for h in data['hunts']]
+    submit_job(username, 'delete', delete_hunt_job, session['api_token'], hunt_id,
+               hunt_id=hunt_id, message=f'Waiting to delete hunt "{hunt_to_delete["name"]}"')
+    flash(f'Deleting hunt "{hunt_to_delete["name"]}" in the background.', 'info')
+    return redirect(url_for('hunts'))
+
+def delete_hunt_job(store, progress, api_token, hunt_id):
+    """Background job that deletes a hunt, keeping labels of messages that appear in other hunts."""
+    hunt_to_delete = store.get_hunt(hunt_id)
+    if not hunt_to_delete:
+        raise Exception('Hunt not found')
     
-    try:
-        analyzer = HuntAnalyzer(session['api_token'])
-        
-        # Create a cache of hunt results to avoid repeated API calls
-        hunt_results_cache = {}
-        
-        # Get the results for the hunt being deleted
-        hunt_results_cache[hunt_id] = analyzer.get_hunt_results(hunt_id)
-        message_ids = [msg['id'] for msg in hunt_results_cache[hunt_id]]
-        
-        # Build a lookup map of which messages appear in which remaining hunts
-        message_hunt_map = {}
-        
-        # Fetch all remaining hunt results in one batch to minimize API calls
-        for other_hunt_id in remaining_hunt_ids:
-            hunt_results_cache[other_hunt_id] = analyzer.get_hunt_results(other_hunt_id)
-            
-            # Map each message ID to this hunt
-            for msg in hunt_results_cache[other_hunt_id]:
-                if msg['id'] not in message_hunt_map:
-                    message_hunt_map[msg['id']] = []
-                message_hunt_map[msg['id']].append(other_hunt_id)
-        
-        # Find messages that were labeled in this hunt
-        hunt_labeled_messages = []
-        for msg_id in true_positives:
-            if true_positives[msg_id]['hunt_id'] == hunt_id:
-                hunt_labeled_messages.append(msg_id)
-                
-        for msg_id in false_positives:
-            if false_positives[msg_id]['hunt_id'] == hunt_id:
-                hunt_labeled_messages.append(msg_id)
-        
-        # Only process messages that were labeled in this hunt (more efficient)
-        for msg_id in hunt_labeled_messages:
-            # Check if this message appears in other remaining hunts
-            other_hunts_with_msg = message_hunt_map.get(msg_id, [])
-            message_in_other_hunts = len(other_hunts_with_msg) > 0
-            
-            # If message is not in other hunts, remove its categorization
-            if not message_in_other_hunts:
-                if msg_id in true_positives and true_positives[msg_id]['hunt_id'] == hunt_id:
-                    del true_positives[msg_id]
-                if msg_id in false_positives and false_positives[msg_id]['hunt_id'] == hunt_id:
-                    del false_positives[msg_id]
-            
-            # If message is in other hunts but was categorized in this hunt,
-            # update the hunt_id reference to one of the remaining hunts
-            else:
-                if msg_id in true_positives and true_positives[msg_id]['hunt_id'] == hunt_id:
-                    # Use the first hunt where this message appears
-                    true_positives[msg_id]['hunt_id'] = other_hunts_with_msg[0]
-                
-                if msg_id in false_positives and false_positives[msg_id]['hunt_id'] == hunt_id:
-                    # Use the first hunt where this message appears
-                    false_positives[msg_id]['hunt_id'] = other_hunts_with_msg[0]
-        
-        # Save updated data
-        data['true_positives'] = true_positives
-        data['false_positives'] = false_positives
-        save_data(data, username)
-        
-        flash(f'Hunt "{hunt_to_delete["name"]}" has been deleted successfully!', 'success')
-        return redirect(url_for('hunts'))
+    analyzer = get_analyzer(store.username, api_token)
     
-    except Exception as e:
-        flash(f'Error deleting hunt: {str(e)}', 'danger')
-        return redirect(url_for('hunts'))
+    # Labels are reassigned using the membership index, so only hunts that
+    # haven't been indexed yet need their results loaded
+    index_hunt_members(analyzer, store, progress=progress)
+    
+    # Remove the hunt, moving labels that appear in other hunts to the first of them
+    progress(message=f'Deleting hunt "{hunt_to_delete["name"]}"')
+    reassigned_count, removed_count = store.delete_hunt(hunt_id)
+    logger.info("Deleted hunt %s: reassigned %s labels and removed %s labels", hunt_id, reassigned_count, removed_count)
+    
+    # The deleted hunt's results are no longer needed
+    analyzer.delete_cached_results(hunt_id)
+    
+    return f'Hunt "{hunt_to_delete["name"]}" has been deleted successfully!'
 
 @app.route('/add_hunt', methods=['POST'])
 def add_hunt():
@@ -652,143 +2865,340 @@ def add_hunt():
     hunt_id = request.form.get('hunt_id', '').strip()
     hunt_name = request.form.get('hunt_name', '').strip()
     
-    logger.info(f"User {username} adding new hunt ID: {hunt_id}, Name: {hunt_name}")
+    logger.info("User %s adding new hunt ID: %s, Name: %s", username, hunt_id, hunt_name)
     
     if not hunt_id or not hunt_name:
         logger.warning("Hunt ID or name is missing")
         flash('Hunt ID and name are required', 'danger')
         return redirect(url_for('hunts'))
     
-    # Load data
-    data = load_data(username)
-    hunts = data.get('hunts', [])
+    store = get_store(username)
     
     # Check if this hunt was already added
-    for hunt in hunts:
-        if hunt['id'] == hunt_id:
-            logger.warning(f"Hunt {hunt_id} already exists as '{hunt['name']}'")
-            flash(f'This hunt has already been added as "{hunt["name"]}"', 'warning')
-            return redirect(url_for('hunts'))
+    hunt = store.get_hunt(hunt_id)
+    if hunt:
+        logger.warning("Hunt %s already exists as '%s'", hunt_id, hunt['name'])
+        flash(f'This hunt has already been added as "{hunt["name"]}"', 'warning')
+        return redirect(url_for('hunts'))
     
-    # Add the hunt to data
+    if store.get_active_jobs(kind='import', hunt_id=hunt_id):
+        flash('This hunt is already being imported', 'warning')
+        return redirect(url_for('hunts'))
+    
+    # Fetching and labeling a large hunt takes minutes, so do it in the background
+    submit_job(username, 'import', import_hunt_job, session['api_token'], hunt_id, hunt_name,
+               hunt_id=hunt_id, message=f'Waiting to import hunt "{hunt_name}"')
+    flash(f'Importing hunt "{hunt_name}" in the background.', 'info')
+    return redirect(url_for('hunts'))
+
+def import_hunt_job(store, progress, api_token, hunt_id, hunt_name):
+    """Background job that fetches a new hunt's results, auto-labels them and adds the hunt."""
+    existing_hunt = store.get_hunt(hunt_id)
+    if existing_hunt:
+        raise Exception(f'This hunt has already been added as "{existing_hunt["name"]}"')
+    
+    analyzer = get_analyzer(store.username, api_token)
+    
+    # Get hunt details including timeframe and status, also used to cache the results
     try:
-        logger.info(f"Fetching hunt results for {hunt_id}")
-        analyzer = HuntAnalyzer(session['api_token'])
-        results = analyzer.get_hunt_results(hunt_id)
-        logger.info(f"Retrieved {len(results)} samples for hunt {hunt_id}")
-        
-        true_positives = data.get('true_positives', {})
-        false_positives = data.get('false_positives', {})
-        
-        logger.debug(f"Current database contains {len(true_positives)} true positives and {len(false_positives)} false positives")
-        
-        # Get hunt details including timeframe and status
-        try:
-            hunt_details = analyzer.get_hunt_details(hunt_id)
-            
-            # Check if the hunt is completed
-            hunt_status = hunt_details.get('status', '').upper()
-            logger.info(f"Hunt {hunt_id} status: {hunt_status}")
-            
-            if hunt_status != "COMPLETED":
-                logger.warning(f"Hunt {hunt_id} has status {hunt_status}, not COMPLETED")
-                flash(f'This hunt has status "{hunt_status}" and is not ready for analysis yet. Only import hunts with "COMPLETED" status.', 'danger')
-                return redirect(url_for('hunts'))
-            
-            # Extract MQL source
-            mql_source = hunt_details.get('source', '')
-            logger.debug(f"Hunt MQL source: {mql_source}")
-                
-            timeframe = analyzer.parse_timeframe(hunt_details)
-            logger.debug(f"Hunt timeframe: {timeframe}")
-        except Exception as e:
-            # If we can't get the timeframe, continue without it
-            timeframe = None
-            mql_source = ''
-            logger.error(f"Error getting hunt details: {str(e)}")
-        
-        # Auto-label samples that match existing true/false positives
-        tp_count = 0
-        fp_count = 0
-        
-        # Keep track of auto-labeled samples for logging
-        auto_labeled_samples = {'tp': [], 'fp': []}
-        
-        for message_group in results:
-            msg_id = message_group['id']
-            
-            # Check if this message is already in true_positives
-            if msg_id in true_positives:
-                tp_count += 1
-                auto_labeled_samples['tp'].append({
-                    'id': msg_id,
-                    'subject': analyzer.get_subject_from_message_group(message_group),
-                    'original_hunt': true_positives[msg_id]['hunt_id']
-                })
-            # Check if this message is already in false_positives
-            elif msg_id in false_positives:
-                fp_count += 1
-                auto_labeled_samples['fp'].append({
-                    'id': msg_id,
-                    'subject': analyzer.get_subject_from_message_group(message_group),
-                    'original_hunt': false_positives[msg_id]['hunt_id']
-                })
-        
-        logger.info(f"Auto-labeled {tp_count} true positives and {fp_count} false positives")
-        logger.debug(f"Auto-labeled TP samples: {auto_labeled_samples['tp']}")
-        logger.debug(f"Auto-labeled FP samples: {auto_labeled_samples['fp']}")
-        
-        hunt_data = {
-            'id': hunt_id,
-            'name': hunt_name,
-            'total_samples': len(results),
-            'true_positives_count': tp_count,
-            'false_positives_count': fp_count,
-            'pre_labeled_count': tp_count + fp_count,  # Keep track of pre-labeled count
-            'date_added': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'mql_source': mql_source  # Store the MQL source
-        }
-        
-        # Add timeframe if available
-        if timeframe:
-            hunt_data['timeframe'] = timeframe
-        
-        hunts.append(hunt_data)
+        hunt_details = analyzer.get_hunt_details(hunt_id)
+    except Exception as e:
+        # If we can't get the details, continue without them
+        hunt_details = None
+        logger.error("Error getting hunt details: %s", e)
+    
+    # Add the hunt to data
+    logger.info("Fetching hunt results for %s", hunt_id)
+    progress(message=f'Fetching results of hunt "{hunt_name}"')
+    # Only the normalized records of the results are kept, one page of raw results at a time
+    records = list(analyzer.iter_hunt_records(hunt_id, progress=progress, hunt_details=hunt_details))
+    logger.info("Retrieved %s samples for hunt %s", len(records), hunt_id)
+    
+    progress(message=f'Labeling samples of hunt "{hunt_name}"')
+    pre_labeled = add_imported_hunt(analyzer, store, hunt_id, hunt_name, records, hunt_details)
+    
+    # Only the new hunt's stats changed, so a consolidated pass replaces a full reprocess
+    finish_hunt_imports(analyzer, store, progress=progress)
+    
+    if pre_labeled > 0:
+        return (f'Hunt "{hunt_name}" added successfully with {len(records)} samples. ' + 
+                f'{pre_labeled} samples were automatically labeled based on your previous decisions.')
+    return f'Hunt "{hunt_name}" added successfully with {len(records)} samples.'
+
+def add_imported_hunt(analyzer, store, hunt_id, hunt_name, records, hunt_details):
+    """Auto-label a fetched hunt's samples against existing labels and store the hunt.
+    
+    hunt_details may be None if they couldn't be fetched. Raises if the hunt has
+    already been added or isn't completed. Returns the number of auto-labeled samples.
+    """
+    existing_hunt = store.get_hunt(hunt_id)
+    if existing_hunt:
+        raise Exception(f'This hunt has already been added as "{existing_hunt["name"]}"')
+    
+    hunt_status = None
+    timeframe = None
+    mql_source = ''
+    if hunt_details is not None:
+        hunt_status = hunt_details.get('status', '').upper()
+        logger.info("Hunt %s status: %s", hunt_id, hunt_status)
         
-        data['hunts'] = hunts
-        save_data(data, username)
-        logger.info(f"Hunt {hunt_id} added to database with {len(results)} samples")
+        # Extract MQL source
+        mql_source = hunt_details.get('source', '')
+        logger.debug("Hunt MQL source: %s", mql_source)
         
-        pre_labeled = tp_count + fp_count
-        new_samples = len(results) - pre_labeled
+        timeframe = analyzer.parse_timeframe(hunt_details)
+        logger.debug("Hunt timeframe: %s", timeframe)
+    
+    # Check if the hunt is completed
+    if hunt_status and hunt_status != "COMPLETED":
+        logger.warning("Hunt %s has status %s, not COMPLETED", hunt_id, hunt_status)
+        raise Exception(f'This hunt has status "{hunt_status}" and is not ready for analysis yet. Only import hunts with "COMPLETED" status.')
+    
+    # Look up existing labels for just the messages in this hunt
+    existing_labels = store.get_label_map(record.id for record in records)
+    logger.debug("%s of the hunt's samples are already labeled", len(existing_labels))
+    
+    # Auto-label samples that match existing true/false positives
+    tp_count = 0
+    fp_count = 0
+    
+    # Log a few of the auto-labeled samples rather than all of them
+    sampled_log = LogSampler(logger)
+    
+    for record in records:
+        label = existing_labels.get(record.id)
         
-        if pre_labeled > 0:
-            flash(f'Hunt "{hunt_name}" added successfully with {len(results)} samples. ' + 
-                  f'{pre_labeled} samples were automatically labeled based on your previous decisions.', 'success')
+        # Check if this message is already a true or false positive
+        if label and label['category'] == 'true_positive':
+            tp_count += 1
+        elif label and label['category'] == 'false_positive':
+            fp_count += 1
         else:
-            flash(f'Hunt "{hunt_name}" added successfully with {len(results)} samples.', 'success')
-        
-        # After adding a hunt, reprocess all samples to ensure consistent labeling
-        try:
-            logger.info("Running reprocess_samples_internal after adding hunt")
-            # We already have an analyzer instance
-            reprocess_result = reprocess_samples_internal(analyzer, data)
-            if reprocess_result:
-                save_data(data, username)
-            logger.info(f"Reprocess completed, result: {reprocess_result}")
-        except Exception as e:
-            logger.error(f"Error reprocessing samples after adding hunt: {str(e)}", exc_info=True)
-        
-        return redirect(url_for('analyze_hunt', hunt_id=hunt_id))
+            continue
+        sampled_log.debug("Auto-labeled %s (%r) as %s from hunt %s", record.id, record.subject, label['category'], label['hunt_id'])
+    
+    sampled_log.summarize()
+    logger.info("Auto-labeled %s true positives and %s false positives", tp_count, fp_count)
+    
+    hunt_data = {
+        'id': hunt_id,
+        'name': hunt_name,
+        'total_samples': len(records),
+        'true_positives_count': tp_count,
+        'false_positives_count': fp_count,
+        'pre_labeled_count': tp_count + fp_count,  # Keep track of pre-labeled count
+        'date_added': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'mql_source': mql_source  # Store the MQL source
+    }
+    
+    # Add timeframe if available
+    if timeframe:
+        hunt_data['timeframe'] = timeframe
+    
+    try:
+        store.add_hunt(hunt_data)
+    except sqlite3.IntegrityError:
+        # Another import added the hunt while this one was fetching its results
+        existing_hunt = store.get_hunt(hunt_id)
+        raise Exception(f'This hunt was added as "{existing_hunt["name"] if existing_hunt else hunt_name}" by another import while it was being imported')
+    store_hunt_records(analyzer, store, hunt_id, records)
+    logger.info("Hunt %s added to database with %s samples", hunt_id, len(records))
+    return tp_count + fp_count
+
+def finish_hunt_imports(analyzer, store, progress=None):
+    """Run one consolidated stats pass after hunts have been imported.
+    
+    Adding a hunt doesn't change any other hunt's stats, so unlike a reprocess this
+    doesn't fetch any hunt's details. Only hunts that were never indexed are indexed,
+    and only the hunts flagged dirty, such as the imported ones, are reconciled.
+    """
+    if progress:
+        progress(message='Updating hunt stats')
+    try:
+        index_hunt_members(analyzer, store, progress=progress)
+        fixed_ref_count, removed_msg_count, drift = store.reconcile()
+        logger.info("Fixed %s message references and removed %s orphaned messages", fixed_ref_count, removed_msg_count)
+        if drift:
+            logger.info("Repaired stats of %s hunts", len(drift))
     except Exception as e:
-        logger.error(f"Error adding hunt {hunt_id}: {str(e)}", exc_info=True)
-        flash(f'Error: {str(e)}', 'danger')
+        logger.error("Error updating hunt stats after import: %s", e, exc_info=True)
+
+def parse_hunt_list(text):
+    """Parse a pasted list or CSV of hunts into (hunt_id, hunt_name) pairs.
+    
+    Each row holds a hunt ID, optionally followed by a name; hunts without a name are
+    named after their ID. Blank rows, a header row and repeated hunt IDs are skipped.
+    """
+    hunts = []
+    seen = set()
+    for row in csv.reader(io.StringIO(text)):
+        row = [cell.strip() for cell in row]
+        if not row or not row[0] or row[0].startswith('#'):
+            continue
+        hunt_id = row[0]
+        if not hunts and hunt_id.lower() in ('id', 'hunt_id', 'hunt id'):
+            continue
+        if hunt_id in seen:
+            continue
+        seen.add(hunt_id)
+        hunt_name = ','.join(cell for cell in row[1:] if cell).strip() or hunt_id
+        hunts.append((hunt_id, hunt_name))
+    return hunts
+
+@app.route('/add_hunts', methods=['POST'])
+def add_hunts():
+    """Add several hunts at once from a pasted list or an uploaded CSV file."""
+    if 'api_token' not in session or 'username' not in session:
+        flash('Please log in first', 'warning')
+        return redirect(url_for('index'))
+    
+    username = session['username']
+    
+    text = request.form.get('hunt_list', '')
+    upload = request.files.get('hunt_file')
+    if upload and upload.filename:
+        try:
+            text += '\n' + upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            flash('The uploaded file is not a UTF-8 CSV file', 'danger')
+            return redirect(url_for('hunts'))
+    
+    hunt_list = parse_hunt_list(text)
+    if not hunt_list:
+        flash('Paste or upload at least one hunt ID', 'danger')
+        return redirect(url_for('hunts'))
+    
+    store = get_store(username)
+    
+    # Leave out hunts that were already added or are being imported on their own
+    importing_ids = {job['hunt_id'] for job in store.get_active_jobs(kind='import') if job['hunt_id']}
+    added_hunts = {hunt_id for hunt_id, _ in hunt_list if store.get_hunt(hunt_id)}
+    importing_hunts = {hunt_id for hunt_id, _ in hunt_list if hunt_id in importing_ids} - added_hunts
+    new_hunts = [(hunt_id, hunt_name) for hunt_id, hunt_name in hunt_list
+                 if hunt_id not in added_hunts and hunt_id not in importing_hunts]
+    skipped_count = len(added_hunts) + len(importing_hunts)
+    if not new_hunts:
+        flash('All of these hunts have already been added or are being imported', 'warning')
         return redirect(url_for('hunts'))
+    
+    logger.info("User %s importing %s hunts, skipping %s (%s already added, %s being imported)",
+                username, len(new_hunts), skipped_count, len(added_hunts), len(importing_hunts))
+    
+    submit_job(username, 'import', import_hunts_job, session['api_token'], new_hunts,
+               message=f'Waiting to import {len(new_hunts)} hunts')
+    message = f'Importing {len(new_hunts)} hunts in the background.'
+    if added_hunts:
+        message += f' {len(added_hunts)} hunts were skipped because they have already been added.'
+    if importing_hunts:
+        message += f' {len(importing_hunts)} hunts were skipped because they are already being imported.'
+    flash(message, 'info')
+    return redirect(url_for('hunts'))
+
+@app.errorhandler(413)
+def request_too_large(error):
+    """Reject requests over REQUEST_MAX_BYTES, showing the hunts page again for a too large hunt list."""
+    limit = f'{REQUEST_MAX_BYTES / (1024 * 1024):g} MB' if REQUEST_MAX_BYTES >= 1024 * 1024 else f'{REQUEST_MAX_BYTES} bytes'
+    message = f'The request is too large. Requests and uploaded files may be at most {limit}.'
+    logger.warning("Rejected a request to %s of %s bytes: over the %s byte limit", request.path, request.content_length, REQUEST_MAX_BYTES)
+    
+    if request.endpoint == 'add_hunts' and 'api_token' in session and 'username' in session:
+        flash(message, 'danger')
+        return hunts(), 413
+    return jsonify({'status': 'error', 'message': message}), 413
+
+def import_hunts_job(store, progress, api_token, hunts):
+    """Background job that imports several hunts at once.
+    
+    The details of all hunts are fetched first so that hunts that aren't completed are
+    rejected without downloading their results. Results of the remaining hunts are
+    fetched a few at a time, and each hunt is auto-labeled and stored as soon as its
+    results arrive so that only those few hunts' records are held in memory. The hunts
+    are put back in the order they were listed at the end, followed by one consolidated
+    stats pass. A hunt that fails to import doesn't stop the others.
+    """
+    analyzer = get_analyzer(store.username, api_token)
+    hunt_names = dict(hunts)
+    failed = {}
+    
+    progress(0, len(hunts), f'Checking the status of {len(hunts)} hunts')
+    hunt_details = {}
+    for hunt_id, details, error in analyzer.get_many_hunt_details(hunt_names):
+        if error:
+            # Continue without the details, as importing a single hunt does
+            logger.error("Error getting details of hunt %s: %s", hunt_id, error)
+            hunt_details[hunt_id] = None
+        elif details.get('status', '').upper() not in ('', 'COMPLETED'):
+            logger.warning("Hunt %s has status %s, not COMPLETED", hunt_id, details['status'])
+            failed[hunt_id] = f'status "{details["status"].upper()}"'
+        else:
+            hunt_details[hunt_id] = details
+    
+    pending_ids = [hunt_id for hunt_id in hunt_names if hunt_id in hunt_details]
+    imported = []
+    pre_labeled = 0
+    
+    for done, (hunt_id, records, error) in enumerate(analyzer.get_many_hunt_records(pending_ids, hunt_details=hunt_details), 1):
+        if error:
+            logger.error("Error fetching results of hunt %s: %s", hunt_id, error)
+            failed[hunt_id] = str(error)
+        else:
+            try:
+                pre_labeled += add_imported_hunt(analyzer, store, hunt_id, hunt_names[hunt_id], records, hunt_details[hunt_id])
+                imported.append(hunt_id)
+            except Exception as e:
+                logger.error("Error importing hunt %s: %s", hunt_id, e)
+                failed[hunt_id] = str(e)
+        # Drop the records before waiting for the next hunt
+        records = None
+        
+        progress(done, len(pending_ids), f'Imported {len(imported)} of {len(hunts)} hunts')
+    
+    if imported:
+        store.set_hunt_order([hunt_id for hunt_id in pending_ids if hunt_id in imported])
+        finish_hunt_imports(analyzer, store, progress=progress)
+    
+    for hunt_id, reason in failed.items():
+        logger.warning('Hunt %s ("%s") was not imported: %s', hunt_id, hunt_names[hunt_id], reason)
+    
+    if not imported:
+        raise Exception(f'None of the {len(hunts)} hunts could be imported. '
+                        f'Failed hunts: {", ".join(hunt_names[hunt_id] for hunt_id in failed)}')
+    
+    message = f'{len(imported)} hunts added successfully.'
+    if pre_labeled > 0:
+        message += f' {pre_labeled} samples were automatically labeled based on your previous decisions.'
+    if failed:
+        message += f' {len(failed)} hunts could not be imported: {", ".join(hunt_names[hunt_id] for hunt_id in failed)}.'
+    return message
+
+@app.route('/jobs')
+def jobs():
+    """Get the user's queued and running background jobs."""
+    if 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    return jsonify({'status': 'success', 'jobs': get_store(session['username']).get_active_jobs()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Get the status and progress of a background job."""
+    if 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    job = get_store(session['username']).get_job(job_id)
+    if not job:
+        return jsonify({'status': 'error', 'message': 'Job not found'})
+    
+    return jsonify({'status': 'success', 'job': job})
 
 @app.route('/analyze/<hunt_id>')
 def analyze_hunt(hunt_id):
-    """Analyze a specific hunt."""
-    logger.info(f"Analyzing hunt {hunt_id}")
+    """Analyze a specific hunt.
+    
+    Only the hunt's stats are rendered here; the message list is loaded page by page
+    from api_hunt_messages.
+    """
+    logger.info("Analyzing hunt %s", hunt_id)
     
     if 'api_token' not in session or 'username' not in session:
         logger.warning("Not logged in, redirecting to index")
@@ -796,210 +3206,274 @@ def analyze_hunt(hunt_id):
         return redirect(url_for('index'))
     
     username = session['username']
-    
-    # Load data
-    data = load_data(username)
+    store = get_store(username)
     
     # Find the hunt
-    hunt = next((h for h in data.get('hunts', []) if h['id'] == hunt_id), None)
+    hunt = store.get_hunt(hunt_id)
     
     if not hunt:
-        logger.warning(f"Hunt {hunt_id} not found")
+        logger.warning("Hunt %s not found", hunt_id)
         flash('Hunt not found', 'danger')
         return redirect(url_for('hunts'))
     
-    logger.info(f"User {username} analyzing hunt {hunt_id}: {hunt.get('name', 'Unknown')}")
-    logger.debug(f"Hunt details: {hunt}")
+    logger.info("User %s analyzing hunt %s: %s", username, hunt_id, hunt.get('name', 'Unknown'))
+    logger.debug("Hunt details: %s", hunt)
+    
+    show_all_messages = request.args.get('show_all', '0') == '1'
+    
+    # Refetch the hunt's results and update its membership, then show the fresh results
+    if request.args.get('refresh', '0') == '1':
+        try:
+            analyzer = get_analyzer(username, session['api_token'])
+            index_hunt_results(analyzer, store, hunt_id, refresh=True)
+        except Exception as e:
+            flash(f'Error: {str(e)}', 'danger')
+            return redirect(url_for('hunts'))
+        return redirect(url_for('analyze_hunt', hunt_id=hunt_id, show_all=1 if show_all_messages else 0))
+    
+    # Hunts without a membership index only have the counts stored when they were added
+    counts_mismatch = not store.is_indexed(hunt_id)
+    if counts_mismatch:
+        logger.warning("Hunt %s has no membership index, its stored counts may be inaccurate", hunt_id)
+        apply_stored_counts(hunt)
+    
+    # Mark that the hunt was viewed, so we remember the user's preference
+    if 'pre_labeled_viewed' not in hunt:
+        store.update_hunt(hunt_id, {'pre_labeled_viewed': True})
+        logger.info("Marked hunt %s as viewed for the first time", hunt_id)
+    
+    return render_template('analyze.html', 
+                          hunt=hunt, 
+                          counts_mismatch=counts_mismatch, 
+                          show_all_messages=show_all_messages,
+                          rule_filter=request.args.get('rule', ''),
+                          username=username)
+
+def apply_stored_counts(hunt):
+    """Derive the analyze view's counts of a hunt without maintained stats from its stored counts."""
+    return LabelStore.apply_stats(hunt, {
+        'total': hunt.get('total_samples', 0),
+        'tp': hunt.get('true_positives_count', 0),
+        'fp': hunt.get('false_positives_count', 0),
+        'pre_labeled': hunt.get('pre_labeled_count', 0)
+    })
+
+def get_hunt_stats(store, hunt):
+    """Get the counts shown by the analyze view for a hunt."""
+    if not store.is_indexed(hunt['id']):
+        apply_stored_counts(hunt)
+    return {field: hunt.get(field, 0) for field in (
+        'total_samples', 'true_positives_count', 'false_positives_count', 'pre_labeled_count',
+        'unlabeled_count', 'total_new_samples', 'labeled_new_samples'
+    )}
+
+# Sort keys of the analyze view's columns, applied to (record, status, pre_labeled) tuples
+VERDICT_PRIORITY = {'malicious': 1, 'spam': 2, 'suspicious': 3, 'likely_benign': 4, 'graymail': 5, 'unknown': 6}
+STATUS_PRIORITY = {'true_positive': 1, 'false_positive': 2, 'unlabeled': 3}
+MESSAGE_SORT_KEYS = {
+    'attack_score': lambda msg: VERDICT_PRIORITY.get(msg[0].verdict, 999),
+    'status': lambda msg: STATUS_PRIORITY[msg[1]],
+    'subject': lambda msg: (msg[0].subject or '').lower(),
+    'sender': lambda msg: (msg[0].sender or '').lower(),
+    'rules': lambda msg: msg[0].rules_count,
+    'date': lambda msg: msg[0].date or '',
+    # Clusters are numbered by decreasing size
+    'cluster': lambda msg: msg[0].cluster_id if msg[0].cluster_id is not None else math.inf
+}
+
+def query_hunt_messages(records, labels, hunt_id, args):
+    """Filter and sort a hunt's records by the query parameters of api_hunt_messages.
+    
+    labels maps message IDs to their (category, hunt_id). Returns (record, status,
+    pre_labeled) tuples.
+    """
+    statuses = {value for value in args.get('status', '').split(',') if value}
+    verdicts = {value for value in args.get('verdict', '').split(',') if value}
+    pre_labeled_filter = args.get('pre_labeled', '')
+    sender_domain = args.get('sender_domain', '').strip().lower()
+    rule = args.get('rule', '').strip().lower()
+    cluster = args.get('cluster', type=int)
+    
+    messages = []
+    for record in records:
+        label = labels.get(record.id)
+        status = label[0] if label else 'unlabeled'
+        pre_labeled = label is not None and label[1] != hunt_id
+        
+        if statuses and status not in statuses and not ('labeled' in statuses and label):
+            continue
+        if pre_labeled_filter and pre_labeled != (pre_labeled_filter == '1'):
+            continue
+        if verdicts and record.verdict not in verdicts:
+            continue
+        if sender_domain and record.sender_domain != sender_domain:
+            continue
+        if rule and not any(rule in rule_name.lower() for rule_name in record.rule_names):
+            continue
+        if cluster is not None and record.cluster_id != cluster:
+            continue
+        
+        messages.append((record, status, pre_labeled))
+    
+    sort = args.get('sort', 'attack_score')
+    if sort in MESSAGE_SORT_KEYS:
+        messages.sort(key=MESSAGE_SORT_KEYS[sort], reverse=args.get('order', 'asc') == 'desc')
+    
+    return messages
+
+@app.route('/api/hunts/<hunt_id>/messages')
+def api_hunt_messages(hunt_id):
+    """Get a page of a hunt's messages with their labels.
+    
+    Query parameters:
+        offset, limit: the page to return (limit is capped at MESSAGES_MAX_PAGE_SIZE)
+        status: comma-separated true_positive, false_positive, unlabeled or labeled
+        pre_labeled: 1 for only messages labeled in other hunts, 0 to exclude them
+        verdict: comma-separated attack score verdicts
+        sender_domain: exact sender domain
+        rule: substring of a flagged rule name
+        cluster: ID of a cluster of near-duplicate messages
+        sort: attack_score, status, subject, sender, rules, date or cluster; order: asc or desc
+        ids: 1 to return the IDs of all matching messages instead of a page
+    """
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    username = session['username']
+    store = get_store(username)
+    
+    hunt = store.get_hunt(hunt_id)
+    if not hunt:
+        return jsonify({'status': 'error', 'message': 'Hunt not found'})
+    
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', MESSAGES_PAGE_SIZE)), 1), MESSAGES_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid offset or limit'})
     
-    # Get hunt results
     try:
-        analyzer = HuntAnalyzer(session['api_token'])
-        results = analyzer.get_hunt_results(hunt_id)
-        
-        # Prepare data for template
-        message_groups = []
-        true_positives = data.get('true_positives', {})
-        false_positives = data.get('false_positives', {})
-        
-        # Count for real-time accuracy
-        tp_count = 0
-        fp_count = 0
-        
-        # Check if this is the first time viewing this hunt
-        first_view = True
-        if 'pre_labeled_viewed' not in hunt:
-            # Get the show_all_messages parameter
-            show_all_messages = request.args.get('show_all', '0') == '1'
-        else:
-            # Hunt was viewed before, use the stored preference
-            first_view = False
-            show_all_messages = request.args.get('show_all', '0') == '1'
-        
-        # Process message groups
-        for message_group in results:
-            msg_id = message_group['id']
-            subject = analyzer.get_subject_from_message_group(message_group)
-            
-            # Determine if it's already categorized
-            status = None
-            pre_labeled = False
-            
-            if msg_id in true_positives:
-                status = 'true_positive'
-                tp_count += 1
-                
-                # Check if this was labeled in a different hunt
-                if true_positives[msg_id]['hunt_id'] != hunt_id:
-                    pre_labeled = True
-                    
-            elif msg_id in false_positives:
-                status = 'false_positive'
-                fp_count += 1
-                
-                # Check if this was labeled in a different hunt
-                if false_positives[msg_id]['hunt_id'] != hunt_id:
-                    pre_labeled = True
-            
-            # Skip pre-labeled messages unless show_all_messages is true
-            if pre_labeled and not show_all_messages:
-                continue
-                
-            # Create message group data
-            msg_data = {
-                'id': msg_id,
-                'subject': subject,
-                'status': status,
-                'pre_labeled': pre_labeled,
-                'message_link': f"https://platform.sublime.security/messages/{msg_id}",
-                'attack_score_verdict': message_group.get('attack_score_verdict', 'unknown')
+        analyzer = get_analyzer(username, session['api_token'])
+        records = get_cached_records(store, analyzer, hunt_id)
+    except Exception as e:
+        logger.error("Error loading messages of hunt %s: %s", hunt_id, e, exc_info=True)
+        return jsonify({'status': 'error', 'message': 'An internal error has occurred while loading the hunt\'s messages.'})
+    
+    messages = query_hunt_messages(records, get_cached_labels(store), hunt_id, request.args)
+    stats = get_hunt_stats(store, hunt)
+    
+    if request.args.get('ids') == '1':
+        return jsonify({'status': 'success', 'total': len(messages), 'ids': [record.id for record, _, _ in messages], 'stats': stats})
+    
+    cluster_sizes = get_cluster_sizes(records)
+    page = [dict(record.to_dict(), status=status, pre_labeled=pre_labeled, cluster_size=cluster_sizes.get(record.cluster_id, 1))
+            for record, status, pre_labeled in messages[offset:offset + limit]]
+    return jsonify({
+        'status': 'success',
+        'total': len(messages),
+        'offset': offset,
+        'limit': limit,
+        'messages': page,
+        'stats': stats
+    })
+
+def get_cluster_sizes(records):
+    """Count the records of each cluster, keyed by cluster ID."""
+    sizes = {}
+    for record in records:
+        sizes[record.cluster_id] = sizes.get(record.cluster_id, 0) + 1
+    return sizes
+
+def summarize_clusters(records, labels, hunt_id):
+    """Summarize the clusters of a hunt's records with their label counts, largest first.
+    
+    labels maps message IDs to their (category, hunt_id). Each cluster is described by
+    its first record.
+    """
+    clusters = {}
+    for record in records:
+        cluster = clusters.get(record.cluster_id)
+        if cluster is None:
+            cluster = clusters[record.cluster_id] = {
+                'id': record.cluster_id,
+                'size': 0,
+                'true_positives': 0,
+                'false_positives': 0,
+                'unlabeled': 0,
+                'pre_labeled': 0,
+                'sender_domain': record.sender_domain,
+                'subject': record.subject,
+                'sender': record.sender
             }
-            
-            # Add sender info if available
-            # First try v1 API format
-            if message_group.get('sender_email_addresses') and len(message_group['sender_email_addresses']) > 0:
-                sender_email = message_group['sender_email_addresses'][0]
-                sender_name = "Unknown"
-                
-                # Try to get sender display name from v1 API format
-                if message_group.get('sender_display_name__info') and len(message_group['sender_display_name__info']) > 0:
-                    # Get the first display name from the info object
-                    sender_name = list(message_group['sender_display_name__info'].keys())[0]
-                # Or try from previews
-                elif message_group.get('previews') and len(message_group['previews']) > 0:
-                    sender_name = message_group['previews'][0].get('sender_display_name', 'Unknown')
-                
-                msg_data['sender'] = f"{sender_name} <{sender_email}>"
-                
-                # Get recipients from v1 format
-                if message_group.get('recipients'):
-                    recipients = message_group['recipients']
-                    msg_data['recipients'] = recipients[:3]
-                    msg_data['recipients_count'] = len(recipients)
-                
-                # Get date from v1 format
-                if message_group.get('first_created_at'):
-                    msg_data['date'] = message_group['first_created_at']
-            
-            # Fallback to v0 API format
-            elif message_group.get('messages') and len(message_group['messages']) > 0:
-                message = message_group['messages'][0]
-                sender_name = message.get('sender', {}).get('display_name', 'Unknown')
-                sender_email = message.get('sender', {}).get('email', 'unknown@example.com')
-                msg_data['sender'] = f"{sender_name} <{sender_email}>"
-                
-                recipients = [r.get('email', 'unknown@example.com') for r in message.get('recipients', [])]
-                msg_data['recipients'] = recipients[:3]
-                msg_data['recipients_count'] = len(recipients)
-                
-                msg_data['date'] = message.get('created_at', 'Unknown')
-            
-            # Add flagged rules
-            flagged_rules = message_group.get('flagged_rules', [])
-            
-            # Handle flagged rules differently based on API version
-            if flagged_rules and isinstance(flagged_rules[0], dict) and 'rule_meta' in flagged_rules[0]:
-                # v1 API format
-                msg_data['rules'] = [rule.get('rule_meta', {}).get('name', 'Unknown Rule') 
-                                    for rule in flagged_rules[:5]]
-            else:
-                # v0 API format
-                msg_data['rules'] = [rule.get('name', 'Unknown Rule') for rule in flagged_rules[:5]]
-                
-            msg_data['rules_count'] = len(flagged_rules)
-            
-            message_groups.append(msg_data)
-        
-        # Update hunt stats in memory (don't save to disk yet as this is just a view)
-        hunt_copy = hunt.copy()
-        hunt_copy['true_positives_count'] = tp_count
-        hunt_copy['false_positives_count'] = fp_count
-        hunt_copy['total_samples'] = len(results)
-        
-        # Count unlabeled messages (only messages that weren't pre-labeled from other hunts)
-        total_pre_labeled = 0
-        for message_group in results:
-            msg_id = message_group['id']
-            if msg_id in true_positives and true_positives[msg_id]['hunt_id'] != hunt_id:
-                total_pre_labeled += 1
-            elif msg_id in false_positives and false_positives[msg_id]['hunt_id'] != hunt_id:
-                total_pre_labeled += 1
-        
-        # Calculate total unlabeled messages that we care about
-        total_new_samples = len(results) - total_pre_labeled
-        labeled_new_samples = (tp_count + fp_count) - total_pre_labeled  # Only count labels from this hunt
-        hunt_copy['total_new_samples'] = total_new_samples
-        hunt_copy['labeled_new_samples'] = labeled_new_samples
-        hunt_copy['unlabeled_count'] = total_new_samples - labeled_new_samples
-        hunt_copy['pre_labeled_count'] = total_pre_labeled
-        
-        # Set the show_all_messages flag for the template
-        show_all_messages = request.args.get('show_all', '0') == '1'
-        
-        # Check if counts don't match what's stored - if so, suggest reprocessing
-        counts_mismatch = (tp_count != hunt.get('true_positives_count', 0) or 
-                           fp_count != hunt.get('false_positives_count', 0) or
-                           len(results) != hunt.get('total_samples', 0))
-        
-        if counts_mismatch:
-            logger.warning(f"Count mismatch detected for hunt {hunt_id}:")
-            logger.warning(f"  Stored TP count: {hunt.get('true_positives_count', 0)}, Actual: {tp_count}")
-            logger.warning(f"  Stored FP count: {hunt.get('false_positives_count', 0)}, Actual: {fp_count}")
-            logger.warning(f"  Stored total: {hunt.get('total_samples', 0)}, Actual: {len(results)}")
-            logger.warning(f"  Stored pre-labeled: {hunt.get('pre_labeled_count', 0)}")
-            logger.warning(f"  Stored unlabeled: {hunt.get('unlabeled_count', 0)}")
-            
-            # Log detailed information for debugging
-            labeled_msgs = set()
-            for msg in message_groups:
-                if msg.get('status') is not None:
-                    labeled_msgs.add(msg.get('id'))
-            
-            logger.debug(f"Count of message_groups with status: {len(labeled_msgs)}")
-            logger.debug(f"Total message_groups: {len(message_groups)}")
-            
-            # Check if the correct number of messages are displayed in the UI
-            if len(message_groups) != len(results) and not show_all_messages:
-                skipped_count = len(results) - len(message_groups)
-                logger.info(f"UI is filtering {skipped_count} pre-labeled messages with show_all_messages={show_all_messages}")
-        
-        # Mark that the hunt was viewed, so we remember the user's preference
-        if 'pre_labeled_viewed' not in hunt:
-            for h in data['hunts']:
-                if h['id'] == hunt_id:
-                    h['pre_labeled_viewed'] = True
-                    save_data(data, username)  # Save this flag with username
-                    break
-            logger.info(f"Marked hunt {hunt_id} as viewed for the first time")
-        
-        return render_template('analyze.html', 
-                              hunt=hunt_copy, 
-                              message_groups=message_groups, 
-                              counts_mismatch=counts_mismatch, 
-                              show_all_messages=show_all_messages,
-                              username=username)
+        
+        cluster['size'] += 1
+        label = labels.get(record.id)
+        if label is None:
+            cluster['unlabeled'] += 1
+        else:
+            cluster['true_positives' if label[0] == 'true_positive' else 'false_positives'] += 1
+            if label[1] != hunt_id:
+                cluster['pre_labeled'] += 1
+    
+    return sorted(clusters.values(), key=lambda cluster: (-cluster['size'], cluster['id']))
+
+@app.route('/api/hunts/<hunt_id>/clusters')
+def api_hunt_clusters(hunt_id):
+    """Get a page of a hunt's clusters of near-duplicate messages, largest first.
+    
+    Query parameters:
+        offset, limit: the page to return (limit is capped at MESSAGES_MAX_PAGE_SIZE)
+        min_size: leave out smaller clusters (default 2)
+        unlabeled: 1 for only clusters with unlabeled messages
+    """
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    username = session['username']
+    store = get_store(username)
+    
+    if not store.get_hunt(hunt_id):
+        return jsonify({'status': 'error', 'message': 'Hunt not found'})
+    
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', CLUSTERS_PAGE_SIZE)), 1), MESSAGES_MAX_PAGE_SIZE)
+        min_size = max(int(request.args.get('min_size', 2)), 1)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid offset, limit or min_size'})
+    
+    # Read before the records, so that clusters changed meanwhile are rejected when labeled
+    clusters_version = get_clusters_version(store, hunt_id)
+    try:
+        analyzer = get_analyzer(username, session['api_token'])
+        records = get_cached_records(store, analyzer, hunt_id)
     except Exception as e:
-        flash(f'Error: {str(e)}', 'danger')
-        return redirect(url_for('hunts'))
+        logger.error("Error loading messages of hunt %s: %s", hunt_id, e, exc_info=True)
+        return jsonify({'status': 'error', 'message': 'An internal error has occurred while loading the hunt\'s messages.'})
+    
+    clusters = [cluster for cluster in summarize_clusters(records, get_cached_labels(store), hunt_id)
+                if cluster['size'] >= min_size and (request.args.get('unlabeled') != '1' or cluster['unlabeled'])]
+    return jsonify({
+        'status': 'success',
+        'total': len(clusters),
+        'clustered_messages': sum(cluster['size'] for cluster in clusters),
+        'version': clusters_version,
+        'offset': offset,
+        'limit': limit,
+        'clusters': clusters[offset:offset + limit]
+    })
+
+def log_hunt_stats(store, msg_ids):
+    """Log the current stats of every hunt containing any of the given messages."""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    
+    for hunt_id in store.get_message_hunt_ids(msg_ids):
+        hunt = store.get_hunt(hunt_id)
+        if hunt:
+            logger.info("Hunt %s (%s) stats: TP=%s, FP=%s, pre-labeled=%s, unlabeled=%s", hunt_id, hunt.get('name', 'Unknown'),
+                        hunt.get('true_positives_count', 0), hunt.get('false_positives_count', 0),
+                        hunt.get('pre_labeled_count', 0), hunt.get('unlabeled_count', 0))
 
 @app.route('/categorize', methods=['POST'])
 def categorize():
@@ -1015,97 +3489,98 @@ def categorize():
     subject = request.form.get('subject')
     category = request.form.get('category')
     
-    logger.info(f"User {username} categorizing message {msg_id} from hunt {hunt_id} as {category}")
+    logger.info("User %s categorizing message %s from hunt %s as %s", username, msg_id, hunt_id, category)
     
     if not all([msg_id, hunt_id, subject, category]):
-        logger.warning(f"Missing parameters: msg_id={msg_id}, hunt_id={hunt_id}, subject={subject}, category={category}")
+        logger.warning("Missing parameters: msg_id=%s, hunt_id=%s, subject=%s, category=%s", msg_id, hunt_id, subject, category)
         return jsonify({'status': 'error', 'message': 'Missing required parameters'})
     
     if category not in ['true_positive', 'false_positive']:
-        logger.warning(f"Invalid category: {category}")
+        logger.warning("Invalid category: %s", category)
         return jsonify({'status': 'error', 'message': 'Invalid category'})
     
-    # Load data
-    data = load_data(username)
-    true_positives = data.get('true_positives', {})
-    false_positives = data.get('false_positives', {})
-    hunts = data.get('hunts', [])
+    store = get_store(username)
     
     # Check existing categorization status before change
-    was_tp = msg_id in true_positives
-    was_fp = msg_id in false_positives
-    previous_hunt_id = None
-    
-    if was_tp:
-        previous_hunt_id = true_positives[msg_id]['hunt_id']
-    elif was_fp:
-        previous_hunt_id = false_positives[msg_id]['hunt_id']
-    
-    logger.debug(f"Before categorization: msg_id={msg_id}, was_tp={was_tp}, was_fp={was_fp}, previous_hunt_id={previous_hunt_id}")
-    
-    # Remove from opposite category if needed
-    if category == 'true_positive' and msg_id in false_positives:
-        logger.info(f"Removing message {msg_id} from false_positives")
-        del false_positives[msg_id]
-    elif category == 'false_positive' and msg_id in true_positives:
-        logger.info(f"Removing message {msg_id} from true_positives")
-        del true_positives[msg_id]
-    
-    # Add to the correct category
-    if category == 'true_positive':
-        logger.info(f"Adding message {msg_id} to true_positives with hunt_id {hunt_id}")
-        true_positives[msg_id] = {'hunt_id': hunt_id, 'subject': subject}
-    else:
-        logger.info(f"Adding message {msg_id} to false_positives with hunt_id {hunt_id}")
-        false_positives[msg_id] = {'hunt_id': hunt_id, 'subject': subject}
+    previous_label = store.get_label(msg_id)
     
-    # Update hunt stats
-    affected_hunts = set()
-    affected_hunts.add(hunt_id)
-    if previous_hunt_id and previous_hunt_id != hunt_id:
-        affected_hunts.add(previous_hunt_id)
+    logger.debug("Before categorization: msg_id=%s, previous_label=%s", msg_id, previous_label)
     
-    hunt_stats_before = {}
-    hunt_stats_after = {}
+    # Add to the correct category, replacing the opposite category if needed.
+    # The stats of every hunt containing the message are adjusted along with the label.
+    logger.info("Labeling message %s as %s with hunt_id %s", msg_id, category, hunt_id)
+    store.set_label(msg_id, category, hunt_id, subject)
+    log_hunt_stats(store, [msg_id])
     
-    for hunt in hunts:
-        if hunt['id'] in affected_hunts:
-            hunt_id_to_update = hunt['id']
-            
-            # Store stats before update
-            hunt_stats_before[hunt_id_to_update] = {
-                'name': hunt.get('name', 'Unknown'),
-                'tp_count': hunt.get('true_positives_count', 0),
-                'fp_count': hunt.get('false_positives_count', 0)
-            }
-            
-            # Recount for this hunt
-            tp_count = sum(1 for tp in true_positives.values() if tp['hunt_id'] == hunt_id_to_update)
-            fp_count = sum(1 for fp in false_positives.values() if fp['hunt_id'] == hunt_id_to_update)
-            hunt['true_positives_count'] = tp_count
-            hunt['false_positives_count'] = fp_count
-            
-            # Store stats after update
-            hunt_stats_after[hunt_id_to_update] = {
-                'name': hunt.get('name', 'Unknown'),
-                'tp_count': tp_count,
-                'fp_count': fp_count
-            }
-            
-            logger.info(f"Updated hunt {hunt_id_to_update} ({hunt.get('name', 'Unknown')}) stats: TP {hunt_stats_before[hunt_id_to_update]['tp_count']} -> {tp_count}, FP {hunt_stats_before[hunt_id_to_update]['fp_count']} -> {fp_count}")
+    logger.info("Categorization complete for message %s as %s", msg_id, category)
+    return jsonify({'status': 'success'})
+
+@app.route('/categorize_batch', methods=['POST'])
+def categorize_batch():
+    """Label several messages of a hunt in one transaction.
+    
+    Takes a JSON body {"hunt_id": ..., "operations": [{"msg_id": ..., "category": ...}]}.
+    Operations apply in order, so a later operation on a message replaces an earlier
+    one. Messages that aren't in the hunt are reported back as failed. Returns the
+    hunt's updated stats so the client doesn't need to fetch them again.
+    """
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
     
-    # Save data
-    data['true_positives'] = true_positives
-    data['false_positives'] = false_positives
-    data['hunts'] = hunts
-    save_data(data, username)
+    username = session['username']
+    data = request.get_json(silent=True) or {}
+    hunt_id = data.get('hunt_id')
+    operations = data.get('operations')
     
-    logger.info(f"Categorization complete for message {msg_id} as {category}")
-    return jsonify({'status': 'success'})
+    if not hunt_id or not isinstance(operations, list) or not operations:
+        return jsonify({'status': 'error', 'message': 'Missing required parameters'})
+    
+    # Keep only the last operation on each message
+    categories = {}
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(operation.get('msg_id'), str):
+            return jsonify({'status': 'error', 'message': 'Invalid operation'})
+        if operation.get('category') not in ['true_positive', 'false_positive']:
+            return jsonify({'status': 'error', 'message': 'Invalid category'})
+        categories.pop(operation['msg_id'], None)
+        categories[operation['msg_id']] = operation['category']
+    
+    store = get_store(username)
+    hunt = store.get_hunt(hunt_id)
+    if not hunt:
+        return jsonify({'status': 'error', 'message': 'Hunt not found'})
+    
+    try:
+        subjects = get_hunt_subjects(store, get_analyzer(username, session['api_token']), hunt_id, categories)
+    except Exception as e:
+        logger.error("Error loading messages of hunt %s: %s", hunt_id, e, exc_info=True)
+        return jsonify({'status': 'error', 'message': 'An internal error has occurred while loading the hunt\'s messages.'})
+    
+    labels = [(msg_id, category, hunt_id, subjects[msg_id]) for msg_id, category in categories.items() if msg_id in subjects]
+    failed_ids = [msg_id for msg_id in categories if msg_id not in subjects]
+    
+    logger.info("User %s labeling %s messages of hunt %s in a batch of %s operations", username, len(labels), hunt_id, len(operations))
+    if failed_ids:
+        logger.warning("Ignoring %s messages that aren't in hunt %s: %s", len(failed_ids), hunt_id, failed_ids[:10])
+    
+    store.set_labels(labels)
+    
+    return jsonify({
+        'status': 'success',
+        'applied_count': len(labels),
+        'failed_ids': failed_ids,
+        'stats': get_hunt_stats(store, store.get_hunt(hunt_id))
+    })
 
 @app.route('/mass_categorize', methods=['POST'])
 def mass_categorize():
-    """Categorize multiple messages at once."""
+    """Categorize multiple messages at once.
+    
+    Messages are given by ID in message_ids[], or as whole clusters of near-duplicate
+    messages in cluster_ids[] along with the clusters_version they were loaded at.
+    Messages of the clusters already labeled with the category are left alone, so
+    labels made in other hunts keep their hunt.
+    """
     if 'api_token' not in session or 'username' not in session:
         logger.warning("Mass categorize attempt without being logged in")
         return jsonify({'status': 'error', 'message': 'Not logged in'})
@@ -1114,88 +3589,189 @@ def mass_categorize():
     
     hunt_id = request.form.get('hunt_id')
     message_ids = request.form.getlist('message_ids[]')
+    cluster_ids = request.form.getlist('cluster_ids[]')
+    clusters_version = request.form.get('clusters_version')
     category = request.form.get('category')
     
-    logger.info(f"User {username} mass categorizing {len(message_ids)} messages from hunt {hunt_id} as {category}")
+    logger.info("User %s mass categorizing %s messages and %s clusters from hunt %s as %s", username, len(message_ids),
+                len(cluster_ids), hunt_id, category)
     
-    if not hunt_id or not message_ids or not category:
-        logger.warning(f"Missing parameters: hunt_id={hunt_id}, message_ids={message_ids}, category={category}")
+    if not hunt_id or not (message_ids or cluster_ids) or not category:
+        logger.warning("Missing parameters: hunt_id=%s, message_ids=%s, cluster_ids=%s, category=%s", hunt_id, message_ids,
+                       cluster_ids, category)
         return jsonify({'status': 'error', 'message': 'Missing required parameters'})
     
     if category not in ['true_positive', 'false_positive']:
-        logger.warning(f"Invalid category: {category}")
+        logger.warning("Invalid category: %s", category)
         return jsonify({'status': 'error', 'message': 'Invalid category'})
     
-    # Load data
-    data = load_data(username)
-    true_positives = data.get('true_positives', {})
-    false_positives = data.get('false_positives', {})
-    hunts = data.get('hunts', [])
+    try:
+        cluster_ids = {int(cluster_id) for cluster_id in cluster_ids}
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cluster ID'})
+    
+    store = get_store(username)
+    hunt = store.get_hunt(hunt_id)
+    if not hunt:
+        return jsonify({'status': 'error', 'message': 'Hunt not found'})
+    
+    # Cluster IDs are reassigned whenever the hunt is reindexed, so they only mean
+    # the same messages at the version they were loaded at
+    clusters_changed = 'The groups of similar messages have changed since they were loaded. Reload them and try again.'
+    if cluster_ids and clusters_version != get_clusters_version(store, hunt_id):
+        logger.warning("Clusters of hunt %s changed since version %s, not labeling them", hunt_id, clusters_version)
+        return jsonify({'status': 'error', 'message': clusters_changed})
     
-    # Get analyzer to retrieve message subjects we may need
+    # Subjects come from the hunt's stored records, which also tell us which messages are in it
     try:
-        analyzer = HuntAnalyzer(session['api_token'])
-        results = analyzer.get_hunt_results(hunt_id)
-        message_map = {msg['id']: analyzer.get_subject_from_message_group(msg) for msg in results}
+        analyzer = get_analyzer(username, session['api_token'])
+        message_map = get_hunt_subjects(store, analyzer, hunt_id, message_ids) if message_ids else {}
+        if cluster_ids:
+            labels = get_cached_labels(store)
+            records = get_cached_records(store, analyzer, hunt_id)
+            if clusters_version != get_clusters_version(store, hunt_id):
+                logger.warning("Clusters of hunt %s changed while labeling them", hunt_id)
+                return jsonify({'status': 'error', 'message': clusters_changed})
+            for record in records:
+                if record.cluster_id in cluster_ids and labels.get(record.id, (None,))[0] != category:
+                    message_ids.append(record.id)
+                    message_map[record.id] = record.subject
     except Exception as e:
-        logger.error(f"Error retrieving hunt results for mass categorization: {traceback.format_exc()}")
+        logger.error("Error loading messages of hunt %s for mass categorization: %s", hunt_id, traceback.format_exc())
         return jsonify({'status': 'error', 'message': 'An internal error has occurred while retrieving hunt details.'})
     
-    # Process each message ID
-    successful_ids = []
-    failed_ids = []
+    # Label all messages of the hunt in one transaction
+    message_ids = list(dict.fromkeys(message_ids))
+    successful_ids = [msg_id for msg_id in message_ids if msg_id in message_map]
+    failed_ids = [msg_id for msg_id in message_ids if msg_id not in message_map]
+    if failed_ids:
+        logger.warning("Ignoring %s messages that aren't in hunt %s: %s", len(failed_ids), hunt_id, failed_ids[:10])
     
-    for msg_id in message_ids:
-        try:
-            # Get subject from the map or use a default
-            subject = message_map.get(msg_id, "Unknown subject")
-            
-            # Check existing categorization status
-            was_tp = msg_id in true_positives
-            was_fp = msg_id in false_positives
-            
-            # Remove from opposite category if needed
-            if category == 'true_positive' and msg_id in false_positives:
-                del false_positives[msg_id]
-            elif category == 'false_positive' and msg_id in true_positives:
-                del true_positives[msg_id]
-            
-            # Add to the correct category
-            if category == 'true_positive':
-                true_positives[msg_id] = {'hunt_id': hunt_id, 'subject': subject}
-            else:
-                false_positives[msg_id] = {'hunt_id': hunt_id, 'subject': subject}
-                
-            successful_ids.append(msg_id)
-        except Exception as e:
-            logger.error(f"Error categorizing message {msg_id}: {str(e)}")
-            failed_ids.append(msg_id)
-    
-    # Update hunt stats
-    for hunt in hunts:
-        if hunt['id'] == hunt_id:
-            # Recount for this hunt
-            tp_count = sum(1 for tp in true_positives.values() if tp['hunt_id'] == hunt_id)
-            fp_count = sum(1 for fp in false_positives.values() if fp['hunt_id'] == hunt_id)
-            hunt['true_positives_count'] = tp_count
-            hunt['false_positives_count'] = fp_count
-            logger.info(f"Updated hunt {hunt_id} stats: TP={tp_count}, FP={fp_count}")
-            break
-    
-    # Save data
-    data['true_positives'] = true_positives
-    data['false_positives'] = false_positives
-    data['hunts'] = hunts
-    save_data(data, username)
-    
-    logger.info(f"Mass categorization complete. {len(successful_ids)} succeeded, {len(failed_ids)} failed")
+    try:
+        store.set_labels([(msg_id, category, hunt_id, message_map[msg_id]) for msg_id in successful_ids])
+    except Exception as e:
+        logger.error("Error categorizing messages: %s", e)
+        failed_ids, successful_ids = failed_ids + successful_ids, []
+    
+    # Hunt stats were adjusted along with the labels
+    log_hunt_stats(store, successful_ids)
+    
+    logger.info("Mass categorization complete. %s succeeded, %s failed", len(successful_ids), len(failed_ids))
     return jsonify({
         'status': 'success', 
         'message': f'Successfully categorized {len(successful_ids)} messages',
         'successful_count': len(successful_ids),
-        'failed_count': len(failed_ids)
+        'failed_count': len(failed_ids),
+        'stats': get_hunt_stats(store, store.get_hunt(hunt_id))
     })
 
+def count_bits(bits):
+    """Count the set bits of an integer bitset."""
+    return bin(bits).count('1')
+
+class HuntComparison:
+    """Compares hunts by their indexed membership and the user's labels.
+    
+    Every message in the compared hunts or the label set is assigned a bit, and each
+    hunt and label category becomes an integer bitset, so comparing every revision of
+    a rule is a handful of big-integer operations instead of set building per pair.
+    """
+    
+    def __init__(self, store, hunt_ids):
+        self.hunt_ids = list(hunt_ids)
+        members = store.get_members_of_hunts(self.hunt_ids)
+        labels = get_cached_labels(store)
+        
+        # Assign bits to the labeled messages first, then to the rest of each hunt
+        self.msg_ids = list(labels)
+        self.bit_index = {msg_id: bit for bit, msg_id in enumerate(self.msg_ids)}
+        for hunt_id in self.hunt_ids:
+            for msg_id in members[hunt_id]:
+                if msg_id not in self.bit_index:
+                    self.bit_index[msg_id] = len(self.msg_ids)
+                    self.msg_ids.append(msg_id)
+        
+        self.hunts = {hunt_id: self.encode(members[hunt_id]) for hunt_id in self.hunt_ids}
+        self.true_positives = self.encode(msg_id for msg_id, (category, _) in labels.items() if category == 'true_positive')
+        self.false_positives = self.encode(msg_id for msg_id, (category, _) in labels.items() if category == 'false_positive')
+    
+    def encode(self, msg_ids):
+        """Encode message IDs as a bitset."""
+        buffer = bytearray((len(self.msg_ids) + 7) // 8)
+        for msg_id in msg_ids:
+            bit = self.bit_index[msg_id]
+            buffer[bit >> 3] |= 1 << (bit & 7)
+        return int.from_bytes(buffer, 'little')
+    
+    def decode(self, bits):
+        """Decode a bitset into message IDs, in bit order."""
+        msg_ids = []
+        for byte_index, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')):
+            while byte:
+                low_bit = byte & -byte
+                msg_ids.append(self.msg_ids[(byte_index << 3) + low_bit.bit_length() - 1])
+                byte ^= low_bit
+        return msg_ids
+    
+    def compare(self, previous_hunt_id, current_hunt_id):
+        """Get the bitsets describing how the current hunt changed from the previous one."""
+        prev = self.hunts[previous_hunt_id]
+        curr = self.hunts[current_hunt_id]
+        prev_true_positives = prev & self.true_positives
+        prev_false_positives = prev & self.false_positives
+        curr_true_positives = curr & self.true_positives
+        
+        return {
+            'prev_true_positives': prev_true_positives,
+            'prev_false_positives': prev_false_positives,
+            'curr_true_positives': curr_true_positives,
+            'common_true_positives': prev_true_positives & curr,
+            'missing_true_positives': prev_true_positives & ~curr,
+            'common_false_positives': prev_false_positives & curr,
+            'eliminated_false_positives': prev_false_positives & ~curr,
+            'new_true_positives': curr_true_positives & ~prev_true_positives,
+            # True positives from all hunts that the current hunt doesn't match
+            'missing_all_true_positives': self.true_positives & ~curr
+        }
+    
+    def metrics(self, previous_hunt_id, current_hunt_id):
+        """Get the counts and rates of how the current hunt changed from the previous one."""
+        counts = {name: count_bits(bits) for name, bits in self.compare(previous_hunt_id, current_hunt_id).items()}
+        counts.update({
+            'previous_hunt_id': previous_hunt_id,
+            'current_hunt_id': current_hunt_id,
+            'fp_reduction_count': counts['eliminated_false_positives'],
+            'fp_reduction_percent': (counts['eliminated_false_positives'] / counts['prev_false_positives'] * 100) if counts['prev_false_positives'] else 0,
+            'tp_retention_percent': (counts['common_true_positives'] / counts['prev_true_positives'] * 100) if counts['prev_true_positives'] else 0,
+            'new_tp_count': counts['new_true_positives']
+        })
+        return counts
+    
+    def hunt_summary(self, hunt_id):
+        """Get a hunt's label counts and its coverage of all true positives."""
+        hunt = self.hunts[hunt_id]
+        total_true_positives = count_bits(self.true_positives)
+        true_positives = count_bits(hunt & self.true_positives)
+        return {
+            'hunt_id': hunt_id,
+            'samples': count_bits(hunt),
+            'true_positives': true_positives,
+            'false_positives': count_bits(hunt & self.false_positives),
+            'unlabeled': count_bits(hunt & ~(self.true_positives | self.false_positives)),
+            'missing_all_true_positives': total_true_positives - true_positives,
+            'tp_coverage_percent': (true_positives / total_true_positives * 100) if total_true_positives else 0
+        }
+    
+    def history(self):
+        """Summarize every hunt and compare each consecutive pair, in the order given."""
+        return {
+            'hunts': [self.hunt_summary(hunt_id) for hunt_id in self.hunt_ids],
+            'pairs': [self.metrics(previous_hunt_id, current_hunt_id)
+                      for previous_hunt_id, current_hunt_id in zip(self.hunt_ids, self.hunt_ids[1:])],
+            'total_true_positives': count_bits(self.true_positives),
+            'total_false_positives': count_bits(self.false_positives)
+        }
+
 @app.route('/compare')
 def compare():
     """Compare hunts page."""
@@ -1204,8 +3780,7 @@ def compare():
         return redirect(url_for('index'))
     
     username = session['username']
-    data = load_data(username)
-    return render_template('compare.html', hunts=data.get('hunts', []), username=username)
+    return render_template('compare.html', hunts=get_store(username).get_hunts(), username=username)
 
 @app.route('/compare_hunts', methods=['POST'])
 def compare_hunts():
@@ -1221,7 +3796,7 @@ def compare_hunts():
     
     previous_hunt_id = request.form.get('previous_hunt')
     current_hunt_id = request.form.get('current_hunt')
-    logger.info(f"User {username} comparing hunts: previous={previous_hunt_id}, current={current_hunt_id}")
+    logger.info("User %s comparing hunts: previous=%s, current=%s", username, previous_hunt_id, current_hunt_id)
     
     if not previous_hunt_id or not current_hunt_id:
         logger.warning("Missing hunt IDs for comparison")
@@ -1233,16 +3808,13 @@ def compare_hunts():
         flash('Please select different hunts for comparison', 'danger')
         return redirect(url_for('compare'))
     
-    # Load data
-    data = load_data(username)
-    hunts = data.get('hunts', [])
-    
     # Find the hunts
-    prev_hunt = next((h for h in hunts if h['id'] == previous_hunt_id), None)
-    curr_hunt = next((h for h in hunts if h['id'] == current_hunt_id), None)
+    store = get_store(username)
+    prev_hunt = store.get_hunt(previous_hunt_id)
+    curr_hunt = store.get_hunt(current_hunt_id)
     
     if not prev_hunt or not curr_hunt:
-        logger.warning(f"Hunt not found: prev={prev_hunt is None}, curr={curr_hunt is None}")
+        logger.warning("Hunt not found: prev=%s, curr=%s", prev_hunt is None, curr_hunt is None)
         flash('Hunt not found', 'danger')
         return redirect(url_for('compare'))
     
@@ -1254,8 +3826,11 @@ def compare_hunts():
     prev_categorized = prev_tp_count + prev_fp_count
     prev_total_categorized = prev_categorized
     
+    # Maintained stats already count pre-labeled samples in the tp/fp counts
+    if 'unlabeled_count' in prev_hunt:
+        prev_total_categorized = prev_total - prev_hunt['unlabeled_count']
     # Account for pre-labeled samples only if they're not already counted in tp/fp counts
-    if prev_pre_labeled > 0 and prev_categorized < prev_total:
+    elif prev_pre_labeled > 0 and prev_categorized < prev_total:
         prev_total_categorized = min(prev_total, prev_categorized + prev_pre_labeled)
     
     curr_total = curr_hunt.get('total_samples', 0)
@@ -1265,45 +3840,36 @@ def compare_hunts():
     curr_categorized = curr_tp_count + curr_fp_count
     curr_total_categorized = curr_categorized
     
+    # Maintained stats already count pre-labeled samples in the tp/fp counts
+    if 'unlabeled_count' in curr_hunt:
+        curr_total_categorized = curr_total - curr_hunt['unlabeled_count']
     # Account for pre-labeled samples only if they're not already counted in tp/fp counts
-    if curr_pre_labeled > 0 and curr_categorized < curr_total:
+    elif curr_pre_labeled > 0 and curr_categorized < curr_total:
         curr_total_categorized = min(curr_total, curr_categorized + curr_pre_labeled)
     
-    logger.info(f"Previous hunt: {prev_hunt['name']} - {prev_total_categorized}/{prev_total} categorized (including {prev_pre_labeled} pre-labeled)")
-    logger.info(f"Current hunt: {curr_hunt['name']} - {curr_total_categorized}/{curr_total} categorized (including {curr_pre_labeled} pre-labeled)")
+    logger.info("Previous hunt: %s - %s/%s categorized (including %s pre-labeled)",
+                prev_hunt['name'], prev_total_categorized, prev_total, prev_pre_labeled)
+    logger.info("Current hunt: %s - %s/%s categorized (including %s pre-labeled)",
+                curr_hunt['name'], curr_total_categorized, curr_total, curr_pre_labeled)
     
     # Log detailed stats for debugging
-    logger.debug(f"Previous hunt stats: {prev_hunt}")
-    logger.debug(f"Current hunt stats: {curr_hunt}")
+    logger.debug("Previous hunt stats: %s", prev_hunt)
+    logger.debug("Current hunt stats: %s", curr_hunt)
     
     if prev_total_categorized < prev_total:
-        logger.warning(f"Previous hunt not fully categorized: {prev_total_categorized}/{prev_total}")
+        logger.warning("Previous hunt not fully categorized: %s/%s", prev_total_categorized, prev_total)
         flash(f'Please categorize all samples in "{prev_hunt["name"]}" before comparing', 'warning')
         return redirect(url_for('analyze_hunt', hunt_id=previous_hunt_id))
     
     if curr_total_categorized < curr_total:
-        logger.warning(f"Current hunt not fully categorized: {curr_total_categorized}/{curr_total}")
+        logger.warning("Current hunt not fully categorized: %s/%s", curr_total_categorized, curr_total)
         flash(f'Cannot compare: "{curr_hunt["name"]} ({curr_total} samples, {curr_total_categorized}/{curr_total} labeled) - Incomplete" is not fully labeled. Please label all samples first.', 'warning')
         return redirect(url_for('analyze_hunt', hunt_id=current_hunt_id))
     
-    # Load data
-    data = load_data()
-    hunts = data.get('hunts', [])
-    true_positives = data.get('true_positives', {})
-    false_positives = data.get('false_positives', {})
-    
-    # Get hunt information
-    prev_hunt = next((h for h in hunts if h['id'] == previous_hunt_id), None)
-    curr_hunt = next((h for h in hunts if h['id'] == current_hunt_id), None)
-    
-    if not prev_hunt or not curr_hunt:
-        flash('Hunt not found', 'danger')
-        return redirect(url_for('compare'))
-    
     try:
-        analyzer = HuntAnalyzer(session['api_token'])
-        previous_results = analyzer.get_hunt_results(previous_hunt_id)
-        current_results = analyzer.get_hunt_results(current_hunt_id)
+        analyzer = get_analyzer(username, session['api_token'])
+        previous_records = get_cached_records(store, analyzer, previous_hunt_id)
+        current_records = get_cached_records(store, analyzer, current_hunt_id)
         
         # Check if timeframes are similar
         timeframe_warning = None
@@ -1337,87 +3903,71 @@ def compare_hunts():
                 # If we can't parse the dates, don't show a warning
                 pass
         
-        # Collect all message IDs and subjects from both hunts
-        prev_messages = {msg["id"]: analyzer.get_subject_from_message_group(msg) for msg in previous_results}
-        curr_messages = {msg["id"]: analyzer.get_subject_from_message_group(msg) for msg in current_results}
-        
-        # Identify true positives and false positives in previous hunt
-        prev_true_positives = set(msg_id for msg_id in prev_messages.keys() if msg_id in true_positives)
-        prev_false_positives = set(msg_id for msg_id in prev_messages.keys() if msg_id in false_positives)
+        # Compare membership bitsets; loading the records above indexes legacy hunts
+        engine = HuntComparison(store, [previous_hunt_id, current_hunt_id])
+        result = engine.compare(previous_hunt_id, current_hunt_id)
+        metrics = engine.metrics(previous_hunt_id, current_hunt_id)
+        prev_messages = {record.id: record.subject for record in previous_records}
+        curr_messages = {record.id: record.subject for record in current_records}
         
-        # Common and new/missing samples
-        common_true_positives = list(prev_true_positives.intersection(curr_messages.keys()))
-        missing_true_positives = list(prev_true_positives - set(curr_messages.keys()))
-        common_false_positives = list(prev_false_positives.intersection(curr_messages.keys()))
-        eliminated_false_positives = list(prev_false_positives - set(curr_messages.keys()))
-        
-        # Determine all true positives from all previous hunts that should be in current hunt
-        all_previous_true_positives = set(true_positives.keys())
-        missing_all_true_positives = list(all_previous_true_positives - set(curr_messages.keys()))
-        
-        # Identify new true positives (in current hunt but not in previous hunt)
-        # First identify all messages in current hunt that are labeled as true positives
-        curr_true_positives = set(msg_id for msg_id in curr_messages.keys() if msg_id in true_positives)
-        # Then exclude those that were already in the previous hunt
-        new_true_positives = list(curr_true_positives - prev_true_positives)
-        
-        # Generate MQL diff if available
+        # Generate MQL diff if available, leaving long rules that weren't diffed before for the page to load
         prev_mql = prev_hunt.get('mql_source', '')
         curr_mql = curr_hunt.get('mql_source', '')
-        mql_diff = create_html_diff(prev_mql, curr_mql)
+        mql_diff = get_cached_html_diff(prev_mql, curr_mql)
+        if mql_diff is None and len(prev_mql or '') + len(curr_mql or '') <= MQL_INLINE_DIFF_CHARS:
+            mql_diff = create_html_diff(prev_mql, curr_mql)
         
         # Prepare comparison data for template
         comparison = {
             'prev_hunt': prev_hunt,
             'curr_hunt': curr_hunt,
-            'prev_samples': len(previous_results),
-            'curr_samples': len(current_results),
-            'prev_true_positives': len(prev_true_positives),
-            'prev_false_positives': len(prev_false_positives),
-            'curr_true_positives': len(curr_true_positives),
+            'prev_samples': len(previous_records),
+            'curr_samples': len(current_records),
+            'prev_true_positives': metrics['prev_true_positives'],
+            'prev_false_positives': metrics['prev_false_positives'],
+            'curr_true_positives': metrics['curr_true_positives'],
             'timeframe_warning': timeframe_warning,
             'mql_diff': mql_diff,
             'common_true_positives': [
                 {'id': msg_id, 'prev_subject': prev_messages[msg_id], 'curr_subject': curr_messages[msg_id]}
-                for msg_id in common_true_positives
+                for msg_id in engine.decode(result['common_true_positives'])
             ],
             'common_false_positives': [
                 {'id': msg_id, 'prev_subject': prev_messages[msg_id], 'curr_subject': curr_messages[msg_id]}
-                for msg_id in common_false_positives
+                for msg_id in engine.decode(result['common_false_positives'])
             ],
             'eliminated_false_positives': [
                 {'id': msg_id, 'subject': prev_messages[msg_id]}
-                for msg_id in eliminated_false_positives
+                for msg_id in engine.decode(result['eliminated_false_positives'])
             ],
             'missing_true_positives': [
                 {'id': msg_id, 'subject': prev_messages[msg_id]}
-                for msg_id in missing_true_positives
+                for msg_id in engine.decode(result['missing_true_positives'])
             ],
             'new_true_positives': [
                 {'id': msg_id, 'subject': curr_messages[msg_id]}
-                for msg_id in new_true_positives
+                for msg_id in engine.decode(result['new_true_positives'])
             ],
             'missing_all_true_positives': []
         }
         
         # Add missing true positives from all hunts
+        missing_all_true_positives = engine.decode(result['missing_all_true_positives'])
+        hunt_names = {hunt['id']: hunt['name'] for hunt in store.get_hunts()}
+        missing_labels = store.get_label_map(missing_all_true_positives)
         for msg_id in missing_all_true_positives:
-            if msg_id in true_positives:
-                tp_data = true_positives[msg_id]
-                orig_hunt_id = tp_data.get('hunt_id', 'Unknown')
-                orig_hunt = next((h for h in hunts if h['id'] == orig_hunt_id), {'name': 'Unknown Hunt'})
-                
-                comparison['missing_all_true_positives'].append({
-                    'id': msg_id,
-                    'subject': tp_data.get('subject', 'Unknown subject'),
-                    'hunt_name': orig_hunt['name']
-                })
+            tp_data = missing_labels[msg_id]
+            comparison['missing_all_true_positives'].append({
+                'id': msg_id,
+                'subject': tp_data.get('subject') or 'Unknown subject',
+                'hunt_name': hunt_names.get(tp_data.get('hunt_id'), 'Unknown Hunt')
+            })
         
         # Calculate metrics
-        fp_reduction_count = len(eliminated_false_positives)
-        fp_reduction_percent = (fp_reduction_count / len(prev_false_positives) * 100) if prev_false_positives else 0
-        tp_retention_percent = (len(common_true_positives) / len(prev_true_positives) * 100) if prev_true_positives else 0
-        new_tp_count = len(new_true_positives)
+        fp_reduction_count = metrics['fp_reduction_count']
+        fp_reduction_percent = metrics['fp_reduction_percent']
+        tp_retention_percent = metrics['tp_retention_percent']
+        new_tp_count = metrics['new_tp_count']
         
         comparison['metrics'] = {
             'fp_reduction_count': fp_reduction_count,
@@ -1470,8 +4020,339 @@ def compare_hunts():
         flash(f'Error: {str(e)}', 'danger')
         return redirect(url_for('compare'))
 
+def get_hunt_history(username, api_token, hunt_ids):
+    """Compare the given hunts in the order they were added, indexing any that aren't yet."""
+    store = get_store(username)
+    hunts = [hunt for hunt in store.get_hunts() if hunt['id'] in set(hunt_ids)]
+    if len(hunts) != len(set(hunt_ids)):
+        raise Exception("Hunt not found")
+    
+    unindexed = [hunt['id'] for hunt in hunts if not store.is_indexed(hunt['id'])]
+    if unindexed:
+        index_hunts(get_analyzer(username, api_token), store, unindexed)
+    
+    history = HuntComparison(store, [hunt['id'] for hunt in hunts]).history()
+    for hunt, summary in zip(hunts, history['hunts']):
+        summary['name'] = hunt['name']
+    return history
+
+@app.route('/compare_history', methods=['POST'])
+def compare_history():
+    """Compare a sequence of hunts revision by revision."""
+    if 'api_token' not in session or 'username' not in session:
+        flash('Please log in first', 'warning')
+        return redirect(url_for('index'))
+    
+    username = session['username']
+    hunt_ids = request.form.getlist('hunt_ids')
+    if len(set(hunt_ids)) < 2:
+        flash('Please select at least two hunts for the history', 'danger')
+        return redirect(url_for('compare'))
+    
+    try:
+        start_time = time.time()
+        history = get_hunt_history(username, session['api_token'], hunt_ids)
+        logger.info("User %s compared %s hunts in %.3fs", username, len(history['hunts']), time.time() - start_time)
+        return render_template('comparison_history.html', history=history)
+    except Exception as e:
+        flash(f'Error: {str(e)}', 'danger')
+        return redirect(url_for('compare'))
+
+@app.route('/api/compare')
+def api_compare():
+    """Compare hunts revision by revision, defaulting to all hunts in the order they were added."""
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    username = session['username']
+    hunt_ids = [hunt_id for hunt_id in request.args.get('hunt_ids', '').split(',') if hunt_id]
+    if not hunt_ids:
+        hunt_ids = [hunt['id'] for hunt in get_store(username).get_hunts()]
+    
+    try:
+        history = get_hunt_history(username, session['api_token'], hunt_ids)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+    
+    return jsonify({'status': 'success', **history})
+
+@app.route('/api/mql_diff')
+def api_mql_diff():
+    """Get the HTML diff between the MQL sources of two hunts.
+    
+    Query parameters:
+        previous_hunt, current_hunt: the IDs of the hunts to diff
+    """
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    store = get_store(session['username'])
+    prev_hunt = store.get_hunt(request.args.get('previous_hunt', ''))
+    curr_hunt = store.get_hunt(request.args.get('current_hunt', ''))
+    if not prev_hunt or not curr_hunt:
+        return jsonify({'status': 'error', 'message': 'Hunt not found'})
+    
+    return jsonify({
+        'status': 'success',
+        'html': create_html_diff(prev_hunt.get('mql_source', ''), curr_hunt.get('mql_source', ''))
+    })
+
+@app.route('/analytics')
+def analytics():
+    """Rule analytics page: how often each flagged rule fires and how its messages are labeled."""
+    if 'api_token' not in session or 'username' not in session:
+        flash('Please log in first', 'warning')
+        return redirect(url_for('index'))
+    
+    username = session['username']
+    store = get_store(username)
+    hunt_id = request.args.get('hunt_id') or None
+    hunt = store.get_hunt(hunt_id) if hunt_id else None
+    if hunt_id and not hunt:
+        flash('Hunt not found', 'danger')
+        return redirect(url_for('analytics'))
+    
+    return render_template('analytics.html',
+                          hunts=store.get_hunts(),
+                          hunt=hunt,
+                          rules=get_rule_analytics(store, hunt_id),
+                          unindexed_count=len(store.get_hunts_without_records()),
+                          username=username)
+
+@app.route('/api/rules')
+def api_rules():
+    """Get the number of messages each rule flagged and how they're labeled.
+    
+    Query parameters:
+        hunt_id: count one hunt's messages instead of the distinct messages of all hunts
+    """
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    store = get_store(session['username'])
+    hunt_id = request.args.get('hunt_id') or None
+    if hunt_id and not store.get_hunt(hunt_id):
+        return jsonify({'status': 'error', 'message': 'Hunt not found'})
+    
+    return jsonify({'status': 'success', 'hunt_id': hunt_id, 'rules': get_rule_analytics(store, hunt_id)})
+
+@app.route('/api/rules/cooccurrence')
+def api_rule_cooccurrence():
+    """Get the rules that flagged the same messages as a rule, and how those messages are labeled.
+    
+    Query parameters:
+        rule: the name of the rule
+        hunt_id: only count messages of this hunt
+    """
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    rule = request.args.get('rule', '')
+    if not rule:
+        return jsonify({'status': 'error', 'message': 'No rule given'})
+    
+    store = get_store(session['username'])
+    hunt_id = request.args.get('hunt_id') or None
+    if hunt_id and not store.get_hunt(hunt_id):
+        return jsonify({'status': 'error', 'message': 'Hunt not found'})
+    
+    return jsonify({'status': 'success', 'rule': rule, 'hunt_id': hunt_id,
+                    'rules': get_rule_analytics(store, hunt_id, rule)})
+
+@app.route('/api/verify_stats')
+def verify_stats():
+    """Recount hunt stats from scratch and report any drift from the maintained counters."""
+    if 'api_token' not in session or 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Not logged in'})
+    
+    repair = request.args.get('repair', '0') == '1'
+    drift = get_store(session['username']).verify_stats(repair=repair)
+    
+    return jsonify({
+        'status': 'success',
+        'drifted_hunts': len(drift),
+        'repaired': repair and bool(drift),
+        'drift': {hunt_id: {field: {'maintained': maintained, 'actual': actual}
+                            for field, (maintained, actual) in fields.items()}
+                  for hunt_id, fields in drift.items()}
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Serve request, job and phase timings in the Prometheus text format."""
+    if not METRICS_ENABLED:
+        return jsonify({'status': 'error', 'message': 'Metrics are disabled'}), 404
+    
+    if METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {METRICS_TOKEN}".encode('utf-8')):
+            return jsonify({'status': 'error', 'message': 'Not authorized'}), 401
+    
+    return Response(generate_latest(get_metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+@app.cli.command('verify-stats')
+@click.option('--repair', is_flag=True, help='Replace drifted stats with the recount.')
+def verify_stats_command(repair):
+    """Recount every user's hunt stats and report drift from the maintained counters."""
+    for username in sorted(os.listdir(DATA_DIR)):
+        if os.path.exists(os.path.join(DATA_DIR, username, 'hunt_data.db')):
+            store = LabelStore(username)
+            drift = store.verify_stats(repair=repair)
+            store.close()
+            print(f"{username}: {len(drift)} hunts drifted{' (repaired)' if repair and drift else ''}")
+            for hunt_id, fields in drift.items():
+                print(f"  {hunt_id}: " + ", ".join(f"{field} {maintained} != {actual}" for field, (maintained, actual) in fields.items()))
+
+@app.cli.command('migrate-json')
+def migrate_json_command():
+    """Migrate every user's legacy hunt_data.json file into the SQLite label store."""
+    for username in sorted(os.listdir(DATA_DIR)):
+        if os.path.exists(os.path.join(DATA_DIR, username, 'hunt_data.json')):
+            # Opening the store migrates the JSON file
+            LabelStore(username).close()
+            print(f"Migrated data for user {username}")
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """A RotatingFileHandler that several server processes can write to.
+    
+    The size of the file on disk decides when it's rotated, and processes take turns
+    rotating it under a lock. A process that finds the file was rotated by another one
+    reopens it instead of writing on to the rotated file.
+    """
+    
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.lock_path = f"{self.baseFilename}.lock"
+        self.inode = None
+    
+    def _open(self):
+        stream = super()._open()
+        self.inode = os.fstat(stream.fileno()).st_ino
+        return stream
+    
+    def get_file_stat(self):
+        try:
+            return os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return None
+    
+    def shouldRollover(self, record):
+        stat = self.get_file_stat()
+        if self.stream is not None and (stat is None or stat.st_ino != self.inode):
+            # Another process rotated the file, write to the new one
+            self.stream.close()
+            self.stream = None
+            return False
+        return self.maxBytes > 0 and stat is not None and stat.st_size >= self.maxBytes
+    
+    def doRollover(self):
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have rotated the file while we waited
+            stat = self.get_file_stat()
+            if stat is not None and stat.st_size >= self.maxBytes:
+                super().doRollover()
+            elif self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+def set_log_levels(levels):
+    """Set the levels of single loggers from a "name=LEVEL,name=LEVEL" list."""
+    for item in filter(None, (item.strip() for item in levels.split(','))):
+        name, _, level = item.partition('=')
+        if not name.strip() or not level.strip():
+            raise Exception(f"Invalid LOG_LEVELS entry \"{item}\", expected name=LEVEL")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+# Writes queued log records to the console and log file, so requests never wait on log I/O
+_log_listener = None
+
+def start_log_writer(queue_handler, handlers):
+    """Start a thread writing the records collected by queue_handler to handlers."""
+    global _log_listener
+    queue_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+
+def stop_log_writer():
+    """Write out the records still queued and stop the writer thread."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+def configure_logging():
+    """Send the application's log to the console and LOG_FILE, once per process.
+    
+    Records are queued and written by a background thread. Forked server workers don't
+    inherit the thread, so each starts its own.
+    """
+    root = logging.getLogger()
+    if getattr(root, '_hunt_analyzer_configured', False):
+        return
+    
+    formatter = logging.Formatter('%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(SharedRotatingFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    start_log_writer(queue_handler, handlers)
+    os.register_at_fork(after_in_child=lambda: start_log_writer(queue_handler, handlers))
+    atexit.register(stop_log_writer)
+    
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    set_log_levels(LOG_LEVELS)
+    root._hunt_analyzer_configured = True
+
+def get_secret_key():
+    """Get the key sessions are signed with, the same for every worker process.
+    
+    SECRET_KEY is used if set. Otherwise a random key is generated once and kept in
+    the data directory, so sessions stay valid across workers and restarts.
+    """
+    secret_key = os.environ.get('SECRET_KEY')
+    if secret_key:
+        return secret_key
+    
+    key_path = os.path.join(DATA_DIR, '.secret_key')
+    if not os.path.exists(key_path):
+        # Link a fully written key into place so concurrent workers all read the same one
+        temp_path = f"{key_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(os.urandom(32))
+        os.chmod(temp_path, 0o600)
+        try:
+            os.link(temp_path, key_path)
+            logger.info("Generated a session key in %s", key_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    
+    with open(key_path, 'rb') as f:
+        return f.read()
+
+def create_app():
+    """Set up logging, the data directory and the session key, and return the app.
+    
+    This is the entry point for WSGI servers, e.g. gunicorn "app:create_app()". Importing
+    the module builds the app and the objects that gunicorn's preloaded master shares with
+    the workers it forks: the job and API thread pools, the API request semaphore and
+    the Prometheus metrics. It starts no threads, since the pools only start them when
+    first used, and leaves the data directory, database and log files alone until this
+    is called. Calling this more than once is harmless.
+    """
+    configure_logging()
+    os.makedirs(DATA_DIR, exist_ok=True)
+    if not app.secret_key:
+        app.secret_key = get_secret_key()
+    return app
+
 if __name__ == '__main__':
-    # Determine if we're in development or production
-    debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
     # Only enable debug mode in development, never in production
-    app.run(host='0.0.0.0', port=5000, debug=debug_mode)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000, debug=DEBUG_MODE)
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""A local stand-in for the parts of the Sublime API that Hunt Analyzer uses.
+
+Serves GET /v1/hunt-jobs/<id> and GET /v1/hunt-jobs/<id>/results with generated
+message groups, so the app can be benchmarked without talking to Sublime. Hunts are
+named h0, h1, ... and model successive revisions of a rule: each hunt's messages
+overlap the previous hunt's by the configured fraction.
+
+GET /_stats returns the number of requests and bytes served since the last
+/_stats?reset=1.
+
+Run it on its own to point a development server at it:
+
+    python bench/fake_sublime.py --port 8765 --hunts 5 --hunt-size 2000
+    SUBLIME_API_BASE_URL=http://127.0.0.1:8765/v1 python app.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+VERDICTS = ['malicious', 'suspicious', 'spam', 'graymail', 'likely_benign', 'unknown']
+RULES = ['Credential phishing: Generic', 'Link to free file host', 'Impersonation: Invoice',
+         'Suspicious attachment', 'Brand impersonation: Microsoft', 'Display name spoofing']
+DOMAINS = ['example.com', 'invoices.example.net', 'mail.example.org', 'notify.example.io', 'example.co.uk']
+
+class FakeSublime:
+    """Generated hunts and the options for serving them."""
+
+    def __init__(self, hunts=5, hunt_size=1000, hunt_sizes=None, overlap=0.8, shape='v1',
+                 latency=0.0, rate_429=0.0, retry_after=1.0, misreport_total=True,
+                 group_bytes=1500, seed=0):
+        self.sizes = list(hunt_sizes) if hunt_sizes else [hunt_size] * hunts
+        self.overlap = overlap
+        self.shape = shape
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.misreport_total = misreport_total
+        self.padding = 'x' * max(0, group_bytes - 400)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def hunt_ids(self):
+        return [f'h{index}' for index in range(len(self.sizes))]
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'details': 0, 'results': 0, 'throttled': 0, 'not_found': 0, 'bytes_sent': 0}
+
+    def get_stats(self, reset=False):
+        with self.lock:
+            stats = dict(self.stats)
+        if reset:
+            self.reset_stats()
+        return stats
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def get_hunt_index(self, hunt_id):
+        match = re.fullmatch(r'h(\d+)', hunt_id)
+        if match and int(match.group(1)) < len(self.sizes):
+            return int(match.group(1))
+        return None
+
+    def get_message_numbers(self, index):
+        """Get the range of message numbers in a hunt, shifted from the previous hunt's by the overlap."""
+        start = sum(int(size * (1 - self.overlap)) for size in self.sizes[:index])
+        return range(start, start + self.sizes[index])
+
+    def make_message_group(self, number):
+        """Build the message group of a message, the same in every hunt it appears in."""
+        rng = random.Random(number)
+        msg_id = f'{hashlib.md5(str(number).encode()).hexdigest()[:8]}-{number:08d}'
+        subject = f'{rng.choice(["Invoice", "Payment", "Shared document", "Password expiry", "Voicemail"])} #{number}'
+        domain = rng.choice(DOMAINS)
+        sender_name = f'Sender {rng.randrange(50)}'
+        sender_email = f'sender{rng.randrange(50)}@{domain}'
+        recipients = [f'user{rng.randrange(500)}@corp.example' for _ in range(rng.randrange(1, 6))]
+        created_at = f'2025-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}T{rng.randrange(24):02d}:00:00Z'
+        verdict = rng.choice(VERDICTS)
+        rules = rng.sample(RULES, rng.randrange(1, 4))
+
+        if self.shape == 'v0':
+            return {
+                'id': msg_id,
+                'messages': [{
+                    'subject': subject,
+                    'sender': {'display_name': sender_name, 'email': sender_email},
+                    'recipients': [{'email': recipient} for recipient in recipients],
+                    'created_at': created_at,
+                    'body_preview': self.padding
+                }],
+                'attack_score_verdict': verdict,
+                'flagged_rules': [{'name': rule} for rule in rules]
+            }
+
+        return {
+            'id': msg_id,
+            'subjects': [subject],
+            'sender_email_addresses': [sender_email],
+            'sender_display_name__info': {sender_name: 1},
+            'recipients': recipients,
+            'first_created_at': created_at,
+            'attack_score_verdict': verdict,
+            'flagged_rules': [{'rule_meta': {'name': rule}} for rule in rules],
+            'previews': [{'sender_display_name': sender_name, 'body': self.padding}]
+        }
+
+    def get_details(self, index):
+        hunt_id = f'h{index}'
+        return {
+            'id': hunt_id,
+            'status': 'COMPLETED',
+            'mql': '\n'.join(f'and any(body.links, .href_url.domain.root_domain == "{domain}")'
+                             for domain in DOMAINS[:index % len(DOMAINS) + 1]),
+            'range_start_time': '2025-01-01T00:00:00Z',
+            'range_end_time': '2025-01-31T00:00:00Z'
+        }
+
+    def get_results(self, index, offset, limit):
+        numbers = self.get_message_numbers(index)
+        page = numbers[offset:offset + limit]
+        total = len(numbers)
+        if self.misreport_total and self.shape == 'v1':
+            # The v1 API can report the page size as the total
+            total = min(limit, total)
+        return {'message_groups': [self.make_message_group(number) for number in page], 'total_group_count': total}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.fake.count('bytes_sent', len(data))
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/_stats':
+            return self.send_json(200, fake.get_stats(reset=query.get('reset') == ['1']))
+
+        match = re.fullmatch(r'/v1/hunt-jobs/([^/]+)(/results)?', url.path)
+        index = fake.get_hunt_index(match.group(1)) if match else None
+        if index is None:
+            fake.count('not_found')
+            return self.send_json(404, {'error': 'not found'})
+
+        if fake.latency:
+            time.sleep(fake.latency * fake.random.uniform(0.5, 1.5))
+        if fake.rate_429 and fake.random.random() < fake.rate_429:
+            fake.count('throttled')
+            return self.send_json(429, {'error': 'too many requests'}, {'Retry-After': str(fake.retry_after)})
+
+        if not match.group(2):
+            fake.count('details')
+            return self.send_json(200, fake.get_details(index))
+
+        fake.count('results')
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['50'])[0])
+        self.send_json(200, fake.get_results(index, offset, limit), {'ETag': f'"h{index}-{fake.shape}"'})
+
+def serve(fake, host='127.0.0.1', port=0):
+    """Start serving a FakeSublime in a background thread, returning the server."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_arguments(parser):
+    """Add the options of a FakeSublime to an argument parser."""
+    parser.add_argument('--hunts', type=int, default=5, help='number of hunts (default 5)')
+    parser.add_argument('--hunt-size', type=int, default=1000, help='message groups per hunt (default 1000)')
+    parser.add_argument('--hunt-sizes', help='comma-separated message groups of each hunt, instead of --hunts and --hunt-size')
+    parser.add_argument('--overlap', type=float, default=0.8, help="fraction of each hunt's messages also in the previous hunt (default 0.8)")
+    parser.add_argument('--shape', choices=['v0', 'v1'], default='v1', help='API payload shape (default v1)')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to each API response (default 0)')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='fraction of API requests answered with 429 (default 0)')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds of 429 responses (default 1)')
+    parser.add_argument('--correct-total', action='store_true', help='report the real total_group_count instead of the page size')
+    parser.add_argument('--group-bytes', type=int, default=1500, help='approximate size of a message group in bytes (default 1500)')
+
+def from_arguments(args):
+    """Build a FakeSublime from parsed arguments."""
+    return FakeSublime(
+        hunts=args.hunts,
+        hunt_size=args.hunt_size,
+        hunt_sizes=[int(size) for size in args.hunt_sizes.split(',')] if args.hunt_sizes else None,
+        overlap=args.overlap,
+        shape=args.shape,
+        latency=args.latency,
+        rate_429=args.rate_429,
+        retry_after=args.retry_after,
+        misreport_total=not args.correct_total,
+        group_bytes=args.group_bytes
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Sublime API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = serve(from_arguments(args), args.host, args.port)
+    print(f'Serving hunts on http://{args.host}:{server.server_address[1]}/v1', flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
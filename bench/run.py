@@ -0,0 +1,421 @@
+"""Benchmark Hunt Analyzer's routes against a local stand-in for the Sublime API.
+
+Starts bench/fake_sublime.py in a subprocess, points a fresh app at it with an empty
+data directory, and drives the app through its routes with Flask's test client, one
+scenario at a time. Each scenario reports:
+
+- latency percentiles of each route, and wall time of the background jobs it ran
+- requests made to the API, responses throttled with 429 and bytes downloaded
+- bytes the app process read and wrote other than API traffic, which is essentially
+  its data directory (Linux only, from /proc/self/io)
+- the size of the data directory afterwards
+- peak resident memory (Linux; elsewhere the peak of the whole run so far), or with
+  --tracemalloc the peak of memory allocated by Python
+
+Examples:
+
+    python bench/run.py
+    python bench/run.py --hunts 10 --hunt-size 5000 --latency 0.05 --rate-429 0.01
+    python bench/run.py --json baseline.json
+    python bench/run.py --baseline baseline.json --max-regression 0.25
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.request import urlopen
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_sublime import add_arguments  # noqa: E402
+
+SCENARIOS = ['import', 'bulk_import', 'analyze', 'categorize', 'mass_categorize', 'reprocess', 'compare']
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def read_proc_io():
+    """Get the bytes this process has read and written through system calls, or None."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def reset_peak_rss():
+    """Reset the process's peak resident memory, returning whether that's supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def read_peak_rss():
+    """Get the process's peak resident memory in bytes."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def get_dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class FakeServer:
+    """bench/fake_sublime.py running in a subprocess, so its traffic isn't counted as the app's I/O."""
+
+    def __init__(self, fake_args):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'fake_sublime.py'), '--port', '0', *fake_args],
+            stdout=subprocess.PIPE, text=True
+        )
+        line = self.process.stdout.readline()
+        if not line.startswith('Serving hunts on '):
+            self.process.kill()
+            raise RuntimeError(f'Fake Sublime API failed to start: {line!r}')
+        self.base_url = line.split()[-1]
+        self.stats_url = self.base_url.rsplit('/v1', 1)[0] + '/_stats'
+
+    def get_stats(self, reset=False):
+        with urlopen(self.stats_url + ('?reset=1' if reset else '')) as response:
+            return json.load(response)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+class Scenario:
+    """Measures the requests and jobs run inside a with block."""
+
+    def __init__(self, bench, name):
+        self.bench = bench
+        self.name = name
+        self.timings = {}
+
+    def __enter__(self):
+        self.bench.fake.get_stats(reset=True)
+        if self.bench.use_tracemalloc:
+            tracemalloc.reset_peak()
+        else:
+            self.rss_resettable = reset_peak_rss()
+        self.io_before = read_proc_io()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            return False
+        wall_time = time.perf_counter() - self.started
+        io_after = read_proc_io()
+        api = self.bench.fake.get_stats()
+
+        if self.bench.use_tracemalloc:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        else:
+            peak_memory = read_peak_rss()
+
+        io = None
+        if self.io_before and io_after:
+            # API responses are the app's only other large reads
+            io = {
+                'read_bytes': max(0, io_after[0] - self.io_before[0] - api['bytes_sent']),
+                'written_bytes': io_after[1] - self.io_before[1]
+            }
+
+        self.bench.results[self.name] = {
+            'wall_time_s': round(wall_time, 3),
+            'routes': {
+                label: {
+                    'count': len(values),
+                    'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                    'p90_ms': round(percentile(values, 0.9) * 1000, 2),
+                    'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                    'max_ms': round(max(values) * 1000, 2)
+                }
+                for label, values in self.timings.items()
+            },
+            'api': {
+                'requests': api['details'] + api['results'] + api['throttled'],
+                'details': api['details'],
+                'results': api['results'],
+                'throttled': api['throttled'],
+                'bytes': api['bytes_sent']
+            },
+            'io': io,
+            'data_dir_bytes': get_dir_size(self.bench.data_dir),
+            'peak_memory_bytes': peak_memory,
+            'peak_memory_kind': 'tracemalloc' if self.bench.use_tracemalloc else
+                                ('rss' if self.rss_resettable else 'rss_since_start')
+        }
+        return False
+
+    def record(self, label, elapsed):
+        self.timings.setdefault(label, []).append(elapsed)
+
+    def request(self, method, url, label=None, **kwargs):
+        """Send a request to the app, timing it under label and failing on error responses."""
+        started = time.perf_counter()
+        response = self.bench.client.open(url, method=method, **kwargs)
+        self.record(label or f'{method} {url.split("?")[0]}', time.perf_counter() - started)
+
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {url} returned {response.status_code}')
+        if response.is_json and response.get_json().get('status') == 'error':
+            raise RuntimeError(f'{method} {url} failed: {response.get_json().get("message")}')
+        return response
+
+    def wait_for_jobs(self, label):
+        """Wait for the user's background jobs to finish, timing them under label."""
+        started = time.perf_counter()
+        while self.bench.client.get('/jobs').get_json()['jobs']:
+            time.sleep(0.05)
+        self.record(label, time.perf_counter() - started)
+
+        with self.bench.app.app_context():
+            store = self.bench.hunt_app.get_store('bench')
+            failed = [job for job in store.pop_finished_jobs() if job['status'] != 'completed']
+        if failed:
+            raise RuntimeError(f'{label} failed: {failed[0]["message"]}')
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.use_tracemalloc = args.tracemalloc
+        self.results = {}
+        self.random = random.Random(args.seed)
+
+    def run(self):
+        args = self.args
+        self.data_dir = tempfile.mkdtemp(prefix='hunt-bench-')
+        self.fake = FakeServer(self.get_fake_args())
+
+        try:
+            # The app reads its settings at import
+            os.environ.update({
+                'SUBLIME_API_BASE_URL': self.fake.base_url,
+                'HUNT_DATA_DIR': self.data_dir,
+                'HUNT_LOG_FILE': '',
+                'LOG_LEVEL': args.log_level
+            })
+            import app as hunt_app
+            self.hunt_app = hunt_app
+            self.app = hunt_app.create_app()
+            self.app.config['TESTING'] = True
+            self.client = self.app.test_client()
+            self.client.post('/set_token', data={'username': 'bench', 'api_token': 'bench-token'})
+
+            if self.use_tracemalloc:
+                tracemalloc.start()
+
+            self.hunt_ids = [f'h{index}' for index in range(len(self.get_hunt_sizes()))]
+            # Hunts are imported one at a time, then the rest at once
+            split = max(1, len(self.hunt_ids) - args.bulk_hunts)
+            self.single_hunt_ids = self.hunt_ids[:split]
+            self.bulk_hunt_ids = self.hunt_ids[split:]
+
+            for name in args.scenarios:
+                print(f'Running {name}...', file=sys.stderr, flush=True)
+                getattr(self, f'scenario_{name}')()
+        finally:
+            self.fake.stop()
+            if not args.keep_data:
+                shutil.rmtree(self.data_dir, ignore_errors=True)
+
+        return self.results
+
+    def get_fake_args(self):
+        args = self.args
+        fake_args = ['--hunts', str(args.hunts), '--hunt-size', str(args.hunt_size), '--overlap', str(args.overlap),
+                     '--shape', args.shape, '--latency', str(args.latency), '--rate-429', str(args.rate_429),
+                     '--retry-after', str(args.retry_after), '--group-bytes', str(args.group_bytes)]
+        if args.hunt_sizes:
+            fake_args += ['--hunt-sizes', args.hunt_sizes]
+        if args.correct_total:
+            fake_args.append('--correct-total')
+        return fake_args
+
+    def get_hunt_sizes(self):
+        if self.args.hunt_sizes:
+            return [int(size) for size in self.args.hunt_sizes.split(',')]
+        return [self.args.hunt_size] * self.args.hunts
+
+    def get_message_ids(self, hunt_id, status=None):
+        url = f'/api/hunts/{hunt_id}/messages?ids=1' + (f'&status={status}' if status else '')
+        return self.client.get(url).get_json()['ids']
+
+    # Scenarios
+
+    def scenario_import(self):
+        with Scenario(self, 'import') as scenario:
+            for hunt_id in self.single_hunt_ids:
+                scenario.request('POST', '/add_hunt', data={'hunt_id': hunt_id, 'hunt_name': f'Revision {hunt_id}'})
+                scenario.wait_for_jobs('job import')
+
+    def scenario_bulk_import(self):
+        if not self.bulk_hunt_ids:
+            return
+        with Scenario(self, 'bulk_import') as scenario:
+            hunt_list = '\n'.join(f'{hunt_id},Revision {hunt_id}' for hunt_id in self.bulk_hunt_ids)
+            scenario.request('POST', '/add_hunts', data={'hunt_list': hunt_list})
+            scenario.wait_for_jobs('job bulk import')
+
+    def scenario_analyze(self):
+        with Scenario(self, 'analyze') as scenario:
+            for hunt_id in self.hunt_ids:
+                scenario.request('GET', f'/analyze/{hunt_id}', label='GET /analyze/<id>')
+                for offset in range(0, 500, 100):
+                    scenario.request('GET', f'/api/hunts/{hunt_id}/messages?offset={offset}&limit=100',
+                                     label='GET /api/hunts/<id>/messages')
+                scenario.request('GET', f'/api/hunts/{hunt_id}/messages?sort=subject&order=desc&verdict=malicious,spam',
+                                 label='GET /api/hunts/<id>/messages (filtered)')
+
+    def scenario_categorize(self):
+        hunt_id = self.hunt_ids[0]
+        msg_ids = self.get_message_ids(hunt_id)
+        with Scenario(self, 'categorize') as scenario:
+            for msg_id in self.random.sample(msg_ids, min(self.args.labels, len(msg_ids))):
+                scenario.request('POST', '/categorize', data={
+                    'msg_id': msg_id, 'hunt_id': hunt_id, 'subject': f'Subject of {msg_id}',
+                    'category': self.random.choice(['true_positive', 'false_positive'])
+                })
+            for start in range(0, min(self.args.labels, len(msg_ids)), 20):
+                operations = [{'msg_id': msg_id, 'category': self.random.choice(['true_positive', 'false_positive'])}
+                              for msg_id in msg_ids[start:start + 20]]
+                scenario.request('POST', '/categorize_batch', json={'hunt_id': hunt_id, 'operations': operations})
+
+    def scenario_mass_categorize(self):
+        with Scenario(self, 'mass_categorize') as scenario:
+            for hunt_id in self.hunt_ids:
+                msg_ids = self.get_message_ids(hunt_id, status='unlabeled')
+                # Mark a tenth of each hunt as true positives and the rest as false positives
+                split = len(msg_ids) // 10
+                for category, ids in (('true_positive', msg_ids[:split]), ('false_positive', msg_ids[split:])):
+                    if ids:
+                        scenario.request('POST', '/mass_categorize',
+                                         data={'hunt_id': hunt_id, 'category': category, 'message_ids[]': ids})
+
+    def scenario_reprocess(self):
+        with Scenario(self, 'reprocess') as scenario:
+            for label, form in (('changed', {}), ('full', {'full': 'on'}), ('refetch', {'full': 'on', 'refresh': 'on'})):
+                scenario.request('POST', '/reprocess_samples', label=f'POST /reprocess_samples ({label})', data=form)
+                scenario.wait_for_jobs(f'job reprocess ({label})')
+
+    def scenario_compare(self):
+        with Scenario(self, 'compare') as scenario:
+            # Compare each revision with the previous one twice, the second time with warm caches
+            for _ in range(2):
+                for previous_hunt_id, current_hunt_id in zip(self.hunt_ids, self.hunt_ids[1:]):
+                    scenario.request('POST', '/compare_hunts',
+                                     data={'previous_hunt': previous_hunt_id, 'current_hunt': current_hunt_id})
+            scenario.request('POST', '/compare_history', data={'hunt_ids': self.hunt_ids})
+            scenario.request('GET', '/api/compare')
+
+def format_bytes(value):
+    if value is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(value) < 1024 or unit == 'GB':
+            return f'{value:.0f} {unit}' if unit == 'B' else f'{value:.1f} {unit}'
+        value /= 1024
+
+def print_results(results):
+    for name, result in results.items():
+        io = result['io'] or {}
+        print(f"\n== {name}: {result['wall_time_s']:.2f}s, API {result['api']['requests']} requests "
+              f"({result['api']['throttled']} throttled, {format_bytes(result['api']['bytes'])}), "
+              f"I/O read {format_bytes(io.get('read_bytes'))} written {format_bytes(io.get('written_bytes'))}, "
+              f"data dir {format_bytes(result['data_dir_bytes'])}, "
+              f"peak memory {format_bytes(result['peak_memory_bytes'])} ({result['peak_memory_kind']})")
+        print(f"   {'route':<48} {'count':>6} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+        for label, route in result['routes'].items():
+            print(f"   {label:<48} {route['count']:>6} {route['p50_ms']:>10.1f} {route['p90_ms']:>10.1f} "
+                  f"{route['p99_ms']:>10.1f} {route['max_ms']:>10.1f}")
+
+def compare_results(results, baseline, max_regression, min_delta_ms):
+    """Print how latencies and API requests changed from a baseline, returning the regressions."""
+    regressions = []
+    print('\n== Changes from baseline')
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for label, route in result['routes'].items():
+            base_route = base['routes'].get(label)
+            if not base_route:
+                continue
+            for field in ('p50_ms', 'p90_ms'):
+                before, after = base_route[field], route[field]
+                change = (after - before) / before if before else 0.0
+                print(f"   {name:<16} {label:<48} {field} {before:>10.1f} -> {after:>10.1f} ({change:+.0%})")
+                if change > max_regression and after - before > min_delta_ms:
+                    regressions.append(f'{name} {label} {field} {before:.1f} -> {after:.1f} ms')
+        before, after = base['api']['requests'], result['api']['requests']
+        if after > before:
+            print(f"   {name:<16} API requests {before} -> {after}")
+            regressions.append(f'{name} API requests {before} -> {after}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    add_arguments(parser)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated scenarios to run, in order (default {",".join(SCENARIOS)})')
+    parser.add_argument('--bulk-hunts', type=int, default=2, help='hunts imported at once by bulk_import (default 2)')
+    parser.add_argument('--labels', type=int, default=200, help='messages labeled one at a time by categorize (default 200)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tracemalloc', action='store_true', help='measure peak Python allocations instead of resident memory (slower)')
+    parser.add_argument('--log-level', default='WARNING', help="the app's LOG_LEVEL (default WARNING)")
+    parser.add_argument('--keep-data', action='store_true', help='keep the data directory for inspection')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with results previously written with --json')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='with --baseline, fail if a p50 or p90 latency grew by more than this fraction (default 0.25)')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0,
+                        help='ignore latency regressions smaller than this many milliseconds (default 5)')
+    args = parser.parse_args()
+    args.scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    results = Bench(args).run()
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': {key: value for key, value in vars(args).items() if key not in ('json', 'baseline')},
+                       'scenarios': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['scenarios']
+        regressions = compare_results(results, baseline, args.max_regression, args.min_delta_ms)
+        if regressions:
+            print('\nRegressions:\n   ' + '\n   '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
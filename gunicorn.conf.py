@@ -0,0 +1,61 @@
+"""Gunicorn settings for serving Hunt Analyzer in production.
+
+Run with: gunicorn --config gunicorn.conf.py "app:create_app()"
+
+Every setting can be overridden with the environment variables below or gunicorn's
+own command line options.
+"""
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Worker processes, each serving requests from a pool of threads. Page loads of one
+# reviewer don't queue behind another's, and a slow request only ties up one thread.
+workers = int(os.environ.get('WEB_CONCURRENCY', '4'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+# Import the app once in the master process and fork workers from it, so they start
+# quickly and share its memory until they write to it. Importing starts no threads and
+# doesn't open the database or log files, so workers don't share connections or threads.
+preload_app = True
+
+# Requests that fetch a hunt's results from Sublime can take a while
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+keepalive = 5
+
+# On shutdown or a graceful reload (kill -HUP), workers stop accepting requests and
+# get this long to finish running requests and background jobs
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '120'))
+
+accesslog = '-'
+errorlog = '-'
+
+# Heartbeat files on disk-backed /tmp can stall workers in containers
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Workers write their metrics to files in this directory so /metrics can add up those
+# of every worker. It has to be set before the app is imported.
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'hunt-analyzer-metrics')
+)
+os.makedirs(metrics_dir, exist_ok=True)
+
+def on_starting(server):
+    # Start counting from zero rather than adding to the metrics of a previous run
+    for name in os.listdir(metrics_dir):
+        path = os.path.join(metrics_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+def worker_exit(server, worker):
+    # Fail jobs queued in this worker and let running ones finish. The worker has stopped
+    # its heartbeat by now, so the master kills it once timeout has passed.
+    from app import shutdown_jobs
+    shutdown_jobs(timeout=min(graceful_timeout, timeout))